@@ -89,6 +89,27 @@ extra_columns = ['Separation_XMM_OPT', 'bias_OPT_MAG']
 for col in min_output_columns + extra_columns:
 	assert col in result.columns, ('looking for', col, 'in', result.columns)
 
+joined = nwaylib.join_columns(result, 'OPT', pyfits.open('doc/COSMOS_OPTICAL.fits')[1].data, ['MAG'])
+assert 'OPT_MAG' in joined.columns, joined.columns
+assert (joined['OPT_MAG'][result['OPT'] == -1] == -99).all()
+
+tiled = nwaylib.nway_match(
+	[
+	table_from_fits('doc/COSMOS_XMM.fits', area=2.0),
+	table_from_fits('doc/COSMOS_OPTICAL.fits', poserr_value=0.1, area=2.0, magnitude_columns=[('MAG', 'auto')]),
+	],
+	match_radius = 20, # in arcsec
+	prior_completeness = 0.9,
+	store_mag_hists = False,
+	mag_include_radius = 4.0, # in arcsec
+	tile_nside = 64,
+)
+assert len(tiled) == len(result), (len(tiled), len(result))
+result_sorted = result.sort_values(['XMM', 'OPT']).reset_index(drop=True)
+tiled = tiled.sort_values(['XMM', 'OPT']).reset_index(drop=True)
+assert (result_sorted['OPT'] == tiled['OPT']).all()
+assert numpy.allclose(result_sorted['prob_this_match'], tiled['prob_this_match'])
+
 result = nwaylib.nway_match(
 	[
 	table_from_fits('doc/COSMOS_XMM.fits', area=2.0),
@@ -130,6 +151,28 @@ assert len(result) == 387601, (len(result), result)
 for col in min_output_columns + extra_columns:
 	assert col in result.columns, ('looking for', col, 'in', result.columns)
 
+# matching batches of primary sources against catalogues kept in memory
+catalogues = [
+	nwaylib.Catalogue(table_from_fits('doc/COSMOS_OPTICAL.fits', poserr_value=0.1, area=2.0, magnitude_columns=[('MAG', 'OPT_MAG_fit.txt')]), 20),
+	nwaylib.Catalogue(table_from_fits('doc/COSMOS_IRAC.fits', poserr_value=0.5, area=2.0, magnitude_columns=[('mag_ch1', 'IRAC_mag_ch1_fit.txt')]), 20),
+]
+primary = table_from_fits('doc/COSMOS_XMM.fits', area=2.0)
+batch = dict(primary, ra=primary['ra'][:50], dec=primary['dec'][:50], error=primary['error'][:50])
+result = nwaylib.nway_match([batch] + [c.table for c in catalogues], match_radius=20, prior_completeness=0.9, logger=logger.NullOutputLogger())
+batch_result = nwaylib.match_batch(batch, catalogues, prior_completeness=0.9)
+assert list(batch_result.columns) == list(result.columns), (batch_result.columns, result.columns)
+assert len(batch_result) == len(result), (len(batch_result), len(result))
+assert numpy.allclose(batch_result['prob_this_match'], result['prob_this_match'])
+
+# the same with numpy only, and for one source at a time
+columns = nwaylib.match_sources(batch['ra'], batch['dec'], batch['error'], catalogues, prior_completeness=0.9,
+	primary_density=len(batch['ra']) / batch['area'], name=batch['name'])
+assert list(columns.keys()) == list(result.columns), (columns.keys(), result.columns)
+assert numpy.allclose(columns['prob_this_match'], result['prob_this_match'])
+one = nwaylib.match_one(batch['ra'][3], batch['dec'][3], batch['error'][3], catalogues, prior_completeness=0.9,
+	primary_density=len(batch['ra']) / batch['area'], name=batch['name'])
+assert numpy.allclose(one['prob_this_match'], result['prob_this_match'][result[batch['name']] == 3])
+
 
 """
 if not filenames[0].endswith('shifted.fits'):
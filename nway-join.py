@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+__doc__ = """Attach input catalogue columns to a narrow nway output (nway.py --out-narrow).
+
+The input catalogues are identified by their table name, and the rows
+by the <table>_index columns of the narrow output. Missing counterparts
+are filled with -99.
+
+Example: nway-join.py out-narrow.fits COSMOS_XMM.fits COSMOS_OPTICAL.fits --columns OPT:MAG OPT:ID --out=out.fits
+"""
+
+import sys
+import numpy
+import astropy.io.fits as pyfits
+import argparse
+import tqdm
+import nwaylib.logger as logger
+import nwaylib.fastskymatch as match
+import nwaylib.tableio as tableio
+
+class HelpfulParser(argparse.ArgumentParser):
+	def error(self, message):
+		sys.stderr.write('error: %s\n' % message)
+		self.print_help()
+		sys.exit(2)
+
+parser = HelpfulParser(description=__doc__,
+	epilog="""Johannes Buchner (C) 2013-2017 <johannes.buchner.acad@gmx.com>""",
+	formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+parser.add_argument('matchcatalogue', type=str,
+	help="""narrow nway output catalogue (FITS or Parquet)""")
+
+parser.add_argument('catalogues', type=str, nargs='+',
+	help="""input catalogue files used in the match (FITS, Parquet, HDF5 or CSV)""")
+
+parser.add_argument('--columns', metavar='TABLE:COLUMN', type=str, nargs='+', default=None,
+	help="""input catalogue columns to attach. Use <table>:* for all columns of a table.
+	If not set, all columns of all given catalogues are attached.""")
+
+parser.add_argument('--out', metavar='OUTFILE', help='output file name', required=True)
+
+parser.add_argument('--out-format', default='fits', choices=['fits', 'parquet'],
+	help='output file format')
+
+parser.add_argument('--chunk-size', type=int, default=1000000,
+	help='number of rows processed at a time')
+
+# parsing arguments
+args = parser.parse_args()
+
+print('loading input catalogues ...')
+tables = {}
+fits_formats = {}
+for filename in args.catalogues:
+	input_table = tableio.open_table(filename)
+	assert input_table.name, 'file "%s" does not give a table name (EXTNAME)' % filename
+	print('    "%s" from %s' % (input_table.name, filename))
+	tables[input_table.name] = input_table.data
+	fits_formats[input_table.name] = input_table.formats
+
+join_columns = dict([(table_name, []) for table_name in tables])
+for spec in args.columns or ['%s:*' % table_name for table_name in tables]:
+	table_name, _, col_name = spec.partition(':')
+	assert table_name in tables, 'table "%s" of column "%s" not among the given catalogues: %s' % (table_name, spec, ', '.join(tables.keys()))
+	colnames = tables[table_name].dtype.names
+	if col_name == '*':
+		join_columns[table_name] += colnames
+	else:
+		assert col_name in colnames, 'column "%s" unknown. Known columns in table "%s": %s' % (col_name, table_name, ', '.join(colnames))
+		join_columns[table_name].append(col_name)
+
+print('loading narrow match catalogue %s ...' % args.matchcatalogue)
+if args.matchcatalogue.endswith('.parquet'):
+	import pyarrow.parquet as pq
+	parquet_file = pq.ParquetFile(args.matchcatalogue)
+	header = tableio.read_parquet_metadata(args.matchcatalogue)
+	def chunks():
+		for i in range(parquet_file.num_row_groups):
+			rows = parquet_file.read_row_group(i)
+			yield [(n, rows.column(n).to_numpy(zero_copy_only=False)) for n in rows.column_names]
+	nchunks = parquet_file.num_row_groups
+	primary_hdu = None
+else:
+	f = pyfits.open(args.matchcatalogue, memmap=True)
+	primary_hdu = f[0]
+	header = f[0].header
+	data = f[1].data
+	assert header['COL_PRIM'] in data.dtype.names, 'primary column "%s" not in match catalogue' % header['COL_PRIM']
+	ranges = tableio.row_group_ranges(data[header['COL_PRIM']], args.chunk_size)
+	def chunks():
+		for lo, hi in ranges:
+			yield [(n, data[n][lo:hi]) for n in data.dtype.names]
+	nchunks = len(ranges)
+
+assert 'COLS_IDX' in header, 'match catalogue "%s" is not a narrow nway output (no COLS_IDX header entry)' % args.matchcatalogue
+index_columns = header['COLS_IDX'].split()
+
+print('attaching columns ...')
+writer = None
+formats = {}
+for table_name, cols in join_columns.items():
+	for n, format in zip(tables[table_name].dtype.names, fits_formats[table_name]):
+		formats['%s_%s' % (table_name, n)] = format
+if args.out_format == 'parquet':
+	writer = tableio.ParquetTableWriter(args.out, metadata=dict(header))
+else:
+	if primary_hdu is None:
+		primary_hdu = match.make_primary_hdu()
+		for k, v in header.items():
+			primary_hdu.header[k] = v
+	writer = tableio.FITSTableWriter(args.out, 'NWAYMATCH', formats=formats, primary_hdu=primary_hdu)
+
+for table_name, cols in join_columns.items():
+	if hasattr(tables[table_name], 'load'):
+		tables[table_name].load(cols)
+
+with writer:
+	for chunk in tqdm.tqdm(chunks(), total=nchunks):
+		chunk_columns = dict(chunk)
+		joined = []
+		for table_name, cols in join_columns.items():
+			k = '%s_index' % table_name
+			assert k in index_columns, 'no index column for table "%s" in match catalogue. Have: %s' % (table_name, ', '.join(index_columns))
+			joined += [(c.name, c.array) for c in match.gather_columns(tables[table_name], table_name,
+				numpy.asarray(chunk_columns[k]), fits_formats[table_name], cols, logger=logger.NullOutputLogger())]
+		writer.write(joined + chunk)
+
+print('    wrote "%s" (%d rows)' % (args.out, writer.nrows))
+
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+__doc__ = """Combine the partial outputs of a sharded nway run into one output file.
+
+The shards are written by nway.py --manifest <file> --shard <number>.
+All shards have to be complete and computed from the same manifest.
+
+Example: nway-merge-shards.py run.json
+"""
+
+import sys
+import os
+import argparse
+import astropy.io.fits as pyfits
+import tqdm
+import nwaylib.fastskymatch as match
+import nwaylib.tableio as tableio
+import nwaylib.sharding as sharding
+
+class HelpfulParser(argparse.ArgumentParser):
+	def error(self, message):
+		sys.stderr.write('error: %s\n' % message)
+		self.print_help()
+		sys.exit(2)
+
+parser = HelpfulParser(description=__doc__,
+	epilog="""Johannes Buchner (C) 2013-2017 <johannes.buchner.acad@gmx.com>""",
+	formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+parser.add_argument('manifest', type=str,
+	help="""shard manifest (written by nway.py --shards)""")
+
+parser.add_argument('--out', metavar='OUTFILE', default=None,
+	help='output file name. By default, the --out of the manifest.')
+
+parser.add_argument('--chunk-size', type=int, default=1000000,
+	help='number of rows copied at a time')
+
+# parsing arguments
+args = parser.parse_args()
+
+manifest = sharding.read_manifest(args.manifest)
+outfile = args.out or os.path.join(manifest['directory'], manifest['output'])
+nshards = len(manifest['shards'])
+
+print('checking %d shards of manifest "%s" ...' % (nshards, args.manifest))
+filenames = [sharding.shard_filename(manifest, shard) for shard in range(nshards)]
+missing = [shard for shard, filename in enumerate(filenames) if not os.path.exists(filename)]
+assert not missing, 'shards not (completely) computed: %s' % ', '.join(map(str, missing))
+
+def read_shard(filename):
+	"""
+	Returns header and a generator of chunks.
+	"""
+	if manifest['out_format'] == 'parquet':
+		import pyarrow.parquet as pq
+		parquet_file = pq.ParquetFile(filename)
+		header = tableio.read_parquet_metadata(filename)
+		def chunks():
+			for i in range(parquet_file.num_row_groups):
+				rows = parquet_file.read_row_group(i)
+				yield [(n, rows.column(n).to_numpy(zero_copy_only=False)) for n in rows.column_names]
+		return header, None, chunks
+	f = pyfits.open(filename, memmap=True)
+	data = f[1].data
+	def chunks():
+		for lo, hi in tableio.row_group_ranges(data[f[0].header['COL_PRIM']], args.chunk_size):
+			yield [(n, data[n][lo:hi]) for n in data.dtype.names]
+	return f[0].header, f, chunks
+
+shards = []
+for shard, filename in enumerate(filenames):
+	header, f, chunks = read_shard(filename)
+	assert header.get('MANIFEST') == manifest['id'], 'shard file "%s" was not computed from this manifest' % filename
+	assert int(header.get('SHARD')) == shard, 'shard file "%s" contains shard %s' % (filename, header.get('SHARD'))
+	shards.append((header, f, chunks))
+
+print('combining into "%s" ...' % outfile)
+header, f, _ = shards[0]
+if manifest['out_format'] == 'parquet':
+	metadata = dict([(k, v) for k, v in header.items() if k not in ('SHARD',)])
+	writer = tableio.ParquetTableWriter(outfile, metadata=metadata)
+else:
+	primary_hdu = match.make_primary_hdu()
+	primary_hdu.header = f[0].header.copy()
+	del primary_hdu.header['SHARD']
+	formats = dict([(c.name, c.format) for c in f[1].columns])
+	writer = tableio.FITSTableWriter(outfile, 'NWAYMATCH', formats=formats, primary_hdu=primary_hdu)
+
+with writer:
+	for shard, (header, f, chunks) in enumerate(tqdm.tqdm(shards)):
+		for chunk in chunks():
+			writer.write(chunk)
+
+print('    wrote "%s" (%d rows from %d shards)' % (outfile, writer.nrows, nshards))
+
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+__doc__ = """Match batches of primary sources against catalogues kept in memory.
+
+The secondary catalogues are loaded once, with their spatial indexes and
+magnitude biases (see nwaylib.Catalogue). Batches of primary sources are
+then matched on request (see nwaylib.match_batch), over HTTP on localhost
+or on a Unix socket, several at a time with --workers.
+
+Request: POST /match with a JSON object with the lists ra, dec (degrees) and
+error (arcsec, or one value for all) of the primary sources, the sky area
+(square degrees) of the primary catalogue they are taken from, and optionally
+name, prior_completeness, acceptable_prob and min_prob.
+Response: a JSON object with the columns of the nway_match result.
+GET /status describes the loaded catalogues.
+
+nway-serve.py needs Python 3.5 or later.
+
+Example: nway-serve.py --radius 20 --port 8080 COSMOS_OPTICAL.fits 0.1 COSMOS_IRAC.fits 0.5
+         curl -d '{"ra": [150.1], "dec": [2.2], "error": 1.5, "area": 2.0}' http://localhost:8080/match
+"""
+
+import sys
+import os
+import json
+import signal
+import asyncio
+import argparse
+import multiprocessing
+import concurrent.futures
+from collections import OrderedDict
+import numpy
+import nwaylib
+import nwaylib.tableio as tableio
+
+class HelpfulParser(argparse.ArgumentParser):
+	def error(self, message):
+		sys.stderr.write('error: %s\n' % message)
+		self.print_help()
+		sys.exit(2)
+
+parser = HelpfulParser(description=__doc__,
+	epilog="""Johannes Buchner (C) 2013-2017 <johannes.buchner.acad@gmx.com>""",
+	formatter_class=argparse.RawDescriptionHelpFormatter)
+
+parser.add_argument('--radius', type=float, required=True,
+	help='exclusive search radius in arcsec for initial matching')
+
+parser.add_argument('--mag', metavar='MAGCOLUMN+MAGFILE', type=str, nargs=2, action='append', default=[],
+	help="""name of <table>:<column> for magnitude biasing, and the histogram file
+	(<table>_<column>_fit.txt of a nway.py run with --mag ... auto)""")
+
+parser.add_argument('--prior-completeness', metavar='COMPLETENESS', default=1.0, type=float,
+	help='expected matching completeness of the primary sources, if not given in the request')
+
+parser.add_argument('--acceptable-prob', metavar='PROB', type=float, default=0.5,
+	help='ratio limit up to which secondary solutions are flagged, if not given in the request')
+
+parser.add_argument('--port', type=int, default=8080,
+	help='port on localhost to serve HTTP requests on')
+
+parser.add_argument('--socket', type=str, default=None,
+	help='serve on this Unix socket instead of a port (e.g. curl --unix-socket <socket> http://localhost/match)')
+
+parser.add_argument('--workers', type=int, default=1,
+	help="""number of batches matched at a time. Several workers are forked processes,
+	which share the loaded catalogues.""")
+
+parser.add_argument('catalogues', type=str, nargs='+',
+	help="""secondary catalogue files (FITS, Parquet, HDF5 or CSV) and position errors.
+
+	Example: CANDELS_irac1.fits 0.5 gs_short.fits :pos_err
+	""")
+
+parser.add_argument('--in-format', default=None, choices=sorted(tableio.readers.keys()),
+	help='format of the catalogues. By default guessed from the file name extension.')
+
+parser.add_argument('--table-name', metavar=('FILENAME', 'NAME'), type=str, nargs=2, action='append', default=[],
+	help='table name of a catalogue, if the file does not give one (EXTNAME)')
+
+parser.add_argument('--sky-area', metavar=('FILENAME', 'AREA'), type=str, nargs=2, action='append', default=[],
+	help='sky area of a catalogue in square degrees, if the file does not give one (SKYAREA)')
+
+# parsing arguments
+args = parser.parse_args()
+
+filenames = args.catalogues[::2]
+pos_errors = args.catalogues[1::2]
+assert len(filenames) == len(pos_errors), 'each catalogue needs a position error (column or value)'
+table_name_overrides = dict(args.table_name)
+sky_area_overrides = dict(args.sky_area)
+
+print('loading catalogues ...')
+catalogues = []
+for filename, pos_error in zip(filenames, pos_errors):
+	catalogues.append(nwaylib.open_catalogue(filename, pos_error, args.radius, mags=args.mag,
+		name=table_name_overrides.get(filename), area=sky_area_overrides.get(filename), format=args.in_format))
+	biases = [col[len(catalogues[-1].name) + 1:] for col in catalogues[-1].source_biases.keys()]
+	print('    "%s" (%d sources) from %s, magnitude biases: %s' % (catalogues[-1].name, len(catalogues[-1]), filename, ', '.join(biases) or 'none'))
+for mag, magfile in args.mag:
+	assert mag.split(':', 1)[0] in [c.name for c in catalogues], 'table name specified for magnitude ("%s") unknown' % mag
+
+def match_request(request):
+	"""
+	Match the primary sources of a request. Returns the result columns,
+	with NaN as None (null).
+	"""
+	primary = dict(name=request.get('name', 'PRIMARY'), ra=request['ra'], dec=request['dec'],
+		error=request['error'], area=float(request['area']))
+	assert primary['name'] not in [c.name for c in catalogues], 'the primary name "%s" is also a catalogue name' % primary['name']
+	assert len(primary['ra']) == len(primary['dec']) > 0, 'ra and dec should be non-empty lists of the same length'
+	table = nwaylib.match_batch(primary, catalogues,
+		prior_completeness=numpy.asarray(request.get('prior_completeness', args.prior_completeness), dtype=float),
+		prob_ratio_secondary=request.get('acceptable_prob', args.acceptable_prob),
+		min_prob=request.get('min_prob', 0.))
+	return OrderedDict([(k, [None if v != v else v for v in table[k].values.tolist()]) for k in table.columns])
+
+def status():
+	return dict(radius=args.radius, catalogues=[dict(name=c.name, sources=len(c),
+		biases=list(c.source_biases.keys())) for c in catalogues], workers=args.workers)
+
+class PoolExecutor(object):
+	"""
+	A multiprocessing pool with the submit method of concurrent.futures
+	executors, for run_in_executor (ProcessPoolExecutor only takes a
+	multiprocessing context from Python 3.7).
+	"""
+	def __init__(self, pool):
+		self.pool = pool
+	def submit(self, fn, *args):
+		future = concurrent.futures.Future()
+		self.pool.apply_async(fn, args, callback=future.set_result, error_callback=future.set_exception)
+		return future
+	def shutdown(self, wait=True):
+		self.pool.close()
+		if wait:
+			self.pool.join()
+
+if args.workers > 1:
+	# forked workers share the catalogues loaded above; Ctrl-C stops only the server
+	pool = PoolExecutor(multiprocessing.get_context('fork').Pool(args.workers,
+		initializer=signal.signal, initargs=(signal.SIGINT, signal.SIG_IGN)))
+else:
+	pool = concurrent.futures.ThreadPoolExecutor(1)
+
+reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}
+
+async def respond(method, path, body):
+	if method == 'GET' and path == '/status':
+		return 200, status()
+	if method != 'POST' or path != '/match':
+		return 404, dict(error='use POST /match or GET /status')
+	try:
+		request = json.loads(body.decode('utf-8'))
+	except ValueError as e:
+		return 400, dict(error='invalid JSON: %s' % e)
+	try:
+		return 200, await asyncio.get_event_loop().run_in_executor(pool, match_request, request)
+	except (AssertionError, KeyError, TypeError, ValueError) as e:
+		return 400, dict(error='%s: %s' % (type(e).__name__, e))
+	except Exception as e:
+		return 500, dict(error='%s: %s' % (type(e).__name__, e))
+
+async def handle(reader, writer):
+	"""
+	Serve one HTTP request per connection.
+	"""
+	try:
+		request_line = await reader.readline()
+		if not request_line:
+			return
+		method, path = request_line.decode('latin-1').split()[:2]
+		headers = {}
+		while True:
+			line = await reader.readline()
+			if line in (b'\r\n', b'\n', b''):
+				break
+			key, _, value = line.decode('latin-1').partition(':')
+			headers[key.strip().lower()] = value.strip()
+		body = await reader.readexactly(int(headers.get('content-length', 0)))
+		code, response = await respond(method, path, body)
+		payload = json.dumps(response).encode('utf-8')
+		writer.write(('HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\nConnection: close\r\n\r\n' % (
+			code, reasons[code], len(payload))).encode('ascii') + payload)
+		await writer.drain()
+	finally:
+		writer.close()
+
+loop = asyncio.get_event_loop()
+if args.socket is not None:
+	if os.path.exists(args.socket):
+		os.unlink(args.socket)
+	server = loop.run_until_complete(asyncio.start_unix_server(handle, args.socket))
+	print('serving on Unix socket "%s" ...' % args.socket)
+else:
+	server = loop.run_until_complete(asyncio.start_server(handle, '127.0.0.1', args.port))
+	print('serving on http://localhost:%d/ ...' % args.port)
+sys.stdout.flush()
+try:
+	loop.run_forever()
+except KeyboardInterrupt:
+	pass
+finally:
+	server.close()
+	loop.run_until_complete(server.wait_closed())
+	pool.shutdown()
+	if args.socket is not None and os.path.exists(args.socket):
+		os.unlink(args.socket)
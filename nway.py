@@ -8,30 +8,45 @@ Example: nway.py --radius 10 --prior-completeness 0.95 --mag GOODS:mag_H auto --
 """
 
 import sys
+import os
 import numpy
-from numpy import log10, pi, exp
+from numpy import pi, exp
 import astropy.io.fits as pyfits
 import argparse
+import itertools
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 import tqdm
-import nwaylib.progress as progress
+import nwaylib
 import nwaylib.logger as logger
 import nwaylib.fastskymatch as match
 import nwaylib.bayesdistance as bayesdist
 import nwaylib.magnitudeweights as magnitudeweights
-
-def make_errors_table_matrix(table_names, pos_errors):
+import nwaylib.tableio as tableio
+import nwaylib.tiling as tiling
+import nwaylib.sharding as sharding
+import nwaylib.planning as planning
+import nwaylib.footprint as footprint
+import nwaylib.incremental as incremental
+import nwaylib.histcache as histcache
+import nwaylib.stagecache as stagecache
+import nwaylib.streaming as streaming
+from nwaylib.scratch import ScratchSpace, parse_size, format_size
+
+def make_errors_table_matrix(table_names, pos_errors, table, nrows, verbose=True):
 	symmetric = True
 	rotated = False
 	errors    = []
 	for ti, (table_name, pos_error) in enumerate(zip(table_names, pos_errors)):
 		colnames = tables[ti].dtype.names
 		if pos_error[0] != ':':
-			print('    Position error for "%s": using fixed value %f' % (table_name, float(pos_error)))
 			pos_error = float(pos_error)
-			if pos_error > match_radius * 60 * 60:
+			if verbose:
+				print('    Position error for "%s": using fixed value %f' % (table_name, pos_error))
+			if verbose and pos_error > match_radius * 60 * 60:
 				print('WARNING: Given separation error for "%s" is larger than the match radius! Increase --radius to >> %s' % (table_name, pos_error))
-			pos_error = float(pos_error) * numpy.ones(len(table))
-			errors.append((pos_error, pos_error, numpy.zeros_like(pos_error)))
+			pos_error = numpy.broadcast_to(float(pos_error), nrows)
+			errors.append((pos_error, pos_error, numpy.broadcast_to(0., nrows)))
 			continue
 		
 		keys = pos_error[1:].split(':')
@@ -42,9 +57,10 @@ def make_errors_table_matrix(table_names, pos_errors):
 		for k, meaning in zip(keys, meanings):
 			k2 = "%s_%s" % (table_name, k)
 			# get column
-			assert k2 in table.dtype.names, 'ERROR: Position error column "%s" not in table "%s". Have these columns: %s' % (k2, table_name, ', '.join(colnames))
-			print('    Position error for "%s": found column %s (for %s): Values are [%f..%f]' % (
-				table_name, k, meaning, tables[ti][k].min(), tables[ti][k].max()))
+			assert k2 in table, 'ERROR: Position error column "%s" not in table "%s". Have these columns: %s' % (k2, table_name, ', '.join(colnames))
+			if verbose:
+				print('    Position error for "%s": found column %s (for %s): Values are [%f..%f]' % (
+					table_name, k, meaning, tables[ti][k].min(), tables[ti][k].max()))
 		
 		if len(keys) == 3:
 			keys = keys[0], keys[1], keys[2]
@@ -58,7 +74,9 @@ def make_errors_table_matrix(table_names, pos_errors):
 			table_errors_dec = table["%s_%s" % (table_name, keys[1])]
 			table_errors_rho = table["%s_%s" % (table_name, keys[2])] / 180 * pi
 
-			intable_errors_ra, intable_errors_dec, intable_errors_rho = bayesdist.convert_from_ellipse(intable_errors_ra, intable_errors_dec, intable_errors_rho)
+			if verbose:
+				# only needed for the checks below
+				intable_errors_ra, intable_errors_dec, intable_errors_rho = bayesdist.convert_from_ellipse(intable_errors_ra, intable_errors_dec, intable_errors_rho)
 			table_errors_ra, table_errors_dec, table_errors_rho = bayesdist.convert_from_ellipse(table_errors_ra, table_errors_dec, table_errors_rho)
 			
 		elif len(keys) == 2:
@@ -85,10 +103,10 @@ def make_errors_table_matrix(table_names, pos_errors):
 			table_errors_rho = numpy.zeros_like(table_errors_ra)
 			
 		
-		if intable_errors_ra.min() <= 0 or intable_errors_dec.min() <= 0:
+		if verbose and (intable_errors_ra.min() <= 0 or intable_errors_dec.min() <= 0):
 			print('WARNING: Some separation errors in "%s" are 0! This will give invalid results (%d rows).' % (
 				keys[0], numpy.logical_and(intable_errors_ra <= 0, intable_errors_dec <= 0).sum()))
-		if intable_errors_ra.max() > match_radius * 60 * 60 or intable_errors_dec.max() > match_radius * 60 * 60:
+		if verbose and (intable_errors_ra.max() > match_radius * 60 * 60 or intable_errors_dec.max() > match_radius * 60 * 60):
 			print('WARNING: Some separation errors in "%s" are larger than the match radius! Increase --radius to >> %s' % (keys[0], max(intable_errors_ra.max(), intable_errors_dec.max())))
 		
 		errors.append((table_errors_ra, table_errors_dec, table_errors_rho))
@@ -109,6 +127,21 @@ parser = HelpfulParser(description=__doc__,
 parser.add_argument('--radius', type=float, required=True,
 	help='exclusive search radius in arcsec for initial matching')
 
+parser.add_argument('--adaptive-radius', metavar=('K', 'FLOOR'), type=float, nargs=2, default=None,
+	help="""search each pair of sources i, j only within k * sqrt(error_i^2 + error_j^2) + floor arcsec,
+	using the position error of each source. --radius is then the largest search radius,
+	for the sources with the largest errors. Pre-filter radii of catalogue pairs
+	(--prefilter-pair) are derived from the largest errors.
+
+	Example: --radius 20 --adaptive-radius 5 0.5""")
+
+parser.add_argument('--max-candidates', metavar='M', type=int, default=None,
+	help="""for each primary source, only consider the M nearest sources (by separation
+	relative to the position errors) of each secondary catalogue. This bounds the 
+	number of combinations per primary source in dense fields to (M+1)^(number of 
+	secondary catalogues). The number of candidates left out and an upper bound of 
+	their posterior mass are reported.""")
+
 parser.add_argument('--mag-radius', default=None, type=float,
 	help='search radius for building the magnitude histogram of target sources. If not set, the Bayesian posterior is used.')
 
@@ -131,6 +164,26 @@ parser.add_argument('--mag', metavar='MAGCOLUMN+MAGFILE', type=str, nargs=2, act
 	(use auto for auto-computation within mag-radius).
 	Example: --mag GOODS:mag_H auto --mag IRAC:mag_irac1 irac_histogram.txt""")
 
+parser.add_argument('--mag-grid', metavar='COLUMNS+GRIDFILE', type=str, nargs=2, action='append', default=[],
+	help="""joint prior of several columns of one catalogue (e.g., magnitude and colour), given as 
+	<table>:<column1>,<column2>, and the grid file (use auto to build it from the secure
+	matches, on adaptive bins in each column, like --mag auto).
+	Example: --mag-grid OPT:MAG,R_I auto""")
+
+parser.add_argument('--mag-cache', metavar='DIRECTORY', type=str, default=os.path.join(match.cachedir, 'maghists'),
+	help="""directory for caching the auto-computed magnitude histograms, by a fingerprint 
+	of the inputs and parameters they depend on. Later runs with the same inputs reuse them.""")
+
+parser.add_argument('--no-mag-cache', dest='mag_cache', action='store_const', const=None,
+	help='always compute the auto magnitude histograms, without caching them')
+
+parser.add_argument('--stage-cache', metavar='DIRECTORY', type=str, default=None,
+	help="""directory for caching the candidates and the distance Bayes factors (of each tile),
+	by a fingerprint of the input columns and parameters they depend on. Later runs with the same
+	inputs, e.g. with another --prior-completeness, --acceptable-prob or --min-prob, only 
+	compute the stages which depend on the parameters changed. Needs about as much disk 
+	space as the output.""")
+
 parser.add_argument('--acceptable-prob', metavar='PROB', type=float, default=0.5,
 	help='ratio limit up to which secondary solutions are flagged')
 
@@ -139,12 +192,129 @@ parser.add_argument('--min-prob', type=float, default=0,
 
 parser.add_argument('--out', metavar='OUTFILE', help='output file name', required=True)
 
+parser.add_argument('--sweep', metavar='PARAMETER=VALUES', type=str, action='append', default=[],
+	help="""match once, and compute the probabilities for several values of --prior-completeness, 
+	--acceptable-prob or --min-prob (for all combinations, if given several times). Each 
+	parameter set is written to its own output file, named after --out and the values.
+	Example: --sweep prior-completeness=0.8,0.9,0.95 writes out-prior-completeness0.8.fits etc.""")
+
+parser.add_argument('--update', metavar='PREVIOUS_OUTPUT', type=str, default=None,
+	help="""match incrementally, after rows of the catalogues were added, removed or changed:
+	only the primary sources within --radius of a changed source are matched again, and all 
+	other groups are copied from PREVIOUS_OUTPUT (of a run with the same arguments). The earlier
+	versions of the changed catalogues are given with --previous-catalogue. The auto magnitude 
+	histograms (from --mag-cache) and joint priors (<table>_<columns>_grid.txt) of the previous 
+	run are kept fixed; to refresh them, match all sources again. The groups matched again use 
+	the source densities of the current catalogues.""")
+
+parser.add_argument('--previous-catalogue', metavar=('FILENAME', 'PREVIOUS'), type=str, nargs=2, action='append', default=[],
+	help="""earlier version of an input catalogue, as matched for the --update output.
+
+	Example: --previous-catalogue gs_short.fits gs_short-old.fits""")
+
+parser.add_argument('--out-format', default='fits', choices=['fits', 'parquet', 'ndjson'],
+	help="""output file format. parquet (requires pyarrow) writes compressed columnar output, with row groups aligned to primary sources.
+	ndjson (only with --stream) writes one JSON object per line.""")
+
+parser.add_argument('--out-columns', metavar='TABLE:COLUMN', type=str, nargs='+', default=None,
+	help="""input catalogue columns to copy into the output, besides the ID, RA/DEC,
+	position error and magnitude columns needed for the computation. 
+	Use <table>:* for all columns of a table. If not set, all columns are copied.
+	
+	Example: --out-columns OPT:NAME IRAC:*""")
+
+parser.add_argument('--out-narrow', action='store_true',
+	help="""write only the row number of each candidate in each input catalogue 
+	(<table>_index, -1 if absent) and the computed columns. Input catalogue
+	columns can be attached later with nway-join.py.""")
+
+parser.add_argument('--chunk-size', type=int, default=1000000,
+	help='the output is computed and written in chunks of about this many rows, keeping whole primary source groups together.')
+
+parser.add_argument('--io-threads', type=int, default=4,
+	help="""number of threads for reading the input catalogues. In tiled mode, 
+	the next tile is also prepared while the current tile is written.""")
+
+parser.add_argument('--memory-limit', type=str, default=None,
+	help="""memory budget (e.g., 800M or 16G) for the intermediate arrays (candidates, 
+	separations, probabilities) of the match or of each tile. Beyond, they are
+	placed in memory-mapped scratch files and computed in chunks of --chunk-size rows.
+	Auto magnitude histograms are then built from the catalogue in chunks.""")
+
+parser.add_argument('--plan', action='store_true',
+	help="""do not match, but predict the number of candidates, the memory needed 
+	and the run time from the source densities and a sample of the primary sources,
+	and recommend --tile-nside, --shards and --chunk-size. Uses --memory-limit
+	as the memory available (default: the physical memory).""")
+
+parser.add_argument('--scratch-dir', type=str, default=None,
+	help='directory for the scratch files of --memory-limit. By default, the system temporary directory.')
+
+parser.add_argument('--no-footprint-filter', dest='footprint_filter', action='store_false',
+	help="""do not leave out the secondary sources outside the footprint of the primary 
+	catalogue (dilated by --radius) before matching. The filter does not change the output.""")
+
+parser.add_argument('--footprint-out', type=str, default=None,
+	help='write the footprint of the primary catalogue, dilated by --radius, as a HEALPix MOC (FITS file)')
+
+parser.add_argument('--tile-nside', type=int, default=None,
+	help="""split the sky into HEALPix tiles (with this nside, a power of 2), 
+	which are matched one after the other. This bounds the memory needed
+	to that of the largest tile. The tiles have to be larger than --radius.
+	The output is then ordered by tile.""")
+
+parser.add_argument('--shards', type=int, default=None,
+	help="""with --tile-nside and --manifest: do not match, but split the tiles into
+	this many shards and write a shard manifest (including the magnitude histograms).
+	Each shard is then computed with nway.py --manifest <file> --shard <number>
+	and the partial outputs are combined with nway-merge-shards.py <file>.""")
+
+parser.add_argument('--manifest', type=str, default=None,
+	help='shard manifest file (JSON) to write (with --shards) or to read (with --shard)')
+
+parser.add_argument('--shard', type=int, default=None,
+	help="""compute the shard with this number of the shard manifest. All other
+	arguments are taken from the manifest.""")
+
+parser.add_argument('--stream', action='store_true',
+	help="""match the primary sources as they arrive. The first catalogue is read as 
+	newline-delimited JSON records (objects with RA, DEC and the position error column), 
+	from stdin (-) until it is closed, or from a file which is followed as it grows 
+	(until interrupted). The other catalogues are loaded and indexed once. Each batch of 
+	sources is matched and appended to --out right away (--out-format ndjson or parquet),
+	with the row numbers <table>_index of the secondary sources as with --out-narrow,
+	and the fields of the records. Requires --primary-density. The magnitude histograms 
+	have to be given (no auto), and only circular position errors are supported.""")
+
+parser.add_argument('--primary-density', metavar='DENSITY', type=float, default=None,
+	help='number of primary sources per square degree, for --stream (the sky area of a stream is not known)')
+
+parser.add_argument('--batch-size', type=int, default=100,
+	help='with --stream, the largest number of primary sources matched at a time')
+
+parser.add_argument('--batch-wait', metavar='SECONDS', type=float, default=1.0,
+	help='with --stream, match the sources received so far after at most this many seconds')
+
 parser.add_argument('catalogues', type=str, nargs='+',
-	help="""input catalogue fits files and position errors.
+	help="""input catalogue files (FITS, Parquet, HDF5 or CSV) and position errors.
 
 	Example: cdfs4Ms_srclist_v3.fits :Pos_error CANDELS_irac1.fits 0.5 gs_short.fits 0.1
 	""")
 
+parser.add_argument('--in-format', default=None, choices=sorted(tableio.readers.keys()),
+	help="""format of the input catalogues. By default guessed from the file name extension
+	(.parquet, .hdf5/.h5, .csv; otherwise FITS).""")
+
+parser.add_argument('--table-name', metavar=('FILENAME', 'NAME'), type=str, nargs=2, action='append', default=[],
+	help="""table name of an input catalogue, if the file does not give one (EXTNAME).
+
+	Example: --table-name gs_short.csv OPT""")
+
+parser.add_argument('--sky-area', metavar=('FILENAME', 'AREA'), type=str, nargs=2, action='append', default=[],
+	help="""sky area of an input catalogue in square degrees, if the file does not give one (SKYAREA).
+
+	Example: --sky-area gs_short.csv 0.08""")
+
 parser.add_argument('--prefilter-pair', metavar='CATNAME1 CATNAME2 radius', type=str, nargs=3, action='append', default=[],
 	help="""name of two <table>s where combinations more distant than radius (in arcsec)
 	should not considered. This reduces the memory needs when several large catalogs
@@ -154,11 +324,29 @@ parser.add_argument('--prefilter-pair', metavar='CATNAME1 CATNAME2 radius', type
 
 
 # parsing arguments
-args = parser.parse_args()
+# shard workers take all other arguments from the manifest
+shard_parser = argparse.ArgumentParser(add_help=False)
+shard_parser.add_argument('--manifest', type=str, default=None)
+shard_parser.add_argument('--shard', type=int, default=None)
+shard_args, _ = shard_parser.parse_known_args()
+manifest = None
+if shard_args.shard is not None:
+	assert shard_args.manifest is not None, '--shard requires --manifest'
+	manifest_file = os.path.abspath(shard_args.manifest)
+	manifest = sharding.read_manifest(manifest_file)
+	assert 0 <= shard_args.shard < len(manifest['shards']), 'shard number should be between 0 and %d' % (len(manifest['shards']) - 1)
+	print('shard %d of %d from manifest "%s"' % (shard_args.shard, len(manifest['shards']), manifest_file))
+	# file names are relative to where the manifest was created
+	os.chdir(manifest['directory'])
+	sharding.check_inputs(manifest)
+	args = parser.parse_args(manifest['arguments'] + ['--manifest', manifest_file, '--shard', str(shard_args.shard)])
+else:
+	args = parser.parse_args()
+	if args.shards is not None:
+		assert args.manifest is not None and args.tile_nside is not None, '--shards requires --manifest and --tile-nside'
 
 print('NWAY arguments:')
 
-diff_secondary = args.acceptable_prob
 outfile = args.out
 
 filenames = args.catalogues[::2]
@@ -166,24 +354,132 @@ print('    catalogues: ', ', '.join(filenames))
 pos_errors = args.catalogues[1::2]
 print('    position errors/columns: ', ', '.join(pos_errors))
 
-fits_tables = []
+def parse_prior_completeness(spec):
+	"""
+	Completeness of each catalogue, from --prior-completeness (one value, or one per secondary catalogue)
+	"""
+	if ':' in spec:
+		prior_completeness = numpy.array([1.0] + [float(pc) for pc in spec.split(':')])
+		if len(prior_completeness) != len(filenames):
+			raise Exception('Prior completeness needs one value per catalog, like "%s". Received "%s".' % (':'.join(["0.9"] * (len(filenames) - 1)), spec))
+	else:
+		prior_completeness = numpy.array([1.0] + [float(spec)**(1./(len(filenames)-1)) for i in range(1, len(filenames))])
+	return prior_completeness
+
+assert args.stream or args.out_format != 'ndjson', '--out-format ndjson requires --stream'
+if args.stream:
+	# the primary sources are matched batch by batch, as they arrive,
+	# against the other catalogues, which are loaded and indexed once
+	assert manifest is None and args.shards is None and args.tile_nside is None and args.update is None and not args.sweep and not args.plan, \
+		'--stream can not be combined with --tile-nside, --shards, --update, --sweep or --plan'
+	assert args.adaptive_radius is None and args.max_candidates is None and not args.mag_grid and not args.prefilter_pair and not args.out_columns, \
+		'--stream can not be combined with --adaptive-radius, --max-candidates, --mag-grid, --prefilter-pair or --out-columns'
+	assert args.primary_density is not None, '--stream requires --primary-density'
+	assert args.out_format in ('ndjson', 'parquet'), '--stream requires --out-format ndjson or parquet'
+	assert len(filenames) > 1, '--stream requires catalogues to match the primary sources against'
+	primary_name = dict(args.table_name).get(filenames[0], 'PRIMARY')
+	assert pos_errors[0][0] != ':' or ':' not in pos_errors[0][1:], 'only circular position errors (one field) are supported with --stream: "%s"' % pos_errors[0]
+	for mag, magfile in args.mag:
+		assert mag.split(':', 1)[0] != primary_name, 'magnitude biasing of the primary sources ("%s") is not supported with --stream' % mag
+		assert magfile != 'auto', 'the magnitude histogram of "%s" has to be given with --stream (e.g. <table>_<column>_fit.txt of an earlier run)' % mag
+	prior_completeness = parse_prior_completeness(args.prior_completeness)
+
+	print('loading and indexing catalogues ...')
+	catalogues = []
+	for filename, pos_error in zip(filenames[1:], pos_errors[1:]):
+		catalogues.append(nwaylib.open_catalogue(filename, pos_error, args.radius, mags=args.mag,
+			name=dict(args.table_name).get(filename), area=dict(args.sky_area).get(filename), format=args.in_format))
+		print('    "%s" (%d sources) from %s' % (catalogues[-1].name, len(catalogues[-1]), filename))
+	table_names = [primary_name] + [c.name for c in catalogues]
+	# output columns are named as in the other output files
+	renames = OrderedDict([(n, '%s_index' % n) for n in table_names])
+	for i, a in enumerate(table_names):
+		for b in table_names[i+1:]:
+			renames['Separation_%s_%s' % (a, b)] = 'Separation_%s_%s' % (b, a)
+	renames['Separation_max'] = 'Separation_max'
+	renames['ncat'] = 'ncat'
+	renames['dist_bayesfactor_uncorrected'] = 'dist_bayesfactor'
+	if args.consider_unrelated_associations and len(table_names) > 2:
+		renames['dist_bayesfactor'] = 'dist_bayesfactor_corrected'
+	renames['dist_post'] = 'dist_post'
+	for c in catalogues:
+		for col in c.source_biases.keys():
+			renames['bias_%s' % col] = 'bias_%s' % col
+	renames.update([('p_single', 'p_single'), ('prob_has_match', 'p_any'), ('prob_this_match', 'p_i'), ('match_flag', 'match_flag')])
+
+	if args.out_format == 'parquet':
+		writer = tableio.ParquetTableWriter(outfile, metadata=dict(METHOD='NWAY multi-way matching', INPUT=', '.join(filenames),
+			TABLES=', '.join(table_names), BIASING=', '.join([col for c in catalogues for col in c.source_biases.keys()]),
+			NWAYCMD=' '.join(sys.argv), COL_PRIM='%s_index' % primary_name, COLS_IDX=' '.join(['%s_index' % n for n in table_names])))
+	else:
+		writer = tableio.NDJSONTableWriter(outfile)
+	print('matching the primary sources of %s in batches of up to %d, writing to "%s" ...' % (
+		'stdin' if filenames[0] == '-' else '"%s" as it grows' % filenames[0], args.batch_size, outfile))
+	sys.stdout.flush()
+	fd = sys.stdin.fileno() if filenames[0] == '-' else os.open(filenames[0], os.O_RDONLY)
+	fields = None
+	nsources = 0
+	try:
+		for lines in streaming.read_batches(fd, args.batch_size, args.batch_wait, follow=filenames[0] != '-'):
+			records = streaming.parse_records(lines)
+			if fields is None and records:
+				fields = streaming.record_fields(records[0])
+			if not records:
+				continue
+			data = streaming.records_table(records, fields)
+			ra = data[match.get_tablekeys(data, 'RA', tablename=primary_name)]
+			dec = data[match.get_tablekeys(data, 'DEC', tablename=primary_name)]
+			error = data[pos_errors[0][1:]] if pos_errors[0][0] == ':' else float(pos_errors[0])
+			valid = numpy.logical_and(numpy.isfinite(ra), numpy.isfinite(dec))
+			if not valid.all():
+				sys.stderr.write('WARNING: skipping %d records without a position\n' % (~valid).sum())
+				data, ra, dec, error = data[valid], ra[valid], dec[valid], numpy.broadcast_to(error, valid.shape)[valid]
+				if not valid.any():
+					continue
+			result = nwaylib.match_sources(ra, dec, error, catalogues, prior_completeness, args.primary_density,
+				name=primary_name, prob_ratio_secondary=args.acceptable_prob, min_prob=args.min_prob,
+				correct_unrelated_associations=args.consider_unrelated_associations)
+			rows = result[primary_name]
+			# sources are numbered through the stream
+			result[primary_name] = rows + nsources
+			chunk = [(renames[k], result[k]) for k in table_names] + \
+				[('%s_%s' % (primary_name, k), data[k][rows]) for k, kind in fields] + \
+				[(renames[k], result[k]) for k in renames if k not in table_names and k in result]
+			writer.write(chunk)
+			nsources += len(ra)
+			print('    matched %d sources (%d so far): %d associations' % (len(ra), nsources, len(rows)))
+			sys.stdout.flush()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		writer.close()
+	print('    wrote "%s" (%d rows) for %d sources' % (outfile, writer.nrows, nsources))
+	sys.exit(0)
+
 table_names = []
 tables = []
 source_densities = []
 source_densities_plus = []
 fits_formats = []
-for fitsname in filenames:
-	fits_table = pyfits.open(fitsname)[1]
-	fits_tables.append(fits_table)
-	table_name = fits_table.name
+sky_areas = []
+table_name_overrides = dict(args.table_name)
+sky_area_overrides = dict(args.sky_area)
+# open the catalogues concurrently. Columns are only read when accessed or loaded
+io_pool = ThreadPool(args.io_threads)
+input_tables = io_pool.map(lambda filename: tableio.open_table(filename, name=table_name_overrides.get(filename),
+	area=sky_area_overrides.get(filename), format=args.in_format), filenames)
+for filename, input_table in zip(filenames, input_tables):
+	table_name = input_table.name
+	assert table_name, 'file "%s" does not give a table name (EXTNAME). Use --table-name %s <name>' % (filename, filename)
 	table_names.append(table_name)
-	table = fits_table.data
-	fits_formats.append([c.format for c in fits_table.columns])
+	table = input_table.data
+	fits_formats.append(input_table.formats)
 	tables.append(table)
 
 	n = len(table)
-	assert 'SKYAREA' in fits_table.header, 'file "%s", table "%s" does not have a field "SKYAREA", which should contain the area of the catalogue in square degrees' % (fitsname, table_name)
-	area = fits_table.header['SKYAREA'] * 1.0 # in square degrees
+	assert input_table.area is not None, 'file "%s", table "%s" does not have a field "SKYAREA", which should contain the area of the catalogue in square degrees. Use --sky-area %s <area>' % (filename, table_name, filename)
+	area = input_table.area # in square degrees
+	sky_areas.append(area)
 	area_total = (4 * pi * (180 / pi)**2)
 	density = n / area * area_total
 	print('      from catalogue "%s" (%d), density gives %.2e on entire sky' % (table_name, n, density))
@@ -196,17 +492,37 @@ for fitsname in filenames:
 source_densities_plus[0] = source_densities[0]
 source_densities_plus = numpy.array(source_densities_plus)
 
-if ':' in args.prior_completeness:
-	prior_completeness = numpy.array([1.0] + [float(pc) for pc in args.prior_completeness.split(':')])
-	if len(prior_completeness) != len(filenames):
-		raise Exception('Prior completeness needs one value per catalog, like "%s". Received "%s".' % (':'.join(["0.9"] * (len(filenames) - 1)), args.prior_completeness))
-else:
-	prior_completeness = numpy.array([1.0] + [float(args.prior_completeness)**(1./(len(filenames)-1)) for i in range(1, len(filenames))])
-
+prior_completeness = parse_prior_completeness(args.prior_completeness)
+
+# parameter values to compute the probabilities for, after matching once
+sweep_parameters = OrderedDict()
+for spec in args.sweep:
+	name, _, values = spec.partition('=')
+	assert name in ('prior-completeness', 'acceptable-prob', 'min-prob') and values, '--sweep "%s" should be prior-completeness=..., acceptable-prob=... or min-prob=..., with comma-separated values' % spec
+	sweep_parameters[name] = values.split(',')
+if sweep_parameters:
+	assert manifest is None and args.shards is None, '--sweep can not be combined with --shards'
+	print('    parameter sweep: %s' % ', '.join(['%s=%s' % (name, ','.join(values)) for name, values in sweep_parameters.items()]))
+
+if args.update is not None:
+	assert manifest is None and args.shards is None and args.tile_nside is None and not sweep_parameters, '--update can not be combined with --tile-nside, --shards or --sweep'
+	assert (tableio.guess_format(args.update) == 'parquet') == (args.out_format == 'parquet'), 'the previous output "%s" should have --out-format %s' % (args.update, args.out_format)
+	print('    updating "%s"' % args.update)
+for filename, previous_filename in args.previous_catalogue:
+	assert args.update is not None, '--previous-catalogue requires --update'
+	assert filename in filenames, '--previous-catalogue "%s" is not one of the catalogues: %s' % (filename, ', '.join(filenames))
+	print('      previous version of "%s": "%s"' % (filename, previous_filename))
+
+def sweep_filename(filename, settings):
+	"""
+	Output file name of a parameter set, e.g. out-prior-completeness0.9.fits for out.fits
+	"""
+	base, ext = os.path.splitext(filename)
+	return base + ''.join(['-%s%s' % item for item in settings.items()]) + ext
 
-min_prob = args.min_prob
 
 match_radius = args.radius / 60. / 60 # in degrees
+memory_limit = parse_size(args.memory_limit) if args.memory_limit is not None else None
 
 pairwise_errs = [(table_names.index(tablea), table_names.index(tableb), float(err))
 	for tablea, tableb, err in args.prefilter_pair]
@@ -227,6 +543,15 @@ assert 0 < magauto_post_single_minvalue <= 1, 'probability should be between 0 a
 
 magnitude_columns = args.mag
 print('    magnitude columns: ', ', '.join([c for c, _ in magnitude_columns]))
+grid_columns = args.mag_grid
+if args.update is not None:
+	# the joint priors of the previous run are kept fixed
+	grid_columns = [(spec, spec.replace(':', '_').replace(',', '_') + '_grid.txt' if gridfile == 'auto' else gridfile)
+		for spec, gridfile in grid_columns]
+	for spec, gridfile in grid_columns:
+		assert os.path.exists(gridfile), 'joint prior "%s" of the previous run not found: "%s"' % (spec, gridfile)
+if grid_columns:
+	print('    joint prior columns: ', ', '.join([c for c, _ in grid_columns]))
 
 for mag, magfile in magnitude_columns:
 	table_name, col_name = mag.split(':', 1)
@@ -235,6 +560,17 @@ for mag, magfile in magnitude_columns:
 	col_names = tables[ti].dtype.names
 	assert col_name in col_names, 'column name specified for magnitude ("%s") unknown. Known columns in table "%s": %s' % (mag, table_name, ', '.join(col_names))
 
+for spec, gridfile in grid_columns:
+	assert ':' in spec, 'joint prior columns ("%s") should be <table>:<column1>,<column2>' % spec
+	table_name, col_names = spec.split(':', 1)
+	assert table_name in table_names, 'table name specified for joint prior ("%s") unknown. Known tables: %s' % (table_name, ', '.join(table_names))
+	for col_name in col_names.split(','):
+		assert col_name in tables[table_names.index(table_name)].dtype.names, 'column name specified for joint prior ("%s") unknown: %s' % (spec, col_name)
+
+# columns of each catalogue used for priors
+prior_columns = [mag.split(':', 1) for mag, _ in magnitude_columns] + \
+	[(table_name, col_name) for table_name, col_names in [spec.split(':', 1) for spec, _ in grid_columns] for col_name in col_names.split(',')]
+
 simple_errors = True
 for ti, (table_name, pos_error) in enumerate(zip(table_names, pos_errors)):
 	colnames = tables[ti].dtype.names
@@ -258,386 +594,1011 @@ for ti, (table_name, pos_error) in enumerate(zip(table_names, pos_errors)):
 		assert k in colnames, 'ERROR: Position error column "%s" not in table "%s". Have these columns: %s' % (k, table_name, ', '.join(colnames))
 
 
-# first match input catalogues, compute possible combinations in match_radius
-results, columns, match_header = match.match_multiple(tables, table_names, match_radius, fits_formats, circular=simple_errors,
-	logger=logger.NormalLogger(), pairwise_errs=pairwise_errs)
-table = match.fits_from_columns(pyfits.ColDefs(columns)).data
-
-assert len(table) > 0, 'No matches.'
-
-# first pass: find secure matches and secure non-matches
-print('Computing distance-based probabilities ...')
+# only the columns needed for the computation, and those requested, are merged in
+assert not (args.out_narrow and args.out_columns), '--out-narrow and --out-columns can not be combined'
+if args.out_columns is None and not args.out_narrow:
+	merge_columns = None
+else:
+	out_columns = [spec.split(':', 1) for spec in args.out_columns or []]
+	for spec, table_col in zip(args.out_columns or [], out_columns):
+		assert len(table_col) == 2 and table_col[0] in table_names, 'output column "%s" should be <table>:<column>. Known tables: %s' % (spec, ', '.join(table_names))
+	merge_columns = []
+	for ti, (table_name, pos_error) in enumerate(zip(table_names, pos_errors)):
+		colnames = tables[ti].dtype.names
+		cols = [k for k in colnames if k.upper() == 'ID']
+		if ti == 0:
+			cols.append(match.get_tablekeys(tables[0], 'ID', tablename=table_names[0]))
+		if pos_error[0] == ':':
+			cols += pos_error[1:].split(':')
+		cols += [col_name for prior_table_name, col_name in prior_columns if prior_table_name == table_name]
+		for out_table_name, col_name in out_columns:
+			if out_table_name != table_name:
+				continue
+			if col_name == '*':
+				cols += colnames
+			else:
+				assert col_name in colnames, 'output column "%s" unknown. Known columns in table "%s": %s' % (col_name, table_name, ', '.join(colnames))
+				cols.append(col_name)
+		merge_columns.append(cols)
+
+# read the columns needed for the computation (positions, errors, magnitudes)
+# concurrently, in native byte order. 
+# Formats without random access (CSV) read all needed columns at once.
+load_tasks = []
+# all columns read from each table, for --stage-cache
+used_columns = []
+for ti, (table, table_name, pos_error) in enumerate(zip(tables, table_names, pos_errors)):
+	cols = [match.get_tablekeys(table, 'RA'), match.get_tablekeys(table, 'DEC')]
+	if pos_error[0] == ':':
+		cols += pos_error[1:].split(':')
+	cols += [col_name for prior_table_name, col_name in prior_columns if prior_table_name == table_name]
+	used_columns.append(list(OrderedDict.fromkeys(cols + (list(table.dtype.names) if merge_columns is None else merge_columns[ti]))))
+	if isinstance(table, tableio.ColumnTable):
+		load_tasks.append((table, used_columns[-1]))
+	else:
+		load_tasks += [(table, [col]) for col in cols]
+print('loading %d columns ...' % sum([len(cols) for table, cols in load_tasks]))
+io_pool.map(lambda task: task[0].load(task[1]), load_tasks)
 
-print('  finding position error columns ...')
-# get the separation and error columns for the bayesian weighting
+primary_id_key = match.get_tablekeys(tables[0], 'ID', tablename=table_names[0])
+primary_id_key = '%s_%s' % (table_names[0], primary_id_key)
 
-errors, simple_errors = make_errors_table_matrix(table_names, pos_errors)
-if simple_errors:
-	errors = [e_ra for e_ra, e_dec, e_rho in errors]
+pair_radius = None
+candidate_cap = None
+if args.adaptive_radius is not None or args.max_candidates is not None:
+	# position error of each source (the larger axis, for asymmetric errors)
+	source_errors = []
+	for table, pos_error in zip(tables, pos_errors):
+		if pos_error[0] != ':':
+			source_errors.append(float(pos_error))
+		else:
+			keys = pos_error[1:].split(':')
+			errors = numpy.asarray(table[keys[0]], dtype=float)
+			if len(keys) == 2:
+				errors = numpy.maximum(errors, table[keys[1]])
+			source_errors.append(errors)
+if args.max_candidates is not None:
+	assert args.max_candidates >= 1, '--max-candidates has to be at least 1'
+	candidate_cap = (args.max_candidates, source_errors)
+	print('    keeping the %d nearest candidates of each secondary catalogue per primary source' % args.max_candidates)
+if args.adaptive_radius is not None:
+	k_radius, floor_radius = args.adaptive_radius
+	pair_radius = (k_radius, floor_radius, source_errors)
+	print('    adaptive search radius: %g * sqrt(error_i^2 + error_j^2) + %g arcsec' % (k_radius, floor_radius))
+	prefiltered = set([(i, j) for i, j, _ in pairwise_errs] + [(j, i) for i, j, _ in pairwise_errs])
+	for i, j, radius_ij in match.adaptive_pair_radii([numpy.max(e) for e in source_errors], k_radius, floor_radius, args.radius):
+		if (i, j) not in prefiltered:
+			print('    pair-wise pre-filtering of %s and %s within %.3f arcsec' % (table_names[i], table_names[j], radius_ij))
+			pairwise_errs.append((i, j, radius_ij))
+
+stage_cache = None
+if args.stage_cache is not None:
+	stage_cache = stagecache.StageCache(args.stage_cache)
+	# the inputs by the contents of the columns read (positions, errors and
+	# the columns copied into the output), as changed rows keep the file size
+	stage_key = histcache.fingerprint(stagecache.format_version,
+		[(table_name, pos_error, [(col, table[col]) for col in cols])
+			for table, table_name, pos_error, cols in zip(tables, table_names, pos_errors, used_columns)],
+		merge_columns, args.radius, pairwise_errs, args.adaptive_radius, args.max_candidates)
+
+if args.plan:
+	print()
+	print('Planning the match (hashing a sample of the primary sources) ...')
+	radectables = [(t[match.get_tablekeys(t, 'RA', tablename=table_name)], t[match.get_tablekeys(t, 'DEC', tablename=table_name)])
+		for t, table_name in zip(tables, table_names)]
+	row_bytes = sum([sum([t.dtype[n].itemsize for n in (t.dtype.names if merge_columns is None else set(cols))])
+		for t, cols in zip(tables, merge_columns or [None] * len(tables))])
+	plan = planning.plan(radectables, sky_areas, match_radius, row_bytes, memory_limit=memory_limit,
+		chunk_size=args.chunk_size, pairwise_errs=pairwise_errs)
+	for line in planning.format_plan(plan):
+		print('    ' + line)
+	if [mag for mag, magfile in magnitude_columns + grid_columns if magfile == 'auto'] and plan['recommended']['tile_nside'] is not None:
+		print('    (in tiled mode, --mag auto matches each tile twice)')
+	sys.exit(0)
 
-print('  finding position columns ...')
 # table is in arcsec, and therefore separations is in arcsec
-def make_separation_table_matrix(kstr, table, table_names):
+def make_separation_table_matrix(kstr, table, table_names, nrows):
 	separations = []
 	for ti, a in enumerate(table_names):
 		row = []
 		for tj, b in enumerate(table_names):
 			if ti < tj:
 				k = kstr % (b, a)
-				assert k in table.dtype.names, 'ERROR: Separation column for "%s" not in merged table. Have columns: %s' % (k, ', '.join(table.dtype.names))
+				assert k in table, 'ERROR: Separation column for "%s" not in merged table. Have columns: %s' % (k, ', '.join(table.keys()))
 				row.append(table[k])
 			else:
-				row.append(numpy.ones(len(table)) * numpy.nan)
+				row.append(numpy.broadcast_to(numpy.nan, nrows))
 		separations.append(row)
 	return separations
 
-separations = make_separation_table_matrix('Separation_%s_%s', table, table_names)
-if not simple_errors:
-	separations_ra = make_separation_table_matrix('Separation_%s_%s_ra', table, table_names)
-	separations_dec = make_separation_table_matrix('Separation_%s_%s_dec', table, table_names)
-
-print('  building primary_id index ...')
-primary_id_key = match.get_tablekeys(tables[0], 'ID', tablename=table_names[0])
-primary_id_key = '%s_%s' % (table_names[0], primary_id_key)
-
-primary_ids = []
-primary_id_start = []
-last_primary_id = None
-primary_id_column = table[primary_id_key]
-for i, pid in enumerate(primary_id_column):
-	if pid != last_primary_id:
-		last_primary_id = pid
-		primary_ids.append(pid)
-		primary_id_start.append(i)
-
-primary_id_end = primary_id_start[1:] + [len(primary_id_column)]
-
-# compute n-way position evidence
-print('  computing probabilities ...')
-
-log_bf = numpy.zeros(len(table)) * numpy.nan
-prior = numpy.zeros(len(table)) * numpy.nan
-# handle all cases (also those with missing counterparts in some catalogues)
-for case in range(2**(len(table_names)-1)):
-	table_mask = numpy.array([True] + [(case // 2**(ti)) % 2 == 0 for ti in range(len(tables)-1)])
-	ncat = table_mask.sum()
-	# select those cases
-	mask = True
-	for i in range(1, len(tables)):
-		if table_mask[i]: # require not nan
-			mask = numpy.logical_and(mask, ~numpy.isnan(separations[0][i]))
-		else:
-			mask = numpy.logical_and(mask, numpy.isnan(separations[0][i]))
-	# select errors
-	if simple_errors:
-		errors_selected = [e[mask] for e, m in zip(errors, table_mask) if m]
-		separations_selected = [[cell[mask] for cell, m in zip(row, table_mask) if m] 
-			for row, m in zip(separations, table_mask) if m]
-		log_bf[mask] = bayesdist.log_bf(separations_selected, errors_selected)
+def compute_prior(table, prior_completeness, scratch):
+	"""
+	Prior of each association, from the source densities and the 
+	completeness of the catalogues it contains.
+	"""
+	nrows = len(table['ncat'])
+	prior = scratch.full(nrows, numpy.nan)
+	for s in scratch.chunks(nrows):
+		# the separation to the primary source is not defined for absent sources
+		present = [None] + [~numpy.isnan(table['Separation_%s_%s' % (table_name, table_names[0])][s]) for table_name in table_names[1:]]
+		chunk_prior = prior[s]
+		# handle all cases (also those with missing counterparts in some catalogues)
+		for case in range(2**(len(table_names)-1)):
+			table_mask = numpy.array([True] + [(case // 2**(ti)) % 2 == 0 for ti in range(len(tables)-1)])
+			# select those cases
+			mask = True
+			for i in range(1, len(tables)):
+				mask = numpy.logical_and(mask, present[i] == table_mask[i])
+			chunk_prior[mask] = source_densities[0] * numpy.product(prior_completeness[table_mask]) / numpy.product(source_densities_plus[table_mask])
+			assert numpy.isfinite(chunk_prior[mask]).all(), (source_densities, prior_completeness[table_mask], numpy.product(source_densities_plus[table_mask]))
+	assert numpy.isfinite(prior).all(), prior
+	return prior
+
+def compute_distance_probabilities(rows=None, verbose=True):
+	"""
+	Match the input catalogues (all rows, or for each catalogue the
+	given rows, e.g., of one sky tile) and compute the distance-based
+	probabilities.
+
+	Returns results, columns, match_header, table, prior, log_bf, post, 
+	and the scratch space holding the intermediate arrays.
+
+	With --stage-cache, the candidates and the distance Bayes factors
+	are taken from (or stored in) the stage cache.
+	"""
+	scratch = ScratchSpace(memory_limit, directory=args.scratch_dir, chunk_size=args.chunk_size)
+	cached_candidates = cached_distances = None
+	if stage_cache is not None:
+		candidates_key = histcache.fingerprint(stage_key, rows)
+		distances_key = histcache.fingerprint(candidates_key, source_densities, args.consider_unrelated_associations)
+		cached_candidates = stage_cache.load(candidates_key)
+		cached_distances = stage_cache.load(distances_key)
+	if cached_candidates is not None:
+		if verbose:
+			print('Using cached candidates "%s"' % stage_cache.path(candidates_key))
+		arrays, info = cached_candidates
+		results = arrays.pop('results')
+		columns = [pyfits.Column(name=name, format=format, array=array) for (name, array), format in zip(arrays.items(), info['formats'])]
+		match_header = info['header']
 	else:
-		errors_selected = [(era[mask], edec[mask], ephi[mask])
-			for (era, edec, ephi), m in zip(errors, table_mask) if m]
-		separations_selected_ra = [[cell[mask] for cell, m in zip(row, table_mask) if m] 
-			for row, m in zip(separations_ra, table_mask) if m]
-		separations_selected_dec = [[cell[mask] for cell, m in zip(row, table_mask) if m] 
-			for row, m in zip(separations_dec, table_mask) if m]
-		log_bf[mask] = bayesdist.log_bf_elliptical(separations_selected_ra, 
-			separations_selected_dec, errors_selected)
-	
-	prior[mask] = source_densities[0] * numpy.product(prior_completeness[table_mask]) / numpy.product(source_densities_plus[table_mask])
-	assert numpy.isfinite(prior[mask]).all(), (source_densities, prior_completeness[table_mask], numpy.product(source_densities_plus[table_mask]))
-
-assert numpy.isfinite(prior).all(), (prior, log_bf)
-assert numpy.isfinite(log_bf).all(), (prior, log_bf)
-columns.append(pyfits.Column(name='dist_bayesfactor', format='E', array=log_bf))
-
-ncat = table['ncat']
-ncats = len(tables)
-
-if args.consider_unrelated_associations:
-	candidates = numpy.where(ncat <= ncats - 2)[0]
-	if len(candidates) > 0:
-		print('    correcting for unrelated associations ...')
-		# correct for unrelated associations
-		# identify those in need of correction
-		# two unconsidered catalogues are needed for an unrelated association
-		for i in tqdm.tqdm(candidates):
-			# list which ones we are missing
-			missing_cats = [k for k, sep in enumerate(separations[0]) if numpy.isnan(sep[i])]
-			pid = table[primary_id_key][i]
-			pid_index = primary_ids.index(pid)
-			best_logpost = 0
-			# go through more complex associations
-			for j in range(primary_id_start[pid_index], primary_id_end[pid_index]):
-				if not (ncat[j] > 2): continue
-				# check if this association has sufficient overlap with the one we are looking for
-				# it must contain at least two of the catalogues we are missing
-				augmented_cats = []
-				for k in missing_cats:
-					if not numpy.isnan(separations[0][k][j]):
-						augmented_cats.append(k)
-				n_augmented_cats = len(augmented_cats)
-				if n_augmented_cats >= 2:
-					# ok, this is helpful.
-					# identify the separations and errors
-					# identify the prior
-					prior_j = source_densities[augmented_cats[0]] / numpy.product(source_densities_plus[augmented_cats])
-					# compute a log_bf
-					errors_selected = [[errors[k][j]] for k in augmented_cats]
-					if simple_errors:
-						separations_selected = [[[separations[k][k2][j]] 
-							for k2 in augmented_cats] for k in augmented_cats]
-						log_bf_j = bayesdist.log_bf(numpy.array(separations_selected),
-							numpy.array(errors_selected))
+		# first match input catalogues, compute possible combinations in match_radius
+		results, columns, match_header = match.match_multiple(tables, table_names, match_radius, fits_formats, circular=simple_errors,
+			logger=logger.NormalLogger() if verbose else logger.NullOutputLogger(),
+			pairwise_errs=pairwise_errs, columns=merge_columns, rows=rows, scratch=scratch, pair_radius=pair_radius, candidate_cap=candidate_cap)
+		if stage_cache is not None:
+			stage_cache.store(candidates_key, [('results', results)] + [(c.name, c.array) for c in columns],
+				dict(formats=[str(c.format) for c in columns], header=match_header))
+	# merged table: the columns by name
+	table = OrderedDict([(c.name, c.array) for c in columns])
+	nrows = len(results)
+
+	assert nrows > 0, 'No matches.'
+
+	# first pass: find secure matches and secure non-matches
+	if verbose:
+		print('Computing distance-based probabilities ...')
+
+	# compute n-way position evidence
+	if cached_distances is not None:
+		if verbose:
+			print('  using cached distance Bayes factors "%s"' % stage_cache.path(distances_key))
+		arrays, info = cached_distances
+		log_bf = arrays.pop('log_bf')
+	else:
+		# get the separation and error columns for the bayesian weighting
+		if verbose:
+			print('  finding position error columns ...')
+		errors, simple_errors_here = make_errors_table_matrix(table_names, pos_errors, table, nrows, verbose=verbose)
+		if simple_errors_here:
+			errors = [e_ra for e_ra, e_dec, e_rho in errors]
+
+		if verbose:
+			print('  finding position columns ...')
+		separations = make_separation_table_matrix('Separation_%s_%s', table, table_names, nrows)
+		if not simple_errors_here:
+			separations_ra = make_separation_table_matrix('Separation_%s_%s_ra', table, table_names, nrows)
+			separations_dec = make_separation_table_matrix('Separation_%s_%s_dec', table, table_names, nrows)
+
+		if verbose:
+			print('  computing probabilities ...')
+		log_bf = scratch.full(nrows, numpy.nan)
+		for s in scratch.chunks(nrows):
+			chunk_log_bf = log_bf[s]
+			chunk_separations = [[cell[s] for cell in row] for row in separations]
+			# handle all cases (also those with missing counterparts in some catalogues)
+			for case in range(2**(len(table_names)-1)):
+				table_mask = numpy.array([True] + [(case // 2**(ti)) % 2 == 0 for ti in range(len(tables)-1)])
+				# select those cases
+				mask = True
+				for i in range(1, len(tables)):
+					if table_mask[i]: # require not nan
+						mask = numpy.logical_and(mask, ~numpy.isnan(chunk_separations[0][i]))
 					else:
-						separations_selected_ra = [[[separations_ra[k][k2][j]] 
-							for k2 in augmented_cats] for k in augmented_cats]
-						separations_selected_dec = [[[separations_dec[k][k2][j]] 
-							for k2 in augmented_cats] for k in augmented_cats]
-						log_bf_j = bayesdist.log_bf_elliptical(numpy.array(separations_selected_ra),
-							 numpy.array(separations_selected_dec), 
-							 numpy.array(errors_selected))
-					logpost_j = bayesdist.unnormalised_log_posterior(prior_j, log_bf_j, n_augmented_cats)
-					if logpost_j > best_logpost:
-						#print('post:', logpost_j, log_bf_j, prior_j)
-						best_logpost = logpost_j
-	
-			# ok, we have our correction factor, best_logpost
-			# lets multiply it onto log_bf
-			if best_logpost > 0:
-				log_bf[i] += best_logpost
-		columns.append(pyfits.Column(name='dist_bayesfactor_corrected', format='E', array=log_bf))
+						mask = numpy.logical_and(mask, numpy.isnan(chunk_separations[0][i]))
+				# select errors
+				if simple_errors_here:
+					errors_selected = [e[s][mask] for e, m in zip(errors, table_mask) if m]
+					separations_selected = [[cell[mask] for cell, m in zip(row, table_mask) if m]
+						for row, m in zip(chunk_separations, table_mask) if m]
+					chunk_log_bf[mask] = bayesdist.log_bf(separations_selected, errors_selected)
+				else:
+					errors_selected = [(era[s][mask], edec[s][mask], ephi[s][mask])
+						for (era, edec, ephi), m in zip(errors, table_mask) if m]
+					separations_selected_ra = [[cell[s][mask] for cell, m in zip(row, table_mask) if m]
+						for row, m in zip(separations_ra, table_mask) if m]
+					separations_selected_dec = [[cell[s][mask] for cell, m in zip(row, table_mask) if m]
+						for row, m in zip(separations_dec, table_mask) if m]
+					chunk_log_bf[mask] = bayesdist.log_bf_elliptical(separations_selected_ra,
+						separations_selected_dec, errors_selected)
+
+	prior = compute_prior(table, prior_completeness, scratch)
+	assert numpy.isfinite(log_bf).all(), log_bf
+	if cached_distances is not None:
+		columns += [pyfits.Column(name=name, format='E', array=array) for name, array in arrays.items()]
 	else:
-		print('      correcting for unrelated associations ... not necessary')
-
-# add the additional columns
-post = bayesdist.posterior(prior, log_bf)
-columns.append(pyfits.Column(name='dist_post', format='E', array=post))
-
-# find magnitude biasing functions
-if magnitude_columns:
-	print()
-	print('Incorporating magnitude biases ...')
-biases = {}
-for mag, magfile in magnitude_columns:
-	print('    magnitude bias "%s" ...' % mag)
+		columns.append(pyfits.Column(name='dist_bayesfactor', format='E', array=scratch.astype(log_bf, 'f4')))
+
+	ncat = table['ncat']
+	ncats = len(tables)
+
+	if cached_distances is None and args.consider_unrelated_associations:
+		candidates = numpy.where(ncat <= ncats - 2)[0]
+		if len(candidates) > 0:
+			if verbose:
+				print('    correcting for unrelated associations ...')
+				print('    building primary_id index ...')
+			primary_ids = []
+			primary_id_start = []
+			last_primary_id = None
+			primary_id_column = table[primary_id_key]
+			for i, pid in enumerate(primary_id_column):
+				if pid != last_primary_id:
+					last_primary_id = pid
+					primary_ids.append(pid)
+					primary_id_start.append(i)
+
+			primary_id_end = primary_id_start[1:] + [len(primary_id_column)]
+
+			# correct for unrelated associations
+			# identify those in need of correction
+			# two unconsidered catalogues are needed for an unrelated association
+			for i in tqdm.tqdm(candidates, disable=not verbose):
+				# list which ones we are missing
+				missing_cats = [k for k, sep in enumerate(separations[0]) if numpy.isnan(sep[i])]
+				pid = table[primary_id_key][i]
+				pid_index = primary_ids.index(pid)
+				best_logpost = 0
+				# go through more complex associations
+				for j in range(primary_id_start[pid_index], primary_id_end[pid_index]):
+					if not (ncat[j] > 2): continue
+					# check if this association has sufficient overlap with the one we are looking for
+					# it must contain at least two of the catalogues we are missing
+					augmented_cats = []
+					for k in missing_cats:
+						if not numpy.isnan(separations[0][k][j]):
+							augmented_cats.append(k)
+					n_augmented_cats = len(augmented_cats)
+					if n_augmented_cats >= 2:
+						# ok, this is helpful.
+						# identify the separations and errors
+						# identify the prior
+						prior_j = source_densities[augmented_cats[0]] / numpy.product(source_densities_plus[augmented_cats])
+						# compute a log_bf
+						errors_selected = [[errors[k][j]] for k in augmented_cats]
+						if simple_errors_here:
+							separations_selected = [[[separations[k][k2][j]]
+								for k2 in augmented_cats] for k in augmented_cats]
+							log_bf_j = bayesdist.log_bf(numpy.array(separations_selected),
+								numpy.array(errors_selected))
+						else:
+							separations_selected_ra = [[[separations_ra[k][k2][j]]
+								for k2 in augmented_cats] for k in augmented_cats]
+							separations_selected_dec = [[[separations_dec[k][k2][j]]
+								for k2 in augmented_cats] for k in augmented_cats]
+							log_bf_j = bayesdist.log_bf_elliptical(numpy.array(separations_selected_ra),
+								 numpy.array(separations_selected_dec),
+								 numpy.array(errors_selected))
+						logpost_j = bayesdist.unnormalised_log_posterior(prior_j, log_bf_j, n_augmented_cats)
+						if logpost_j > best_logpost:
+							#print('post:', logpost_j, log_bf_j, prior_j)
+							best_logpost = logpost_j
+
+				# ok, we have our correction factor, best_logpost
+				# lets multiply it onto log_bf
+				if best_logpost > 0:
+					log_bf[i] += best_logpost
+			columns.append(pyfits.Column(name='dist_bayesfactor_corrected', format='E', array=scratch.astype(log_bf, 'f4')))
+		elif verbose:
+			print('      correcting for unrelated associations ... not necessary')
+	if cached_distances is None and stage_cache is not None:
+		stage_cache.store(distances_key, [('log_bf', log_bf)] + 
+			[(c.name, c.array) for c in columns if c.name in ('dist_bayesfactor', 'dist_bayesfactor_corrected')])
+
+	# add the additional columns
+	post = scratch.apply(bayesdist.posterior, prior, log_bf)
+	columns.append(pyfits.Column(name='dist_post', format='E', array=scratch.astype(post, 'f4')))
+	return results, columns, match_header, table, prior, log_bf, post, scratch
+
+def magnitude_selection(mag, table, results, post):
+	"""
+	Find the rows of the catalogue of magnitude column mag
+	which are secure matches (with weights), and those which are possible matches.
+	"""
 	table_name, col_name = mag.split(':', 1)
-	assert table_name in table_names, 'table name specified for magnitude ("%s") unknown. Known tables: %s' % (table_name, ', '.join(table_names))
-	ti = table_names.index(table_name)
-	col_names = tables[ti].dtype.names
-	assert col_name in col_names, 'column name specified for magnitude ("%s") unknown. Known columns in table "%s": %s' % (mag, table_name, ', '.join(col_names))
-	ci = col_names.index(col_name)
-	
-	res = results[table_name]
 	res_defined = results[table_name] != -1
-	
-	# get magnitudes of all
-	mag_all = tables[ti][col_name]
-	# mark -99 as undefined
-	mag_all[mag_all == -99] = numpy.nan
-	
-	# get magnitudes of selected
-	mask_all = ~numpy.logical_or(numpy.isnan(mag_all), numpy.isinf(mag_all))
-
+	if mag_include_radius is not None:
+		selection = table['Separation_max'] < mag_include_radius
+		selection_possible = table['Separation_max'] < mag_exclude_radius
+		selection_weights = numpy.ones(len(selection))
+	else:
+		selection = post > magauto_post_single_minvalue
+		selection_weights = post
+		selection_possible = post > 0.01
+
+	# ignore cases where counterpart is missing
+	assert res_defined.shape == selection.shape, (res_defined.shape, selection.shape)
+	selection = numpy.logical_and(selection, res_defined)
+	selection_weights = selection_weights[selection]
+	selection_possible = numpy.logical_and(selection_possible, res_defined)
+
+	#print '   selection', selection.sum(), selection_possible.sum(), (-selection_possible).sum()
+
+	#rows = results[table_name][selection].tolist()
+	rows, unique_indices = numpy.unique(results[table_name][selection], return_index=True)
+	rows_weights = selection_weights[unique_indices]
+	rows_possible = numpy.unique(results[table_name][selection_possible])
+	return rows, rows_weights, rows_possible
+
+def stream_magnitude_histogram(column, rows, rows_weights, rows_possible):
+	"""
+	Magnitude histograms of secure matches (rows, with weights) and 
+	of secure non-matches (all except rows_possible) of the catalogue 
+	column, read chunk by chunk (see magnitudeweights.streaming_histograms).
+
+	Returns bins, hist_sel, hist_all and the numbers of secure matches, 
+	secure non-matches and valid entries.
+	"""
+	counts = OrderedDict()
+	def chunks():
+		counts.clear()
+		for lo in range(0, len(column), args.chunk_size):
+			hi = min(len(column), lo + args.chunk_size)
+			values = numpy.array(column[lo:hi])
+			# mark -99 as undefined
+			values[values == -99] = numpy.nan
+			mask_all = numpy.isfinite(values)
+			mask_others = mask_all.copy()
+			mask_others[rows_possible[numpy.searchsorted(rows_possible, lo):numpy.searchsorted(rows_possible, hi)] - lo] = False
+			a, b = numpy.searchsorted(rows, lo), numpy.searchsorted(rows, hi)
+			mag_sel = values[rows[a:b] - lo]
+			mask_sel = numpy.isfinite(mag_sel)
+			for k, n in ('sel', mask_sel.sum()), ('others', mask_others.sum()), ('valid', mask_all.sum()):
+				counts[k] = counts.get(k, 0) + n
+			yield values[mask_others], mag_sel[mask_sel], rows_weights[a:b][mask_sel]
+	bins, hist_sel, hist_all = magnitudeweights.streaming_histograms(chunks)
+	return bins, hist_sel, hist_all, counts['sel'], counts['others'], counts['valid']
+
+def make_magnitude_histogram(mag, rows, rows_weights, rows_possible):
+	"""
+	Build and store the magnitude histograms of secure matches
+	and of secure non-matches of magnitude column mag.
+	Under --memory-limit, the column is read chunk by chunk.
+	"""
+	table_name, col_name = mag.split(':', 1)
+	ti = table_names.index(table_name)
 	col = "%s_%s" % (table_name, col_name)
-	
-	if magfile == 'auto':
-		if mag_include_radius is not None:
-			if mag_include_radius >= match_radius * 60 * 60:
-				print('WARNING: magnitude radius is very large (>= matching radius). Consider using a smaller value.')
-			selection = table['Separation_max'] < mag_include_radius
-			selection_possible = table['Separation_max'] < mag_exclude_radius
-			selection_weights = numpy.ones(len(selection))
-		else:
-			selection = post > magauto_post_single_minvalue
-			selection_weights = post
-			selection_possible = post > 0.01
-		
-		# ignore cases where counterpart is missing
-		assert res_defined.shape == selection.shape, (res_defined.shape, selection.shape)
-		selection = numpy.logical_and(selection, res_defined)
-		selection_weights = selection_weights[selection]
-		selection_possible = numpy.logical_and(selection_possible, res_defined)
-		
-		#print '   selection', selection.sum(), selection_possible.sum(), (-selection_possible).sum()
-		
-		#rows = results[table_name][selection].tolist()
-		rows, unique_indices = numpy.unique(results[table_name][selection], return_index=True)
-		rows_weights = selection_weights[unique_indices]
-		
-		assert len(rows) > 1, 'No magnitude values within radius for "%s".' % mag
+	assert len(rows) > 1, 'No magnitude values within radius for "%s".' % mag
+
+	if memory_limit is not None:
+		bins, hist_sel, hist_all, nsel, nothers, nvalid = stream_magnitude_histogram(
+			tables[ti][col_name], rows, rows_weights, rows_possible)
+	else:
+		# get magnitudes of all
+		mag_all = numpy.array(tables[ti][col_name])
+		# mark -99 as undefined
+		mag_all[mag_all == -99] = numpy.nan
+
+		# get magnitudes of selected
+		mask_all = ~numpy.logical_or(numpy.isnan(mag_all), numpy.isinf(mag_all))
+
 		mag_sel = mag_all[rows]
 		mag_sel_weights = rows_weights
-		
+
 		# remove vaguely possible options from alternative histogram
-		rows_possible = numpy.unique(results[table_name][selection_possible])
 		mask_others = mask_all.copy()
 		mask_others[rows_possible] = False
-		
+
 		# all options in the total (field+target sources) histogram
 		mask_sel = ~numpy.logical_or(numpy.isnan(mag_sel), numpy.isinf(mag_sel))
 
 		#print '      non-nans: ', mask_sel.sum(), mask_others.sum()
+		nsel, nothers, nvalid = mask_sel.sum(), mask_others.sum(), mask_all.sum()
 
-		print('    magnitude histogram of column "%s": %d secure matches, %d insecure matches and %d secure non-matches of %d total entries (%d valid)' % (col, mask_sel.sum(), len(rows_possible), mask_others.sum(), len(mag_all), mask_all.sum()))
-		
 		# make function fitting to ratio shape
 		bins, hist_sel, hist_all = magnitudeweights.adaptive_histograms(mag_all[mask_others], mag_sel[mask_sel], weights=mag_sel_weights[mask_sel])
-		print('    magnitude histogram stored to "%s".' % (mag.replace(':', '_') + '_fit.txt'))
-		with open(mag.replace(':', '_') + '_fit.txt', 'wb') as f:
-			f.write(b'# lo hi selected others\n')
-			numpy.savetxt(f,
-				numpy.transpose([bins[:-1], bins[1:], hist_sel, hist_all]), 
-				fmt = ["%10.5f"]*4)
-		if mask_sel.sum() < 100:
-			print('ERROR: too few secure matches to make a good histogram. If you are sure you want to use this poorly sampled histogram, replace "auto" with the filename. You can also decrease the mag-auto-minprob parameter.')
-			sys.exit(1)
-	else:
-		print('    magnitude histogramming: using histogram from "%s" for column "%s"' % (magfile, col))
-		bins_lo, bins_hi, hist_sel, hist_all = numpy.loadtxt(magfile).transpose()
-		bins = numpy.array(list(bins_lo) + [bins_hi[-1]])
-	func = magnitudeweights.fitfunc_histogram(bins, hist_sel, hist_all)
-	magnitudeweights.plot_fit(bins, hist_sel, hist_all, func, mag)
-	weights = log10(func(table[col]))
-	# undefined magnitudes do not contribute
-	weights[numpy.isnan(weights)] = 0
-	biases[col] = weights
-
 
-# add the bias columns
-for col, weights in biases.items():
-	columns.append(pyfits.Column(name='bias_%s' % col, format='E', array=10**weights))
-
-print()
-print('Computing final probabilities ...')
-
-# add the posterior column
-total = log_bf + sum(biases.values())
-post = bayesdist.posterior(prior, total)
-columns.append(pyfits.Column(name='p_single', format='E', array=post))
-
-# compute weights for group posteriors
-# 4pi comes from Eq. 
-log_post_weight = bayesdist.unnormalised_log_posterior(prior, total, ncat)
-
-# flagging of solutions. Go through groups by primary id (IDs in first catalogue)
-index = numpy.zeros_like(post)
-prob_has_match = numpy.zeros_like(post)
-prob_this_match = numpy.zeros_like(post)
-
-match_header['COL_PRIM'] = primary_id_key
-match_header['COLS_ERR'] = ' '.join(['%s_%s' % (ti, poscol) for ti, poscol in zip(table_names, pos_errors)])
-print('    grouping by column "%s" and flagging ...' % (primary_id_key))
-
-pid_index = primary_ids.index(pid)
-best_log_bf = 0
-# go through more complex associations
-for primary_id, ilo, ihi in tqdm.tqdm(list(zip(primary_ids, primary_id_start, primary_id_end))):
-	# group
-	mask = slice(ilo, ihi)
-	
-	# compute no-match probability
-	values = log_post_weight[mask]
-	offset = values.max()
-	bfsum = log10((10**(values - offset)).sum()) + offset
-	if len(values) > 1:
-		offset = values[1:].max()
-		bfsum1 = log10((10**(values[1:] - offset)).sum()) + offset
+	print('    magnitude histogram of column "%s": %d secure matches, %d insecure matches and %d secure non-matches of %d total entries (%d valid)' % (col, nsel, len(rows_possible), nothers, len(tables[ti]), nvalid))
+	print('    magnitude histogram stored to "%s".' % (mag.replace(':', '_') + '_fit.txt'))
+	histcache.write_histogram(mag.replace(':', '_') + '_fit.txt', bins, hist_sel, hist_all)
+	if nsel < 100:
+		print('ERROR: too few secure matches to make a good histogram. If you are sure you want to use this poorly sampled histogram, replace "auto" with the filename. You can also decrease the mag-auto-minprob parameter.')
+		sys.exit(1)
+	return bins, hist_sel, hist_all
+
+def make_grid_prior(spec, rows, rows_weights, rows_possible):
+	"""
+	Build and store the joint histograms (see magnitudeweights.adaptive_grid)
+	of secure matches and of secure non-matches of the columns of spec 
+	(<table>:<column1>,<column2>).
+	"""
+	table_name, col_names = spec.split(':', 1)
+	ti = table_names.index(table_name)
+	assert len(rows) > 1, 'No values within radius for "%s".' % spec
+	values = []
+	for col_name in col_names.split(','):
+		v = numpy.array(tables[ti][col_name], dtype=float)
+		# mark -99 as undefined
+		v[v == -99] = numpy.nan
+		values.append(v)
+	mask_all = numpy.all(numpy.isfinite(values), axis=0)
+	mask_others = mask_all.copy()
+	mask_others[rows_possible] = False
+	mask_sel = mask_all[rows]
+	print('    joint histogram of "%s": %d secure matches, %d insecure matches and %d secure non-matches of %d total entries (%d valid)' % (
+		spec, mask_sel.sum(), len(rows_possible), mask_others.sum(), len(mask_all), mask_all.sum()))
+	grid = magnitudeweights.adaptive_grid([v[mask_others] for v in values], 
+		[v[rows][mask_sel] for v in values], weights=rows_weights[mask_sel])
+	filename = spec.replace(':', '_').replace(',', '_') + '_grid.txt'
+	histcache.write_grid(filename, *grid)
+	print('    grid stored to "%s" (%d non-empty cells)' % (filename, len(grid[1])))
+	if mask_sel.sum() < 100:
+		print('ERROR: too few secure matches to make a good histogram. If you are sure you want to use this poorly sampled histogram, replace "auto" with the filename. You can also decrease the mag-auto-minprob parameter.')
+		sys.exit(1)
+	return grid
+
+def write_groups(writer, columns, log_post_weight, primary_id_column, acceptable_prob, min_prob):
+	"""
+	Compute the group statistics (p_any, p_i, match_flag) of each
+	primary source and write the rows in chunks.
+
+	Returns the number of rows cut away by --min-prob.
+	"""
+	group_start = tableio.group_starts(primary_id_column)
+	ncut = 0
+	for lo, hi in tableio.row_group_ranges(primary_id_column, args.chunk_size):
+		glo, ghi = numpy.searchsorted(group_start, [lo, hi])
+		prob_has_match, prob_this_match, index = bayesdist.group_posteriors(
+			log_post_weight[lo:hi], group_start[glo:ghi] - lo, acceptable_prob)
+
+		chunk = [(c.name, c.array[lo:hi]) for c in columns] + [
+			('p_any', prob_has_match), ('p_i', prob_this_match),
+			# add the flagging column
+			('match_flag', index)]
+
+		# cut away poor posteriors if requested
+		if min_prob > 0:
+			mask = ~(prob_this_match < min_prob)
+			ncut += len(mask) - mask.sum()
+			chunk = [(k, v[mask]) for k, v in chunk]
+
+		writer.write(chunk)
+	return ncut
+
+def copy_previous_groups(writer, names):
+	"""
+	Copy the groups of the previous output (--update) whose primary
+	sources were not matched again. With --out-narrow, the row numbers
+	are changed to those in the current catalogues.
+	"""
+	for chunk in previous_chunks():
+		chunk = OrderedDict(chunk)
+		mask = ~numpy.in1d(chunk[previous_header['COL_PRIM']], replaced_ids)
+		chunk = OrderedDict([(k, v[mask]) for k, v in chunk.items()])
+		if 'dist_bayesfactor_corrected' in names and 'dist_bayesfactor_corrected' not in chunk:
+			# no correction for unrelated associations was necessary
+			chunk['dist_bayesfactor_corrected'] = chunk['dist_bayesfactor']
+		assert set(chunk.keys()) == set(names), 'previous output "%s" has other columns than this run: %s' % (
+			args.update, ', '.join(sorted(set(chunk.keys()).symmetric_difference(names))))
+		if args.out_narrow:
+			for table_name, mapping in zip(table_names, row_mappings):
+				if mapping is None:
+					continue
+				k = '%s_index' % table_name
+				index = incremental.remap_index(mapping[0], chunk[k])
+				assert ((index >= 0) == (chunk[k] >= 0)).all(), 'rows of a changed source of "%s" in groups which were not matched again' % table_name
+				chunk[k] = index
+		writer.write([(n, chunk[n]) for n in names])
+
+def open_writer(columns, match_header, outfile):
+	header = dict(
+		METHOD='NWAY multi-way matching',
+		INPUT=', '.join(filenames),
+		TABLES=', '.join(table_names),
+		BIASING=', '.join(bias_columns),
+		NWAYCMD=' '.join(sys.argv),
+	)
+	header.update(match_header)
+	if args.out_format == 'parquet':
+		print('creating output Parquet file ...')
+		return tableio.ParquetTableWriter(outfile, metadata=header)
 	else:
-		bfsum1 = 0
-	
-	# for p_any, find the one without counterparts
-	p_none = float(values[0])
-	p_any = 1 - 10**(p_none - bfsum)
-	# this avoids overflows in the no-counterpart solution, 
-	# which we want to set to 0
-	values[0] = bfsum1
-	p_i = 10**(values - bfsum1)
-	p_i[0] = 0
-	
-	prob_has_match[mask] = p_any
-	prob_this_match[mask] = p_i
-	
-	best_val = p_i.max()
-	
-	# flag best & second best
-	# ignore very poor solutions
-	index[mask] = numpy.where(best_val == p_i, 1, 
-		numpy.where(p_i > diff_secondary * best_val, 2, 0))
-	
-	
-columns.append(pyfits.Column(name='p_any', format='E', array=prob_has_match))
-columns.append(pyfits.Column(name='p_i', format='E', array=prob_this_match))
-
-#index[ncat == 1] == -1
-# add the flagging column
-columns.append(pyfits.Column(name='match_flag', format='I', array=index))
-
-# cut away poor posteriors if requested
-if min_prob > 0:
-	mask = ~(prob_this_match < min_prob)
-	print('    cutting away %d (below p_i minimum)' % (len(mask) - mask.sum()))
+		print('creating output FITS file ...')
+		primary_hdu = match.make_primary_hdu()
+		for k in 'METHOD', 'INPUT', 'TABLES', 'BIASING', 'NWAYCMD':
+			primary_hdu.header[k] = header[k]
+		for k, v in args.__dict__.items():
+			primary_hdu.header.add_comment("argument %s: %s" % (k, v))
+		primary_hdu.header.update(match_header)
+		formats = dict([(c.name, c.format) for c in columns] + [('p_any', 'E'), ('p_i', 'E'), ('match_flag', 'I')])
+		return tableio.FITSTableWriter(outfile, 'NWAYMATCH', formats=formats, primary_hdu=primary_hdu)
+
+
+if args.footprint_out is not None or (args.footprint_filter and args.tile_nside is None and args.update is None and len(tables) > 1):
+	print('computing the footprint of the primary catalogue ...')
+	radectables = [(t[match.get_tablekeys(t, 'RA', tablename=table_name)], t[match.get_tablekeys(t, 'DEC', tablename=table_name)])
+		for t, table_name in zip(tables, table_names)]
+	moc, footprint_rows = footprint.rows_in_footprint(radectables, match_radius)
+	del radectables
+	print('    footprint area: %.3f square degrees' % footprint.area(moc))
+	if args.footprint_out is not None:
+		footprint.write_moc(args.footprint_out, moc)
+		print('    wrote "%s"' % args.footprint_out)
+	if args.footprint_filter and args.tile_nside is None:
+		for table_name, t, r in zip(table_names[1:], tables[1:], footprint_rows[1:]):
+			print('    %s: %d of %d sources within the footprint' % (table_name, len(r), len(t)))
+	else:
+		footprint_rows = None
+else:
+	footprint_rows = None
+
+# the previous versions of the catalogues (those unchanged are the current ones)
+previous_tables = list(tables)
+previous_areas = list(sky_areas)
+# for each catalogue, the current row number of each previous row and vice versa (-1 if changed)
+row_mappings = [None] * len(tables)
+if args.update is not None:
+	print('comparing with the previous versions of the catalogues ...')
+	previous_filenames = dict(args.previous_catalogue)
+	changed_radectables = []
+	for ti, (filename, table, table_name) in enumerate(zip(filenames, tables, table_names)):
+		if filename not in previous_filenames:
+			continue
+		previous_input = tableio.open_table(previous_filenames[filename], name=table_name,
+			area=sky_area_overrides.get(filename), format=args.in_format)
+		previous = previous_input.data
+		previous_tables[ti] = previous
+		if previous_input.area is not None:
+			previous_areas[ti] = previous_input.area
+		# compare the columns which go into the output
+		ra_key = match.get_tablekeys(table, 'RA', tablename=table_name)
+		dec_key = match.get_tablekeys(table, 'DEC', tablename=table_name)
+		names = list(table.dtype.names) if merge_columns is None else list(OrderedDict.fromkeys([ra_key, dec_key] + merge_columns[ti]))
+		missing = [n for n in names if n not in previous.dtype.names]
+		assert not missing, 'previous version "%s" of catalogue "%s" lacks the columns: %s' % (previous_filenames[filename], filename, ', '.join(missing))
+		current_columns = [(n, table[n]) for n in names]
+		previous_columns = [(n, previous[n]) for n in names]
+		dtypes = incremental.common_dtypes(previous_columns, current_columns)
+		old_to_new, new_to_old = incremental.diff_rows(
+			incremental.row_keys(previous_columns, dtypes, chunk_size=args.chunk_size),
+			incremental.row_keys(current_columns, dtypes, chunk_size=args.chunk_size))
+		row_mappings[ti] = old_to_new, new_to_old
+		print('    %s: %d rows removed or changed, %d rows added or changed' % (table_name, (old_to_new < 0).sum(), (new_to_old < 0).sum()))
+		if ti > 0:
+			# both the previous and the current positions of the changed sources
+			changed_radectables.append((previous[ra_key][old_to_new < 0], previous[dec_key][old_to_new < 0]))
+			changed_radectables.append((table[ra_key][new_to_old < 0], table[dec_key][new_to_old < 0]))
+
+	ra_key = match.get_tablekeys(tables[0], 'RA', tablename=table_names[0])
+	dec_key = match.get_tablekeys(tables[0], 'DEC', tablename=table_names[0])
+	changed_moc = footprint.dilated_coverage(
+		numpy.concatenate([ra for ra, dec in changed_radectables] + [numpy.zeros(0)]),
+		numpy.concatenate([dec for ra, dec in changed_radectables] + [numpy.zeros(0)]), match_radius)
+	# primary sources within radius of a changed secondary source, and those changed themselves
+	affected = footprint.contains(changed_moc, tables[0][ra_key], tables[0][dec_key])
+	if row_mappings[0] is not None:
+		old_to_new, new_to_old = row_mappings[0]
+		affected[new_to_old < 0] = True
+		# groups of the previous output to leave out
+		replaced = old_to_new < 0
+		replaced[new_to_old[affected & (new_to_old >= 0)]] = True
+	else:
+		replaced = affected.copy()
+	affected = numpy.where(affected)[0]
+	replaced = numpy.where(replaced)[0]
+	print('    matching %d of %d primary sources again' % (len(affected), len(tables[0])))
+
+	previous_header, previous_output_columns, previous_chunks = tableio.read_output(args.update, chunk_size=args.chunk_size)
+	if args.out_narrow:
+		assert previous_header.get('COL_PRIM') == '%s_index' % table_names[0], 'previous output "%s" was not written with --out-narrow' % args.update
+		replaced_ids = replaced
+	else:
+		assert previous_header.get('COL_PRIM') == primary_id_key, 'previous output "%s" has primary column "%s", expected "%s"' % (args.update, previous_header.get('COL_PRIM'), primary_id_key)
+		replaced_ids = previous_tables[0][match.get_tablekeys(tables[0], 'ID', tablename=table_names[0])][replaced]
+
+	if len(affected) > 0:
+		# the secondary sources which can be matched to them
+		affected_moc = footprint.dilated_coverage(tables[0][ra_key][affected], tables[0][dec_key][affected], match_radius)
+		footprint_rows = [affected] + [numpy.where(footprint.contains(affected_moc,
+			t[match.get_tablekeys(t, 'RA', tablename=table_name)], t[match.get_tablekeys(t, 'DEC', tablename=table_name)]))[0]
+			for t, table_name in zip(tables[1:], table_names[1:])]
+
+if args.update is not None and len(affected) == 0:
+	tiles = []
+elif args.tile_nside is None:
+	# tiles restrict the secondary sources to their margins already
+	tiles = [(None, footprint_rows)]
+else:
+	print('splitting the sky into tiles (nside=%d) ...' % args.tile_nside)
+	radectables = [(t[match.get_tablekeys(t, 'RA', tablename=table_name)], t[match.get_tablekeys(t, 'DEC', tablename=table_name)])
+		for t, table_name in zip(tables, table_names)]
+	tiles = list(tiling.iter_tiles(radectables, match_radius, args.tile_nside))
+	del radectables
+	print('    %d tiles with primary sources' % len(tiles))
+	if manifest is not None:
+		shard_tiles = set(manifest['shards'][args.shard])
+		tiles = [(tile, rows) for tile, rows in tiles if tile in shard_tiles]
+		assert len(tiles) == len(shard_tiles), 'tiles of shard %d not found' % args.shard
+		print('    %d tiles in shard %d' % (len(tiles), args.shard))
+		# write to a temporary file, renamed when complete
+		outfile = sharding.shard_filename(manifest, args.shard) + '.tmp'
+tiled = args.tile_nside is not None
+# magnitude histograms precomputed for all shards
+shard_histograms = {} if manifest is None else sharding.magnitude_histograms(manifest)
+shard_grids = {} if manifest is None else sharding.grid_priors(manifest)
+
+def compute_tiles(tiles):
+	"""
+	Distance-based probabilities of each tile. In tiled mode, the next
+	tile is computed in the background while the current one is processed.
+	"""
+	compute = lambda tile_rows: compute_distance_probabilities(tile_rows[1], verbose=not tiled)
+	if tiled:
+		return tiling.prefetch(compute, tiles)
+	return map(compute, tiles)
+
+def parameter_stage(stage, completeness):
+	"""
+	Prior, distance-based posterior and columns of a tile for 
+	another prior completeness (see --sweep).
+	"""
+	results, columns, match_header, table, prior, log_bf, post, scratch = stage
+	if not numpy.array_equal(completeness, prior_completeness):
+		prior = compute_prior(table, completeness, scratch)
+		post = scratch.apply(bayesdist.posterior, prior, log_bf)
+		columns = [c for c in columns if c.name != 'dist_post'] + [
+			pyfits.Column(name='dist_post', format='E', array=scratch.astype(post, 'f4'))]
+	return prior, post, list(columns)
+
+# the parameter sets to compute the probabilities for, and their output files
+parameter_sets = []
+for values in itertools.product(*sweep_parameters.values()):
+	settings = OrderedDict(zip(sweep_parameters.keys(), values))
+	parameter_sets.append(dict(
+		settings=settings,
+		prior_completeness=parse_prior_completeness(settings.get('prior-completeness', args.prior_completeness)),
+		acceptable_prob=float(settings.get('acceptable-prob', args.acceptable_prob)),
+		min_prob=float(settings.get('min-prob', args.min_prob)),
+		outfile=sweep_filename(outfile, settings),
+	))
+# the magnitude biases depend only on the prior completeness
+bias_sets = OrderedDict([(tuple(params['prior_completeness']), dict(
+	prior_completeness=params['prior_completeness'],
+	label=params['settings'].get('prior-completeness'))) for params in parameter_sets])
+
+# auto magnitude histograms computed before with the same inputs
+# (with --update, those of the previous versions of the catalogues)
+hist_cache = histcache.HistogramCache(args.mag_cache) if args.mag_cache is not None else None
+for biasing in bias_sets.values():
+	biasing['cached_histograms'] = cached_histograms = OrderedDict()
+	biasing['histogram_keys'] = histogram_keys = OrderedDict()
+	if hist_cache is not None and [mag for mag, magfile in magnitude_columns if magfile == 'auto' and mag not in shard_histograms]:
+		match_key = histcache.fingerprint(
+			[(table_name, t[match.get_tablekeys(t, 'RA', tablename=table_name)], t[match.get_tablekeys(t, 'DEC', tablename=table_name)], 
+				area, pos_error, [t[k] for k in pos_error[1:].split(':')] if pos_error[0] == ':' else [])
+				for t, table_name, area, pos_error in zip(previous_tables, table_names, previous_areas, pos_errors)],
+			args.radius, biasing['prior_completeness'], args.consider_unrelated_associations,
+			pairwise_errs, args.adaptive_radius, args.max_candidates)
+		for mag, magfile in magnitude_columns:
+			if magfile != 'auto' or mag in shard_histograms:
+				continue
+			table_name, col_name = mag.split(':', 1)
+			histogram_keys[mag] = histcache.fingerprint(match_key, mag, previous_tables[table_names.index(table_name)][col_name], 
+				mag_include_radius, mag_exclude_radius, magauto_post_single_minvalue)
+			histograms = hist_cache.load(histogram_keys[mag])
+			if histograms is not None:
+				cached_histograms[mag] = histograms
+	if args.update is not None:
+		# the magnitude histograms of the previous run are kept fixed
+		for mag, magfile in magnitude_columns:
+			assert magfile != 'auto' or mag in cached_histograms, 'magnitude histogram "%s" of the previous run not found in --mag-cache. Give its file (e.g., %s_fit.txt) instead of auto.' % (mag, mag.replace(':', '_'))
+
+	# find magnitude biasing functions
+	# the histograms of secure matches need a first pass over all tiles
+	auto_mags = [mag for mag, magfile in magnitude_columns if magfile == 'auto' and mag not in shard_histograms and mag not in cached_histograms]
+	auto_mags += [spec for spec, gridfile in grid_columns if gridfile == 'auto' and spec not in shard_grids]
+	biasing['selections'] = OrderedDict([(mag, ([], [], [])) for mag in auto_mags])
+
+stage = None
+if [biasing for biasing in bias_sets.values() if biasing['selections']]:
+	if tiled:
+		print('computing distance-based probabilities for magnitude histograms ...')
+	for stage in tqdm.tqdm(compute_tiles(tiles), total=len(tiles), disable=not tiled):
+		results, columns, match_header, table, prior, log_bf, post, scratch = stage
+		for biasing in bias_sets.values():
+			if not biasing['selections']:
+				continue
+			prior, post, columns = parameter_stage(stage, biasing['prior_completeness'])
+			for mag, selections in biasing['selections'].items():
+				for l, v in zip(selections, magnitude_selection(mag, table, results, post)):
+					l.append(v)
+	if tiled:
+		stage = None
+
+for biasing in bias_sets.values():
+	cached_histograms, histogram_keys, selections = biasing['cached_histograms'], biasing['histogram_keys'], biasing['selections']
+	if magnitude_columns or grid_columns:
+		print()
+		if biasing['label'] is not None:
+			print('Incorporating magnitude biases (prior-completeness=%s) ...' % biasing['label'])
+		else:
+			print('Incorporating magnitude biases ...')
+	# log10 bias of each source, by catalogue and column
+	biasing['source_biases'] = source_biases = OrderedDict()
+	bias_columns = []
+	magnitude_histograms = OrderedDict()
+	for mag, magfile in magnitude_columns:
+		print('    magnitude bias "%s" ...' % mag)
+		table_name, col_name = mag.split(':', 1)
+		col = "%s_%s" % (table_name, col_name)
+
+		if mag in shard_histograms:
+			print('    magnitude histogramming: using histogram from shard manifest for column "%s"' % col)
+			bins, hist_sel, hist_all = shard_histograms[mag]
+		elif mag in cached_histograms:
+			print('    magnitude histogramming: using cached histogram "%s" for column "%s"' % (hist_cache.path(histogram_keys[mag]), col))
+			bins, hist_sel, hist_all = cached_histograms[mag]
+		elif magfile == 'auto':
+			if mag_include_radius is not None:
+				if mag_include_radius >= match_radius * 60 * 60:
+					print('WARNING: magnitude radius is very large (>= matching radius). Consider using a smaller value.')
+			# combine the selections of all tiles
+			all_rows, all_weights, all_rows_possible = [numpy.concatenate(l) for l in selections[mag]]
+			rows, unique_indices = numpy.unique(all_rows, return_index=True)
+			bins, hist_sel, hist_all = make_magnitude_histogram(mag, rows, all_weights[unique_indices], numpy.unique(all_rows_possible))
+			if mag in histogram_keys:
+				print('    magnitude histogram cached as "%s".' % hist_cache.store(histogram_keys[mag], bins, hist_sel, hist_all))
+		else:
+			print('    magnitude histogramming: using histogram from "%s" for column "%s"' % (magfile, col))
+			bins_lo, bins_hi, hist_sel, hist_all = numpy.loadtxt(magfile).transpose()
+			bins = numpy.array(list(bins_lo) + [bins_hi[-1]])
+		func = magnitudeweights.fitfunc_histogram(bins, hist_sel, hist_all)
+		magnitudeweights.plot_fit(bins, hist_sel, hist_all, func, mag)
+		# evaluate the bias once per source (the last entry for missing counterparts, -99)
+		log_bias_table = magnitudeweights.log_bias_table(bins, hist_sel, hist_all)
+		magvals = tables[table_names.index(table_name)][col_name]
+		source_bias = ScratchSpace(memory_limit, directory=args.scratch_dir, chunk_size=args.chunk_size).apply(
+			lambda values: magnitudeweights.log_bias(bins, log_bias_table, values), 
+			numpy.append(magvals, numpy.array(-99, dtype=magvals.dtype)))
+		source_biases.setdefault(table_name, OrderedDict())[col] = source_bias
+		bias_columns.append(col)
+		magnitude_histograms[mag] = bins, hist_sel, hist_all
+
+	grid_priors = OrderedDict()
+	for spec, gridfile in grid_columns:
+		print('    joint prior "%s" ...' % spec)
+		table_name, col_names = spec.split(':', 1)
+		col_names = col_names.split(',')
+		col = '_'.join([table_name] + col_names)
+		if spec in shard_grids:
+			print('    grid: using grid from shard manifest for "%s"' % col)
+			grid = shard_grids[spec]
+		elif gridfile == 'auto':
+			all_rows, all_weights, all_rows_possible = [numpy.concatenate(l) for l in selections[spec]]
+			rows, unique_indices = numpy.unique(all_rows, return_index=True)
+			grid = make_grid_prior(spec, rows, all_weights[unique_indices], numpy.unique(all_rows_possible))
+		else:
+			print('    grid: using grid from "%s" for "%s"' % (gridfile, col))
+			grid = histcache.read_grid(gridfile)
+		# evaluate the prior once per source (the last entry for missing counterparts, -99)
+		values = [tables[table_names.index(table_name)][col_name] for col_name in col_names]
+		source_bias = ScratchSpace(memory_limit, directory=args.scratch_dir, chunk_size=args.chunk_size).apply(
+			lambda *values: magnitudeweights.log_grid_bias(grid[0], grid[1], grid[2], grid[3], values),
+			*[numpy.append(v, numpy.array(-99, dtype=v.dtype)) for v in values])
+		source_biases.setdefault(table_name, OrderedDict())[col] = source_bias
+		bias_columns.append(col)
+		grid_priors[spec] = grid
+
+if args.shards is not None and manifest is None:
+	print()
+	# a batch scheduler launches a job for each of the --shards shards
+	assert 1 <= args.shards <= len(tiles), '--shards %d: only %d tiles to split; use at most --shards %d, or a larger --tile-nside' % (args.shards, len(tiles), len(tiles))
+	print('splitting %d tiles into %d shards ...' % (len(tiles), args.shards))
+	shards = sharding.split_tiles([tile for tile, rows in tiles], 
+		[sum([len(r) for r in rows]) for tile, rows in tiles], args.shards)
+	manifest = sharding.write_manifest(args.manifest, 
+		sharding.strip_arguments(sys.argv[1:], ['--shards', '--manifest']),
+		filenames, outfile, args.out_format, args.tile_nside, shards, magnitude_histograms, grid_priors)
+	print('    wrote shard manifest "%s" (%d shards)' % (args.manifest, len(shards)))
+	print()
+	print('  Compute each shard (on any node sharing this file system) with:')
+	print('      nway.py --manifest %s --shard <0..%d>' % (os.path.abspath(args.manifest), len(shards) - 1))
+	print('  and combine the outputs with:')
+	print('      nway-merge-shards.py %s' % os.path.abspath(args.manifest))
+	sys.exit(0)
 
-	for c in columns:
-		c.array = c.array[mask]
 
-if not filenames[0].endswith('shifted.fits'):
+if manifest is None and not filenames[0].endswith('shifted.fits'):
 	print()
 	print()
 	print('  You can calibrate a p_any cut-off with the following steps:')
 	print('   1) Create a offset catalogue to simulate random sky positions:')
 	shiftfile = filenames[0].replace('.fits', '').replace('.FITS', '') + '-fake.fits'
-	shiftoutfile = outfile + '-fake.fits'
 	print('      nway-create-fake-catalogue.py --radius %d %s %s' % (args.radius*2, filenames[0], shiftfile))
 	print('   2) Match the offset catalogue in the same way as this run:')
-	newargv = []
-	i = 0
-	while i < len(sys.argv):
-		v = sys.argv[i]
-		if v == filenames[0]:
-			newargv.append(shiftfile)
-		elif v == '--mag':
-			newargv.append(v)
-			v = sys.argv[i+1]
-			newargv.append(v)
-			if sys.argv[i+2] == 'auto':
-				newargv.append(v.replace(':', '_') + '_fit.txt')
+	for params in parameter_sets:
+		histogram_keys = bias_sets[tuple(params['prior_completeness'])]['histogram_keys']
+		shiftoutfile = params['outfile'] + '-fake.fits'
+		newargv = []
+		i = 0
+		while i < len(sys.argv):
+			v = sys.argv[i]
+			if v == filenames[0]:
+				newargv.append(shiftfile)
+			elif v == '--mag':
+				newargv.append(v)
+				v = sys.argv[i+1]
+				newargv.append(v)
+				if sys.argv[i+2] == 'auto' and v in histogram_keys:
+					newargv.append(hist_cache.path(histogram_keys[v]))
+				elif sys.argv[i+2] == 'auto':
+					newargv.append(v.replace(':', '_') + '_fit.txt')
+				else:
+					newargv.append(sys.argv[i+2])
+				i = i + 2
+			elif v == '--mag-grid':
+				newargv += [v, sys.argv[i+1]]
+				if sys.argv[i+2] == 'auto':
+					newargv.append(sys.argv[i+1].replace(':', '_').replace(',', '_') + '_grid.txt')
+				else:
+					newargv.append(sys.argv[i+2])
+				i = i + 2
+			elif v == '--sweep':
+				# the magnitude histograms differ between parameter sets
+				i = i + 1
+			elif v.startswith('--sweep='):
+				pass
+			elif v == '--update':
+				# the offset catalogue is matched completely
+				i = i + 1
+			elif v.startswith('--update='):
+				pass
+			elif v == '--previous-catalogue':
+				i = i + 2
+			elif v == '--out':
+				newargv.append(v)
+				i = i + 1
+				newargv.append(shiftoutfile)
+			elif v.startswith('--out='):
+				newargv.append('--out=' + shiftoutfile)
 			else:
-				newargv.append(sys.argv[i+2])
-			i = i + 2
-		elif v == '--out':
-			newargv.append(v)
+				newargv.append(v)
 			i = i + 1
-			newargv.append(shiftoutfile)
-		elif v.startswith('--out='):
-			newargv.append('--out=' + shiftoutfile)
-		else:
-			newargv.append(v)
-		i = i + 1
-	print('      ' + ' '.join(newargv))
+		newargv += ['--%s=%s' % item for item in params['settings'].items()]
+		print('      ' + ' '.join(newargv))
 	print('   3) determining the p_any cutoff that corresponds to a false-detection rate')
-	print('      nway-calibrate-cutoff.py %s %s' % (outfile, shiftoutfile))
+	for params in parameter_sets:
+		print('      nway-calibrate-cutoff.py %s %s' % (params['outfile'], params['outfile'] + '-fake.fits'))
 	print()
 	
-# write out fits file
+
 print()
-print('creating output FITS file ...')
-tbhdu = match.fits_from_columns(pyfits.ColDefs(columns))
-
-hdulist = match.wraptable2fits(tbhdu, 'NWAYMATCH')
-hdulist[0].header['METHOD'] = 'NWAY multi-way matching'
-hdulist[0].header['INPUT'] = ', '.join(filenames)
-hdulist[0].header['TABLES'] = ', '.join(table_names)
-hdulist[0].header['BIASING'] =  ', '.join(biases.keys())
-hdulist[0].header['NWAYCMD'] = ' '.join(sys.argv)
-for k, v in args.__dict__.items():
-	hdulist[0].header.add_comment("argument %s: %s" % (k, v))
-hdulist[0].header.update(match_header)
-print('    writing "%s" (%d rows, %d columns) ...' % (outfile, len(tbhdu.data), len(columns)))
-hdulist.writeto(outfile, **progress.kwargs_overwrite_true)
+print('Computing final probabilities ...')
+if tiled:
+	print('    matching and computing tile by tile ...')
+
+spilled = 0
+for params in parameter_sets:
+	params['writer'] = None
+	params['ncut'] = 0
+stages = [stage] if stage is not None else compute_tiles(tiles)
+for stage in tqdm.tqdm(stages, total=len(tiles), disable=not tiled):
+	results, columns, match_header, table, prior, log_bf, post, scratch = stage
+	primary_id_column = table[primary_id_key]
+	match_header['COL_PRIM'] = primary_id_key
+	if args.out_narrow:
+		match_header['COL_PRIM'] = '%s_index' % table_names[0]
+		match_header['COLS_IDX'] = ' '.join(['%s_index' % table_name for table_name in table_names])
+	match_header['COLS_ERR'] = ' '.join(['%s_%s' % (ti, poscol) for ti, poscol in zip(table_names, pos_errors)])
+	if tiled:
+		match_header['TILENSID'] = args.tile_nside
+	if manifest is not None:
+		match_header['MANIFEST'] = manifest['id']
+		match_header['SHARD'] = args.shard
+
+	for completeness_key, biasing in bias_sets.items():
+		prior, post, columns = parameter_stage(stage, biasing['prior_completeness'])
+		if args.update is not None and 'dist_bayesfactor_corrected' in dict(previous_output_columns) and 'dist_bayesfactor_corrected' not in [c.name for c in columns]:
+			# no correction for unrelated associations was necessary here, but in the previous output
+			i = [c.name for c in columns].index('dist_bayesfactor')
+			columns.insert(i + 1, pyfits.Column(name='dist_bayesfactor_corrected', format='E', array=columns[i].array))
+
+		# gather the biases of the sources in each row, all columns of a catalogue in one pass
+		biases = {}
+		for table_name, cols in biasing['source_biases'].items():
+			indices = results[table_name]
+			for col in cols:
+				biases[col] = scratch.empty(len(indices))
+			for s in scratch.chunks(len(indices)):
+				rows = indices[s]
+				for col, source_bias in cols.items():
+					biases[col][s] = source_bias[rows]
+		biases = OrderedDict([(col, biases[col]) for col in bias_columns])
+
+		# add the bias columns
+		for col, weights in biases.items():
+			columns.append(pyfits.Column(name='bias_%s' % col, format='E', array=scratch.apply(lambda w: 10**w, weights, dtype='f4')))
+
+		# add the posterior column
+		total = scratch.apply(lambda log_bf, *weights: log_bf + sum(weights), log_bf, *biases.values())
+		post = scratch.apply(bayesdist.posterior, prior, total, dtype='f4')
+		columns.append(pyfits.Column(name='p_single', format='E', array=post))
+
+		# compute weights for group posteriors
+		# 4pi comes from Eq. 
+		log_post_weight = scratch.apply(bayesdist.unnormalised_log_posterior, prior, total, table['ncat'])
+
+		if args.out_narrow:
+			# replace input catalogue columns by row numbers
+			input_column_names = set(['%s_%s' % (table_name, n) for table_name, t in zip(table_names, tables) for n in t.dtype.names])
+			columns = [pyfits.Column(name='%s_index' % table_name, format='K', array=results[table_name])
+				for table_name in table_names] + [c for c in columns if c.name not in input_column_names]
+
+		for params in parameter_sets:
+			if tuple(params['prior_completeness']) != completeness_key:
+				continue
+			if params['writer'] is None:
+				# write out the output file, chunk by chunk
+				print()
+				header = dict(match_header)
+				if params['settings']:
+					header['SWEEP'] = ' '.join(['%s=%s' % item for item in params['settings'].items()])
+				params['writer'] = open_writer(columns, header, params['outfile'])
+				params['names'] = [c.name for c in columns] + ['p_any', 'p_i', 'match_flag']
+				# flagging of solutions. Go through groups by primary id (IDs in first catalogue)
+				print('    grouping by column "%s" and flagging ...' % (primary_id_key))
+				print('    writing "%s" in chunks of ~%d rows ...' % (params['outfile'], args.chunk_size))
+			params['ncut'] += write_groups(params['writer'], columns, log_post_weight, primary_id_column,
+				params['acceptable_prob'], params['min_prob'])
+	spilled += scratch.spilled
+
+if args.update is not None:
+	params, = parameter_sets
+	if params['writer'] is None:
+		print()
+		print('    no primary source is matched again')
+		params['names'] = [name for name, format in previous_output_columns]
+		if args.out_format == 'parquet':
+			params['writer'] = tableio.ParquetTableWriter(params['outfile'], metadata=previous_header)
+		else:
+			primary_hdu = match.make_primary_hdu()
+			primary_hdu.header = previous_header.copy()
+			params['writer'] = tableio.FITSTableWriter(params['outfile'], 'NWAYMATCH', 
+				formats=dict(previous_output_columns), primary_hdu=primary_hdu)
+	print('    copying the other groups from "%s" ...' % args.update)
+	copy_previous_groups(params['writer'], params['names'])
+
+for params in parameter_sets:
+	params['writer'].close()
+	if manifest is not None:
+		# mark the shard as complete
+		os.rename(params['outfile'], sharding.shard_filename(manifest, args.shard))
+		params['outfile'] = sharding.shard_filename(manifest, args.shard)
+
+	if params['min_prob'] > 0:
+		print('    cut away %d (below p_i minimum)' % params['ncut'])
+	print('    wrote "%s" (%d rows, %d columns)' % (params['outfile'], params['writer'].nrows, len(params['names'])))
+if spilled > 0:
+	print('    placed %s of intermediate arrays in scratch files (above --memory-limit)' % format_size(spilled))
 
 import nwaylib.checkupdates
 nwaylib.checkupdates.checkupdates()
-
-
-
@@ -5,14 +5,22 @@ from __future__ import print_function, division
 __doc__ = """Multiway association between astrometric catalogues"""
 
 import numpy
-from numpy import log10, pi
+from numpy import pi
 import pandas
+import multiprocessing
 from collections import OrderedDict
 
 from .logger import NullOutputLogger, NormalLogger
 from . import fastskymatch as match
 from . import bayesdistance as bayesdist
 from . import magnitudeweights as magnitudeweights
+from . import tableio
+from . import tiling
+from . import sharedstore
+from . import planning
+from . import footprint
+from . import histcache
+from . import skyindex
 
 class UndersampledException(Exception):
 	pass
@@ -23,8 +31,8 @@ def nway_match(match_tables, match_radius, prior_completeness,
 	mag_include_radius=None, mag_exclude_radius=None, magauto_post_single_minvalue=0.9,
 	prob_ratio_secondary = 0.5,
 	min_prob=0., consider_unrelated_associations=True, 
-	store_mag_hists=True,
-	logger=NormalLogger()):
+	store_mag_hists=True, tile_nside=None, processes=1, adaptive_radius=None,
+	max_candidates_per_catalogue=None, footprint_filter=True, mag_hist_cache=None, logger=NormalLogger()):
 	"""
 	match_tables: list of catalogues, each a dict with entries:
 		- name (short catalog name, no spaces, used in output columns)
@@ -68,23 +76,383 @@ def nway_match(match_tables, match_radius, prior_completeness,
 	
 	store_mag_hists: Write constructed mag hists to file (filename based on table name and mags).
 	
+	tile_nside: If set, split the sky into HEALPix tiles with this nside (a power of 2),
+		and match them one after the other. Tiles have to be larger than match_radius.
+		Reduces the memory needed for matching. The output is then ordered by tile.
+	
+	processes: number of worker processes matching tiles in parallel (requires tile_nside).
+		The positions and errors are shared with the workers, not copied (see sharedstore).
+	
+	adaptive_radius: If set to (k, floor), each pair of sources i, j is only searched 
+		within k * sqrt(error_i**2 + error_j**2) + floor arcsec (and within match_radius, 
+		which is then only needed for the sources with the largest errors).
+	
+	max_candidates_per_catalogue: If set, for each primary source only this
+		many nearest sources of each secondary catalogue (by separation
+		relative to the position errors) are considered. Bounds the number of
+		combinations per primary source in dense fields.
+		The number of candidates left out and an upper bound of their posterior
+		mass are logged.
+	
+	footprint_filter: Leave out the secondary sources outside the footprint of the
+		primary catalogue (dilated by match_radius) before matching (without tiles).
+		Does not change the result.
+	
+	mag_hist_cache: directory for caching the automatically built magnitude
+		histograms (maghists entries None), by a fingerprint of the inputs 
+		and parameters they depend on (see histcache). If None (default), not cached.
+	
 	logger: NormalLogger for stderr output and progress bars, NullOutputLogger if silent
 	"""
+	return nway_sweep(match_tables, match_radius, 
+		[dict(prior_completeness=prior_completeness, prob_ratio_secondary=prob_ratio_secondary, min_prob=min_prob)],
+		mag_include_radius=mag_include_radius, mag_exclude_radius=mag_exclude_radius, 
+		magauto_post_single_minvalue=magauto_post_single_minvalue,
+		consider_unrelated_associations=consider_unrelated_associations, 
+		store_mag_hists=store_mag_hists, tile_nside=tile_nside, processes=processes, adaptive_radius=adaptive_radius,
+		max_candidates_per_catalogue=max_candidates_per_catalogue, footprint_filter=footprint_filter, 
+		mag_hist_cache=mag_hist_cache, logger=logger)[0]
+
+def nway_sweep(match_tables, match_radius, parameter_sets,
+	mag_include_radius=None, mag_exclude_radius=None, magauto_post_single_minvalue=0.9,
+	consider_unrelated_associations=True, 
+	store_mag_hists=True, tile_nside=None, processes=1, adaptive_radius=None,
+	max_candidates_per_catalogue=None, footprint_filter=True, mag_hist_cache=None, logger=NormalLogger()):
+	"""
+	Like nway_match, for several parameter sets. The candidates and their
+	distance-based Bayes factors are computed only once.
+
+	parameter_sets: list of dicts with the parameters prior_completeness,
+		prob_ratio_secondary (default: 0.5) and min_prob (default: 0),
+		see nway_match.
+
+	The other arguments are those of nway_match.
+	Returns a list of the result tables, one for each parameter set.
+	"""
 	if mag_exclude_radius is None:
 		mag_exclude_radius = mag_include_radius
 	if mag_include_radius is not None:
 		if mag_include_radius >= match_radius:
 			logger.warn('WARNING: magnitude radius is very large (>= matching radius). Consider using a smaller value.')
 
+	assert processes == 1 or tile_nside is not None, 'parallel matching (processes > 1) requires tiles (tile_nside)'
+	assert len(parameter_sets) > 0, 'no parameter sets given'
+	source_densities, source_densities_plus = _compute_source_densities(match_tables, logger=logger)
+	prior_completeness = parameter_sets[0]['prior_completeness']
+
+	if tile_nside is None and footprint_filter and len(match_tables) > 1:
+		table, prior = _compute_distance_log_bf_footprint(match_tables, match_radius, adaptive_radius, max_candidates_per_catalogue, source_densities, source_densities_plus,
+			prior_completeness, consider_unrelated_associations, logger=logger)
+	elif tile_nside is None:
+		table, prior = _compute_distance_log_bf(match_tables, match_radius, adaptive_radius, max_candidates_per_catalogue, source_densities, source_densities_plus,
+			prior_completeness, consider_unrelated_associations, logger=logger)
+	else:
+		table, prior = _compute_distance_log_bf_tiled(match_tables, match_radius, adaptive_radius, max_candidates_per_catalogue, tile_nside, source_densities, source_densities_plus,
+			prior_completeness, consider_unrelated_associations, processes=processes, logger=logger)
+	log_bf = table['dist_bayesfactor']
+	distance_table = table
+
+	results = []
+	for parameters in parameter_sets:
+		if parameters['prior_completeness'] is not prior_completeness:
+			prior = _compute_prior(match_tables, source_densities, source_densities_plus, distance_table, parameters['prior_completeness'])
+
+		# add the additional columns
+		post = bayesdist.posterior(prior, log_bf)
+		table = distance_table.assign(dist_post=post)
+
+		# find magnitude biasing functions
+		hist_cache = None
+		if mag_hist_cache is not None:
+			match_key = histcache.fingerprint([(t['name'], t['ra'], t['dec'], t['error'], t['area']) for t in match_tables],
+				match_radius, parameters['prior_completeness'], consider_unrelated_associations, adaptive_radius, max_candidates_per_catalogue)
+			hist_cache = (histcache.HistogramCache(mag_hist_cache), match_key)
+		table, total = _apply_magnitude_biasing(match_tables, table, mag_include_radius, mag_exclude_radius, magauto_post_single_minvalue, store_mag_hists, hist_cache=hist_cache, logger=logger)
+
+		table = _compute_final_probabilities(match_tables, table, parameters.get('prob_ratio_secondary', 0.5), prior, total, logger=logger)
+
+		table = _truncate_table(table, parameters.get('min_prob', 0.), logger=logger)
+		results.append(table)
+	
+	return results
+
+def plan(match_tables, match_radius, memory_limit=None, sample_size=planning.default_sample_size, logger=NormalLogger()):
+	"""
+	Predict the number of candidates, the memory needed and the run time 
+	of nway_match, without running it, and recommend tile_nside.
+	
+	match_tables: list of catalogues, as for nway_match
+	match_radius: maximum radius in arcsec to consider
+	memory_limit: memory available in bytes. By default, the physical memory.
+	sample_size: number of primary sources to hash for the prediction
+	
+	Returns a dictionary of the predictions and recommendations 
+	(see planning.plan).
+	"""
+	radectables = [(numpy.asarray(t['ra']), numpy.asarray(t['dec'])) for t in match_tables]
+	# positions, errors and magnitudes are merged into the output
+	row_bytes = sum([8 * (3 + len(t.get('mags', []))) for t in match_tables])
+	result = planning.plan(radectables, [t['area'] for t in match_tables], match_radius / 60. / 60.,
+		row_bytes, memory_limit=memory_limit, sample_size=sample_size)
+	for line in planning.format_plan(result):
+		logger.log(line)
+	return result
+
+class Catalogue(object):
+	"""
+	A secondary catalogue kept in memory for matching many batches of
+	primary sources (see match_batch): its positions and errors, a
+	spatial index (see skyindex) and the magnitude biases of its sources
+	are prepared once.
+
+	table: dict with the entries of a match_tables entry of nway_match
+		(name, ra, dec, error, area, and optionally mags, magnames, maghists).
+		The magnitude histograms have to be given (no None entries).
+	match_radius: maximum radius in arcsec to consider, as for nway_match
+	"""
+	def __init__(self, table, match_radius):
+		self.table = _as_arrays(table)
+		self.name = table['name']
+		self.match_radius = match_radius
+		self.index = skyindex.SkyIndex(self.table['ra'], self.table['dec'], match_radius / 60. / 60)
+		self.source_biases = _fixed_source_biases(self.table)
+
+	def __len__(self):
+		return len(self.index)
+
+def open_catalogue(filename, pos_error, match_radius, mags=[], name=None, area=None, format=None):
+	"""
+	Load a catalogue file (FITS, Parquet, HDF5 or CSV, see tableio.open_table)
+	as a Catalogue.
+
+	pos_error: position error in arcsec, or :<column> (circular errors only)
+	match_radius: maximum radius in arcsec to consider
+	mags: list of (<table>:<column>, histogram file) for magnitude biasing,
+		of which those of this catalogue are used. The histogram files
+		are the <table>_<column>_fit.txt files of nway.py --mag ... auto.
+	name, area, format: table name, sky area (square degrees) and file format,
+		if the file does not give them
+	"""
+	input_table = tableio.open_table(filename, name=name, area=area, format=format)
+	table_name = input_table.name
+	assert table_name, 'file "%s" does not give a table name (EXTNAME). Use --table-name %s <name>' % (filename, filename)
+	assert input_table.area is not None, 'file "%s", table "%s" does not have a field "SKYAREA". Use --sky-area %s <area>' % (filename, table_name, filename)
+	data = input_table.data
+	if pos_error[0] == ':':
+		assert ':' not in pos_error[1:], 'only circular position errors (one column) are supported: "%s"' % pos_error
+		error = data[pos_error[1:]]
+	else:
+		error = float(pos_error)
+	mags = [(mag.split(':', 1)[1], magfile) for mag, magfile in mags if mag.split(':', 1)[0] == table_name]
+	table = dict(name=table_name, area=input_table.area, error=error,
+		ra=data[match.get_tablekeys(data, 'RA', tablename=table_name)],
+		dec=data[match.get_tablekeys(data, 'DEC', tablename=table_name)],
+		mags=[data[col_name] for col_name, magfile in mags], magnames=[col_name for col_name, magfile in mags],
+		maghists=[tuple(numpy.loadtxt(magfile, ndmin=2).transpose()) for col_name, magfile in mags])
+	return Catalogue(table, match_radius)
+
+def _as_arrays(table):
+	# positions and errors as float arrays, also for a single error value
+	table = dict(table)
+	table['ra'] = numpy.atleast_1d(numpy.asarray(table['ra'], dtype=float))
+	table['dec'] = numpy.atleast_1d(numpy.asarray(table['dec'], dtype=float))
+	table['error'] = numpy.broadcast_to(numpy.asarray(table['error'], dtype=float), table['ra'].shape)
+	return table
+
+def _fixed_source_biases(table):
+	# the magnitude bias of each source, from the given histograms
+	source_biases = OrderedDict()
+	for magvals, maghist, magname in zip(table.get('mags', []), table.get('maghists', []), table.get('magnames', [])):
+		assert maghist is not None, 'the magnitude histogram of "%s:%s" has to be given' % (table['name'], magname)
+		bins_lo, bins_hi, hist_sel, hist_all = maghist
+		bins = numpy.array(list(bins_lo) + [bins_hi[-1]])
+		source_biases['%s_%s' % (table['name'], magname)] = _source_log_biases(numpy.asarray(magvals, dtype=float), bins, hist_sel, hist_all)
+	return source_biases
+
+def match_batch(primary, catalogues, prior_completeness,
+	prob_ratio_secondary=0.5, min_prob=0., consider_unrelated_associations=True,
+	logger=NullOutputLogger()):
+	"""
+	Match a batch of primary sources against catalogues kept in memory.
+	Gives the same result as nway_match of the batch with the full
+	secondary catalogues, without hashing the catalogues again.
+
+	primary: dict with the entries of a match_tables entry of nway_match
+		(name, ra, dec, error, area, and optionally mags, magnames, maghists,
+		with the histograms given). The area gives the density of the
+		primary catalogue the batch is taken from.
+	catalogues: list of Catalogue, all for the same match_radius
+
+	The other arguments are those of nway_match.
+	"""
+	match_radius = catalogues[0].match_radius
+	assert all([c.match_radius == match_radius for c in catalogues]), 'the catalogues are indexed for different match radii'
+	primary = _as_arrays(primary)
+	match_tables = [primary] + [c.table for c in catalogues]
+	source_densities, source_densities_plus = _compute_source_densities(match_tables, logger=logger)
+
+	# candidates from the spatial index of each catalogue
+	pairs = [c.index.pairs(primary['ra'], primary['dec'])[:2] for c in catalogues]
+	resultstable = match.combine_candidates(len(primary['ra']), pairs)
+	table, prior = _compute_distance_log_bf(match_tables, match_radius, None, None, source_densities, source_densities_plus,
+		prior_completeness, consider_unrelated_associations, logger=logger, resultstable=resultstable)
+	table = table.assign(dist_post=bayesdist.posterior(prior, table['dist_bayesfactor'].values))
+
+	biases = OrderedDict()
+	for t, source_biases in zip(match_tables, [_fixed_source_biases(primary)] + [c.source_biases for c in catalogues]):
+		biases.update(_gather_biases(source_biases, table[t['name']].values))
+	table, total = _assign_biases(table, biases)
+
+	table = _compute_final_probabilities(match_tables, table, prob_ratio_secondary, prior, total, logger=logger)
+	return _truncate_table(table, min_prob, logger=logger)
+
+def match_sources(ra, dec, error, catalogues, prior_completeness, primary_density,
+	name='PRIMARY', prob_ratio_secondary=0.5, min_prob=0., correct_unrelated_associations=False):
+	"""
+	Match a few primary sources against catalogues kept in memory, with
+	numpy only (no pandas table), for a low latency per call.
+	Gives the same result as match_batch, as a dict of columns.
+
+	ra, dec, error: positions (degrees) and position errors (arcsec)
+		of the primary sources, arrays or single values
+	catalogues: list of Catalogue, all for the same match_radius
+	primary_density: number of sources per square degree of the
+		primary catalogue the sources are taken from
+	name: name of the primary catalogue (output column of the source numbers)
+	correct_unrelated_associations: correct the distance Bayes factors of
+		associations lacking several catalogues for unrelated associations
+		among the sources of those catalogues, as nway.py does. nway_match
+		and match_batch do not change the Bayes factors there.
+
+	The other arguments are those of nway_match. Magnitude biases of
+	the primary sources are not supported.
+	Returns an OrderedDict of the columns of the nway_match result.
+	"""
+	match_radius = catalogues[0].match_radius
+	assert all([c.match_radius == match_radius for c in catalogues]), 'the catalogues are indexed for different match radii'
+	ra = numpy.atleast_1d(numpy.asarray(ra, dtype=float))
+	dec = numpy.atleast_1d(numpy.asarray(dec, dtype=float))
+	error = numpy.broadcast_to(numpy.asarray(error, dtype=float), ra.shape)
+	assert len(ra) == len(dec) > 0, 'ra and dec should be non-empty and of the same length'
+	names = [name] + [c.name for c in catalogues]
+	ratables = [(ra, dec)] + [(c.table['ra'], c.table['dec']) for c in catalogues]
+	errortables = [error] + [c.table['error'] for c in catalogues]
+	area_total = (4 * pi * (180 / pi)**2)
+	source_densities = numpy.array([primary_density * area_total] + [len(c) / (c.table['area'] * 1.0) * area_total for c in catalogues])
+	source_densities_plus = numpy.array([primary_density * area_total] + [(len(c) + 1) / (c.table['area'] * 1.0) * area_total for c in catalogues])
+
+	# all indexes have the same pixels, which are looked up once
+	cells = catalogues[0].index.cells(ra, dec)
+	resultstable = match.combine_candidates(len(ra), [c.index.pairs(ra, dec, cells)[:2] for c in catalogues])
+	ncats = len(names)
+	columns = OrderedDict([(n, resultstable[:,i]) for i, n in enumerate(names)])
+	errors = [e[resultstable[:,i]] for i, e in enumerate(errortables)]
+	invalid_separations = numpy.ones(len(resultstable)) * numpy.nan
+	separations = [[invalid_separations] * ncats for i in range(ncats)]
+	max_separation = numpy.zeros(len(resultstable))
+	for i in range(ncats):
+		a_ra, a_dec = ratables[i][0][resultstable[:,i]], ratables[i][1][resultstable[:,i]]
+		for j in range(i + 1, ncats):
+			b_ra, b_dec = ratables[j][0][resultstable[:,j]], ratables[j][1][resultstable[:,j]]
+			col = match.dist((a_ra, a_dec), (b_ra, b_dec))
+			col[(resultstable[:,i] == -1) | (resultstable[:,j] == -1) | (a_ra == -99) | (b_ra == -99)] = numpy.nan
+			col_arcsec = col * 60 * 60
+			columns['Separation_%s_%s' % (names[i], names[j])] = col_arcsec
+			max_separation = numpy.fmax(col_arcsec, max_separation)
+			separations[i][j] = col_arcsec
+	columns['Separation_max'] = max_separation
+	columns['ncat'] = (resultstable > -1).sum(axis=1)
+
+	mask = max_separation < match_radius
+	columns = OrderedDict([(k, v[mask]) for k, v in columns.items()])
+	errors = [e[mask] for e in errors]
+	separations = [[cell[mask] for cell in row] for row in separations]
+	resultstable = resultstable[mask,:]
+
+	# all combinations of present catalogues at once, instead of one case after the other
+	present = [columns[name] >= 0] + [~numpy.isnan(sep) for sep in separations[0][1:]]
+	log_bf = bayesdist.log_bf_present(separations, errors, present)
+	prior_completeness = _expand_prior_completeness(prior_completeness, ncats)
+	completeness = numpy.ones(len(log_bf))
+	densities_plus = source_densities_plus[0] * numpy.ones(len(log_bf))
+	for i in range(1, ncats):
+		completeness = completeness * numpy.where(present[i], prior_completeness[i], 1)
+		densities_plus = densities_plus * numpy.where(present[i], source_densities_plus[i], 1)
+	prior = source_densities[0] * completeness / densities_plus
+	columns['dist_bayesfactor_uncorrected'] = log_bf
+	if correct_unrelated_associations:
+		log_bf = log_bf + _unrelated_log_post(separations, errors, present, tableio.group_starts(resultstable[:,0]),
+			source_densities, source_densities_plus)
+	columns['dist_bayesfactor'] = log_bf
+	columns['dist_post'] = bayesdist.posterior(prior, log_bf)
+
+	biases = OrderedDict()
+	for i, c in enumerate(catalogues):
+		biases.update(_gather_biases(c.source_biases, resultstable[:,i+1]))
+	for col, weights in biases.items():
+		columns['bias_%s' % col] = 10**weights
+	total = log_bf + sum(biases.values())
+
+	columns['p_single'] = bayesdist.posterior(prior, total)
+	log_post_weight = bayesdist.unnormalised_log_posterior(prior, total, columns['ncat'])
+	group_start = tableio.group_starts(resultstable[:,0])
+	p_any, p_i, match_flag = bayesdist.group_posteriors(log_post_weight, group_start, prob_ratio_secondary)
+	columns['match_flag'] = match_flag
+	columns['prob_has_match'] = p_any
+	columns['prob_this_match'] = p_i
+
+	if min_prob > 0:
+		mask = ~(p_i < min_prob)
+		columns = OrderedDict([(k, v[mask]) for k, v in columns.items()])
+	return columns
+
+def _unrelated_log_post(separations, errors, present, group_start, source_densities, source_densities_plus):
+	# for each association lacking two or more catalogues, the largest log posterior
+	# (if positive) of the sources of those catalogues in another association
+	# of the same primary source being related (see nway.py)
+	ncats = len(present)
+	n = len(present[0])
+	ncat = numpy.sum(present, axis=0)
+	sizes = numpy.diff(numpy.append(group_start, n))
+	group = numpy.repeat(numpy.arange(len(group_start)), sizes)
+	# pair each of those with the associations of its primary source
+	i = numpy.where(ncat <= ncats - 2)[0]
+	counts = sizes[group[i]]
+	pi = numpy.repeat(i, counts)
+	pj = numpy.repeat(group_start[group[i]] - (numpy.cumsum(counts) - counts), counts) + numpy.arange(counts.sum())
+	augmented = [numpy.zeros(len(pi), dtype=bool)] + [~present[k][pi] & present[k][pj] for k in range(1, ncats)]
+	useful = numpy.logical_and(ncat[pj] > 2, numpy.sum(augmented, axis=0) >= 2)
+	pi, pj = pi[useful], pj[useful]
+	augmented = [a[useful] for a in augmented]
+	log_bf = bayesdist.log_bf_present([[cell[pj] for cell in row] for row in separations], [e[pj] for e in errors], augmented)
+	densities_plus = numpy.ones(len(pj))
+	for k in range(1, ncats):
+		densities_plus = densities_plus * numpy.where(augmented[k], source_densities_plus[k], 1)
+	prior = source_densities[numpy.argmax(augmented, axis=0)] / densities_plus
+	best = numpy.zeros(n)
+	numpy.maximum.at(best, pi, bayesdist.unnormalised_log_posterior(prior, log_bf, numpy.sum(augmented, axis=0)))
+	return best
+
+def match_one(ra, dec, error, catalogues, prior_completeness, primary_density, **kwargs):
+	"""
+	Match a single primary source (ra, dec in degrees, error in arcsec)
+	against catalogues kept in memory. See match_sources for the arguments.
+
+	Returns an OrderedDict of the columns of the nway_match result,
+	one row for each association of the source.
+	"""
+	assert numpy.shape(ra) == numpy.shape(dec) == numpy.shape(error) == (), 'match_one takes a single position, use match_sources for several'
+	return match_sources(ra, dec, error, catalogues, prior_completeness, primary_density, **kwargs)
+
+
+def _compute_distance_log_bf(match_tables, match_radius, adaptive_radius, max_candidates, source_densities, source_densities_plus, prior_completeness, consider_unrelated_associations, logger, resultstable=None):
 	ncats = len(match_tables)
 	
-	table, resultstable, separations, errors = _create_match_table(match_tables, match_radius, logger=logger)
+	table, resultstable, separations, errors = _create_match_table(match_tables, match_radius, adaptive_radius, max_candidates, logger=logger, resultstable=resultstable)
 
 	if not len(table) > 0:
 		raise EmptyResultException('No matches.')
 	
-	source_densities, source_densities_plus = _compute_source_densities(match_tables, logger=logger)
-
 	# first pass: find secure matches and secure non-matches
 
 	prior, log_bf = _compute_single_log_bf(match_tables, source_densities, source_densities_plus, table, separations, errors, prior_completeness, logger=logger)
@@ -95,28 +463,80 @@ def nway_match(match_tables, match_radius, prior_completeness,
 	
 	if consider_unrelated_associations:
 		_correct_unrelated_associations(table, separations, errors, ncats, source_densities, source_densities_plus, logger=logger)
-		log_bf = table['dist_bayesfactor']
-
-	# add the additional columns
-	post = bayesdist.posterior(prior, log_bf)
-	table = table.assign(dist_post=post)
-
-	# find magnitude biasing functions
-	table, total = _apply_magnitude_biasing(match_tables, table, mag_include_radius, mag_exclude_radius, magauto_post_single_minvalue, store_mag_hists, logger=logger)
-
-	table = _compute_final_probabilities(match_tables, table, prob_ratio_secondary, prior, total, logger=logger)
-	
-	table = _truncate_table(table, min_prob, logger=logger)
-	
-	return table
-
+	return table, prior
+
+def _compute_tile_log_bf(columns, names, rows, args, logger=NullOutputLogger()):
+	# columns: ra, dec and error of each catalogue, by "<name>:<column>"
+	tile_tables = [dict(name=name, ra=columns[name + ':ra'][r], dec=columns[name + ':dec'][r], error=columns[name + ':error'][r])
+		for name, r in zip(names, rows)]
+	table, prior = _compute_distance_log_bf(tile_tables, *args, logger=logger)
+	# refer to rows of the full catalogues (-1 stays -1)
+	for name, r in zip(names, rows):
+		table[name] = numpy.append(r, -1)[table[name].values]
+	return table, prior
+
+def _compute_tile_log_bf_shared(task):
+	# in worker processes, the catalogue columns come from the shared store
+	handles, names, rows, args = task
+	return _compute_tile_log_bf(sharedstore.attach(handles), names, rows, args)
+
+def _compute_distance_log_bf_footprint(match_tables, match_radius, adaptive_radius, max_candidates, source_densities, source_densities_plus, prior_completeness, consider_unrelated_associations, logger):
+	logger.log('computing the footprint of the primary catalogue ...')
+	moc, rows = footprint.rows_in_footprint([(t['ra'], t['dec']) for t in match_tables], match_radius / 60. / 60)
+	logger.log('    footprint area: %.3f square degrees' % footprint.area(moc))
+	for t, r in zip(match_tables[1:], rows[1:]):
+		logger.log('    %s: %d of %d sources within the footprint' % (t['name'], len(r), len(t['ra'])))
+	columns = dict([('%s:%s' % (t['name'], k), numpy.asarray(t[k])) for t in match_tables for k in ('ra', 'dec', 'error')])
+	args = (match_radius, adaptive_radius, max_candidates, source_densities, source_densities_plus, prior_completeness, consider_unrelated_associations)
+	return _compute_tile_log_bf(columns, [t['name'] for t in match_tables], rows, args, logger=logger)
+
+def _compute_distance_log_bf_tiled(match_tables, match_radius, adaptive_radius, max_candidates, tile_nside, source_densities, source_densities_plus, prior_completeness, consider_unrelated_associations, processes, logger):
+	logger.log('splitting the sky into tiles (nside=%d) ...' % tile_nside)
+	radectables = [(t['ra'], t['dec']) for t in match_tables]
+	tiles = list(tiling.iter_tiles(radectables, match_radius / 60. / 60, tile_nside))
+	logger.log('matching %d tiles with primary sources ...' % len(tiles))
+	names = [t['name'] for t in match_tables]
+	args = (match_radius, adaptive_radius, max_candidates, source_densities, source_densities_plus, prior_completeness, consider_unrelated_associations)
+	pbar = logger.progress()
+	if processes == 1:
+		columns = dict([('%s:%s' % (t['name'], k), t[k]) for t in match_tables for k in ('ra', 'dec', 'error')])
+		results = [_compute_tile_log_bf(columns, names, rows, args) for tile, rows in pbar(tiles)]
+	else:
+		with sharedstore.SharedArrays() as store:
+			for t in match_tables:
+				for k in 'ra', 'dec', 'error':
+					store.publish('%s:%s' % (t['name'], k), numpy.asarray(t[k]))
+			pool = multiprocessing.Pool(processes)
+			try:
+				tasks = [(store.handles, names, rows, args) for tile, rows in tiles]
+				results = list(pbar(pool.imap(_compute_tile_log_bf_shared, tasks)))
+			finally:
+				pool.close()
+				pool.join()
+	if len(results) == 0:
+		raise EmptyResultException('No matches.')
+	return pandas.concat([table for table, prior in results], ignore_index=True), numpy.concatenate([prior for table, prior in results])
 
-def _create_match_table(match_tables, match_radius, logger):
+def _create_match_table(match_tables, match_radius, adaptive_radius, max_candidates, logger, resultstable=None):
 	# first match input catalogues, compute possible combinations in match_radius
+	# (unless given, e.g. from the candidates found with a SkyIndex)
 	ratables = [(t['ra'], t['dec']) for t in match_tables]
 	table_names = [t['name'] for t in match_tables]
 
-	resultstable = match.crossproduct(ratables, match_radius / 60. / 60, logger=logger)
+	pairwise_errs = []
+	pair_radius = None
+	if adaptive_radius is not None:
+		pairwise_errs = match.adaptive_pair_radii([numpy.max(t['error'], initial=0) for t in match_tables], 
+			adaptive_radius[0], adaptive_radius[1], match_radius)
+		pair_radius = (adaptive_radius[0], adaptive_radius[1], [t['error'] for t in match_tables])
+	if resultstable is not None:
+		pass
+	elif max_candidates is not None:
+		resultstable = match.capped_crossproduct(ratables, match_radius / 60. / 60, [t['error'] for t in match_tables],
+			max_candidates, logger=logger, pairwise_errs=pairwise_errs, pair_radius=pair_radius)
+	else:
+		resultstable = match.crossproduct(ratables, match_radius / 60. / 60, logger=logger, pairwise_errs=pairwise_errs,
+			pair_radius=pair_radius)
 	#results = resultstable.view(dtype=[(t['name'], resultstable.dtype) for t in match_tables]).reshape((-1,))
 	nresults = len(resultstable)
 	keys = []
@@ -131,6 +551,7 @@ def _create_match_table(match_tables, match_radius, logger):
 	invalid_separations = numpy.ones(nresults) * numpy.nan
 	logger.log('    adding angular separation columns')
 	max_separation = numpy.zeros(nresults)
+	within_radius = numpy.ones(nresults, dtype=bool)
 	for i in range(len(match_tables)):
 		a_ra  = ratables[i][0][resultstable[:,i]]
 		a_dec = ratables[i][1][resultstable[:,i]]
@@ -155,6 +576,9 @@ def _create_match_table(match_tables, match_radius, logger):
 				keys.append("Separation_%s_%s" % (table_names[i], table_names[j]))
 				columns.append(col_arcsec)
 				max_separation = numpy.nanmax([col_arcsec, max_separation], axis=0)
+				if adaptive_radius is not None:
+					within_radius &= match.within_adaptive_radius(col_arcsec, errors[i], 
+						match_tables[j]['error'][resultstable[:,j]], adaptive_radius[0], adaptive_radius[1])
 				row.append(col_arcsec)
 			else:
 				# mark the upper right triangle of the matrix as invalid data
@@ -168,7 +592,7 @@ def _create_match_table(match_tables, match_radius, logger):
 	columns.append((resultstable > -1).sum(axis=1))
 
 	# now truncate all columns:
-	mask = max_separation < match_radius
+	mask = numpy.logical_and(max_separation < match_radius, within_radius)
 	columns = [c[mask] for c in columns]
 	errors = [e[mask] for e in errors]
 	separations = [[cell[mask] for cell in row] for row in separations]
@@ -206,19 +630,41 @@ def _compute_source_densities(match_tables, logger):
 	source_densities = numpy.array(source_densities)
 	return source_densities, source_densities_plus
 
-def _compute_single_log_bf(match_tables, source_densities, source_densities_plus, table, separations, errors, prior_completeness, logger):
-	logger.log('Computing distance-based probabilities ...')
+def _compute_prior(match_tables, source_densities, source_densities_plus, table, prior_completeness):
 	ncats = len(match_tables)
+	prior_completeness = _expand_prior_completeness(prior_completeness, ncats)
 
+	# the separation to the primary source is not defined for absent sources
+	present = [None] + [~numpy.isnan(table['Separation_%s_%s' % (match_tables[0]['name'], t['name'])].values) for t in match_tables[1:]]
+	prior = numpy.zeros(len(table)) * numpy.nan
+	# handle all cases (also those with missing counterparts in some catalogues)
+	for case in range(2**(ncats-1)):
+		table_mask = numpy.array([True] + [(case // 2**(ti)) % 2 == 0 for ti in range(len(match_tables)-1)])
+		# select those cases
+		mask = True
+		for i in range(1, len(match_tables)):
+			mask = numpy.logical_and(mask, present[i] == table_mask[i])
+		prior[mask] = source_densities[0] * numpy.product(prior_completeness[table_mask]) / numpy.product(source_densities_plus[table_mask])
+		assert numpy.isfinite(prior[mask]).all(), (source_densities, prior_completeness[table_mask], numpy.product(source_densities_plus[table_mask]))
+
+	assert numpy.isfinite(prior).all(), prior
+	return prior
+
+def _expand_prior_completeness(prior_completeness, ncats):
+	# one completeness for each catalogue
 	if numpy.shape(prior_completeness) == ():
 		prior_completeness = numpy.array([1.0] + [float(prior_completeness)**(1./(ncats-1)) for i in range(1, ncats)])
 	
 	if len(prior_completeness) != ncats:
 		raise Exception('Prior completeness needs one value per catalog. Received "%s".' % prior_completeness)
 	assert prior_completeness[0] == 1.0
+	return prior_completeness
+
+def _compute_single_log_bf(match_tables, source_densities, source_densities_plus, table, separations, errors, prior_completeness, logger):
+	logger.log('Computing distance-based probabilities ...')
+	ncats = len(match_tables)
 
 	log_bf = numpy.zeros(len(table)) * numpy.nan
-	prior = numpy.zeros(len(table)) * numpy.nan
 	# handle all cases (also those with missing counterparts in some catalogues)
 	for case in range(2**(ncats-1)):
 		table_mask = numpy.array([True] + [(case // 2**(ti)) % 2 == 0 for ti in range(len(match_tables)-1)])
@@ -240,12 +686,8 @@ def _compute_single_log_bf(match_tables, source_densities, source_densities_plus
 		assert r.shape == mask.sum(), (r.shape, mask.sum(), mask.shape)
 		log_bf[mask] = r
 
-		prior[mask] = source_densities[0] * numpy.product(prior_completeness[table_mask]) / numpy.product(source_densities_plus[table_mask])
-		assert numpy.isfinite(prior[mask]).all(), (source_densities, prior_completeness[table_mask], numpy.product(source_densities_plus[table_mask]))
-
-
-	assert numpy.isfinite(prior).all(), (prior, log_bf)
-	assert numpy.isfinite(log_bf).all(), (prior, log_bf)
+	assert numpy.isfinite(log_bf).all(), log_bf
+	prior = _compute_prior(match_tables, source_densities, source_densities_plus, table, prior_completeness)
 	return prior, log_bf
 
 def _correct_unrelated_associations(table, separations, errors, ncats, source_densities, source_densities_plus, logger):
@@ -289,17 +731,18 @@ def _correct_unrelated_associations(table, separations, errors, ncats, source_de
 		if best_logpost > 0:
 			group['dist_bayesfactor'] += best_logpost
 
-def _apply_magnitude_biasing(match_tables, table, mag_include_radius, mag_exclude_radius, magauto_post_single_minvalue, store_mag_hists, logger):
+def _apply_magnitude_biasing(match_tables, table, mag_include_radius, mag_exclude_radius, magauto_post_single_minvalue, store_mag_hists, logger, hist_cache=None):
 	biases = {}
 	for i, t in enumerate(match_tables):
 		table_name = t['name']
+		res = table[table.columns[i]].values
+		source_biases = OrderedDict()
 		for magvals, maghist, magname in zip(t['mags'], t['maghists'], t['magnames']):
 			col_name = magname
 			col = "%s_%s" % (table_name, col_name)
 			mag = "%s:%s" % (table_name, col_name)
 			logger.log('Incorporating bias "%s" ...' % mag)
 			
-			res = table[table.columns[i]].values
 			res_defined = res != -1
 			# get magnitudes of all
 			# mark -99 as undefined
@@ -309,8 +752,16 @@ def _apply_magnitude_biasing(match_tables, table, mag_include_radius, mag_exclud
 			# get magnitudes of selected
 			mask_all = numpy.isfinite(mag_all)
 			
-		
-			if maghist is None:
+			hist_key = None
+			if maghist is None and hist_cache is not None:
+				cache, match_key = hist_cache
+				hist_key = histcache.fingerprint(match_key, mag, mag_all, mag_include_radius, mag_exclude_radius, magauto_post_single_minvalue)
+				cached = cache.load(hist_key)
+			
+			if hist_key is not None and cached is not None:
+				logger.log('magnitude histogramming: using cached histogram "%s" for "%s"' % (cache.path(hist_key), col))
+				bins, hist_sel, hist_all = cached
+			elif maghist is None:
 				if mag_include_radius is not None:
 					selection = table['Separation_max'].values < mag_include_radius
 					selection_possible = table['Separation_max'].values < mag_exclude_radius
@@ -355,28 +806,41 @@ def _apply_magnitude_biasing(match_tables, table, mag_include_radius, mag_exclud
 				bins, hist_sel, hist_all = magnitudeweights.adaptive_histograms(mag_all[mask_others], mag_sel[mask_sel], weights=mag_sel_weights[mask_sel])
 				if store_mag_hists:
 					logger.log('magnitude histogram stored to "%s".' % (mag.replace(':', '_') + '_fit.txt'))
-					with open(mag.replace(':', '_') + '_fit.txt', 'wb') as f:
-						f.write(b'# lo hi selected others\n')
-						numpy.savetxt(f,
-							numpy.transpose([bins[:-1], bins[1:], hist_sel, hist_all]), 
-							fmt = ["%10.5f"]*4)
+					histcache.write_histogram(mag.replace(':', '_') + '_fit.txt', bins, hist_sel, hist_all)
 				if mask_sel.sum() < 100:
 					raise UndersampledException('ERROR: too few secure matches (%d) to make a good histogram. If you are sure you want to use this poorly sampled histogram, replace "auto" with the filename. You can also decrease the mag-auto-minprob parameter.' % mask_sel.sum())
+				if hist_key is not None:
+					logger.log('magnitude histogram cached as "%s".' % cache.store(hist_key, bins, hist_sel, hist_all))
 			else:
 				logger.log('magnitude histogramming: using user-supplied histogram for "%s"' % (col))
 				bins_lo, bins_hi, hist_sel, hist_all = maghist #numpy.loadtxt(magfile).transpose()
 				bins = numpy.array(list(bins_lo) + [bins_hi[-1]])
-			func = magnitudeweights.fitfunc_histogram(bins, hist_sel, hist_all)
 			if store_mag_hists:
+				func = magnitudeweights.fitfunc_histogram(bins, hist_sel, hist_all)
 				magnitudeweights.plot_fit(bins, hist_sel, hist_all, func, mag)
-			magcol = magvals[res]
-			magcol[~numpy.logical_and(res_defined, numpy.isfinite(magcol))] = -99
-			#magcol[~res_defined] = -99
-			weights = log10(func(magcol))
-			# undefined magnitudes do not contribute
-			weights[numpy.isnan(weights)] = 0
-			biases[col] = weights
-
+			source_biases[col] = _source_log_biases(magvals, bins, hist_sel, hist_all)
+		
+		biases.update(_gather_biases(source_biases, res))
+
+	return _assign_biases(table, biases)
+
+def _source_log_biases(magvals, bins, hist_sel, hist_all):
+	# evaluate once per source; undefined magnitudes and
+	# missing counterparts (the last entry) are looked up as -99
+	source_mags = numpy.append(numpy.where(numpy.isfinite(magvals), magvals, -99), -99)
+	return magnitudeweights.log_bias(bins, 
+		magnitudeweights.log_bias_table(bins, hist_sel, hist_all), source_mags)
+
+def _gather_biases(source_biases, res):
+	# gather the biases of all columns of a catalogue at once
+	biases = OrderedDict()
+	if source_biases:
+		weights = numpy.transpose(list(source_biases.values()))[res]
+		for j, col in enumerate(source_biases.keys()):
+			biases[col] = weights[:,j]
+	return biases
+
+def _assign_biases(table, biases):
 	# add the bias columns
 	table = table.assign(**{'bias_%s' % col:10**weights for col, weights in biases.items()})
 	log_bf = table['dist_bayesfactor'].values
@@ -396,55 +860,20 @@ def _compute_final_probabilities(match_tables, table, prob_ratio_secondary, prio
 	# 4pi comes from Eq. 
 	ncat = table['ncat'].values
 	log_post_weight = bayesdist.unnormalised_log_posterior(prior, total, ncat)
-	table = table.assign(log_post_weight=log_post_weight)
 
 	# flagging of solutions. Go through groups by primary id (IDs in first catalogue)
-
+	logger.log('    grouping by primary catalogue ID and flagging ...')
+	primary_id = table[table.columns[0]].values
+	group_start = tableio.group_starts(primary_id)
+	assert len(group_start) == len(numpy.unique(primary_id)), 'associations of a primary source are not contiguous'
+	# for p_any, the first of each group is the one without counterparts
+	assert (ncat[group_start] == 1).all(), ncat[group_start]
+	p_any, p_i, match_flag = bayesdist.group_posteriors(log_post_weight, group_start, prob_ratio_secondary)
 	table = table.assign(
-		match_flag = numpy.zeros(len(table), dtype=int),
-		prob_has_match = numpy.zeros(len(table)),
-		prob_this_match = numpy.zeros(len(table)),
+		match_flag = match_flag,
+		prob_has_match = p_any,
+		prob_this_match = p_i,
 	)
-
-	logger.log('    grouping by primary catalogue ID and flagging ...')
-
-	def compute_group_statistics(group):
-		# group
-		# compute no-match probability
-		values = group['log_post_weight'].values
-		#values = grpvalues.values
-		offset = values.max()
-		bfsum = log10((10**(values - offset)).sum()) + offset
-		if len(values) > 1:
-			offset = values[1:].max()
-			bfsum1 = log10((10**(values[1:] - offset)).sum()) + offset
-		else:
-			bfsum1 = 0
-		assert group['ncat'].values[0] == 1, group['ncat']
-		#print(group['ncat'].values[0])
-		# for p_any, find the one without counterparts
-		p_none = values[0]
-		p_any = 1 - 10**(p_none - bfsum)
-		# this avoids overflows in the no-counterpart solution, 
-		# which we want to set to 0
-		values[0] = bfsum1
-		p_i = 10**(values - bfsum1)
-		p_i[0] = 0
-		
-		best_val = p_i.max()
-		
-		# flag best & second best
-		# ignore very poor solutions
-		match_flag = numpy.where(best_val == p_i, 1, 
-			numpy.where(p_i > prob_ratio_secondary * best_val, 2, 0))
-		
-		group['prob_has_match'] = p_any
-		group['prob_this_match'] = p_i
-		group['match_flag'] = match_flag
-		return group
-
-	table = table.groupby(table.columns[0], sort=False).apply(compute_group_statistics)
-	del table['log_post_weight']
 	return table
 
 def _truncate_table(table, min_prob, logger):
@@ -456,4 +885,28 @@ def _truncate_table(table, min_prob, logger):
 
 	return table
 
-
+def join_columns(table, table_name, catalogue, columns=None):
+	"""
+	Attach columns of an input catalogue to a nway_match result.
+	
+	table: nway_match result
+	table_name: name of the catalogue (the column in table holding its row numbers)
+	catalogue: input catalogue (structured array, FITS table or DataFrame)
+	columns: names of the columns to attach (default: all)
+	
+	The new columns are named <table_name>_<column>. Where the
+	catalogue does not participate in an association, the value is -99.
+	"""
+	indices = table[table_name].values
+	mask_missing = indices == -1
+	if columns is None:
+		columns = catalogue.dtype.names if hasattr(catalogue, 'dtype') else list(catalogue.columns)
+	new_columns = OrderedDict()
+	for col_name in columns:
+		col = numpy.asarray(catalogue[col_name])[indices]
+		if not col.dtype.isnative:
+			# FITS columns are big-endian, which pandas does not support
+			col = col.astype(col.dtype.newbyteorder('='))
+		col[mask_missing] = -99
+		new_columns['%s_%s' % (table_name, col_name)] = col
+	return table.assign(**new_columns)
@@ -34,6 +34,39 @@ def unnormalised_log_posterior(prior, log_bf, ncat):
 	"""
 	return log_bf + log10(prior)
 
+def group_posteriors(log_post_weight, group_start, prob_ratio_secondary):
+	"""
+	Returns the probability that the primary source has any counterpart (p_any),
+	the relative probability of each association (p_i) and the match flag
+	(1 for the most probable association, 2 for those with at least
+	prob_ratio_secondary times its probability, otherwise 0), for all
+	groups at once.
+
+	log_post_weight: unnormalised log posterior of each association
+	group_start: index of the first association of each primary source,
+		which is the one without counterparts
+	"""
+	log_post_weight = numpy.asarray(log_post_weight, dtype=float)
+	n = len(log_post_weight)
+	sizes = numpy.diff(numpy.append(group_start, n))
+	group = numpy.repeat(numpy.arange(len(group_start)), sizes)
+	first = numpy.zeros(n, dtype=bool)
+	first[group_start] = True
+	# normalise over all associations, and over those with counterparts
+	offset = numpy.maximum.reduceat(log_post_weight, group_start)
+	bfsum = log10(numpy.add.reduceat(10**(log_post_weight - offset[group]), group_start)) + offset
+	values1 = numpy.where(first, -numpy.inf, log_post_weight)
+	offset1 = numpy.where(sizes > 1, numpy.maximum.reduceat(values1, group_start), 0)
+	with numpy.errstate(divide='ignore', invalid='ignore'):
+		bfsum1 = numpy.where(sizes > 1,
+			log10(numpy.add.reduceat(10**(values1 - offset1[group]), group_start)) + offset1, 0)
+	p_any = 1 - 10**(log_post_weight[group_start] - bfsum)
+	p_i = numpy.where(first, 0, 10**(values1 - bfsum1[group]))
+	best_val = numpy.maximum.reduceat(p_i, group_start)[group]
+	match_flag = numpy.where(best_val == p_i, 1,
+		numpy.where(p_i > prob_ratio_secondary * best_val, 2, 0))
+	return p_any[group], p_i, match_flag
+
 
 def log_bf2(psi, s1, s2):
 	"""
@@ -78,6 +111,31 @@ def log_bf(p, s):
 	exponent = - q / 2 / wsum
 	return (norm + s + exponent) * log10(e)
 
+def log_bf_present(p, s, present):
+	"""
+	log10 of the multi-way Bayes factor (see log_bf) of the sources
+	present in each association, for associations of different
+	catalogues at once.
+
+	p: separations matrix (NxN matrix of arrays)
+	s: errors (list of N arrays)
+	present: list of N boolean arrays
+	"""
+	# absent sources have no weight
+	w = [numpy.where(m, numpy.asarray(si, dtype=float)**-2., 0) for si, m in zip(s, present)]
+	n = numpy.sum(present, axis=0)
+	norm = (n - 1) * log(2) + 2 * (n - 1) * log_arcsec2rad
+
+	wsum = numpy.sum(w, axis=0)
+	s = numpy.sum([log(numpy.where(m, wi, 1)) for wi, m in zip(w, present)], axis=0) - log(wsum)
+	q = 0
+	for i, wi in enumerate(w):
+		for j, wj in enumerate(w):
+			if i < j:
+				q += numpy.where(present[i] & present[j], wi * wj * p[i][j]**2, 0)
+	exponent = - q / 2 / wsum
+	return (norm + s + exponent) * log10(e)
+
 # vectorized in the following means that many 2D matrices/vectors are going to be handled.
 # i.e., each entry in the matrix or vector, is a vector of numbers.
 
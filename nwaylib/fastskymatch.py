@@ -15,6 +15,9 @@ from numpy import sin, cos, arctan2, hypot, arccos, arcsin, pi, exp, log
 import healpy
 import tqdm
 import joblib
+from . import tableio
+from .logger import NullOutputLogger
+from .scratch import ScratchSpace
 cachedir = 'cache'
 if not os.path.isdir(cachedir): os.mkdir(cachedir)
 mem = joblib.Memory(cachedir=cachedir, verbose=False)
@@ -81,37 +84,185 @@ def get_healpix_resolution_degrees(nside):
 	resfactor = 0.7
 	return resfactor * resol
 
-@mem.cache(ignore=['logger'])
-def crossproduct(radectables, err, logger, pairwise_errs=[]):
-	# check if away from the poles and RA=0
-	use_flat_bins = True
+def get_healpix_nside(err):
+	"""
+	choose appropriate nside for err (in deg): sources within err 
+	of each other are in the same or in neighbouring pixels.
+	"""
+	nside = 1
+	for nside_next in range(30): 
+		# largest distance still contained within pixels
+		dist_neighbors_complete = get_healpix_resolution_degrees(2**nside_next)
+		# we are looking for a pixel size which ensures bigger distances than the error radius
+		# but we want the smallest pixels possible, to reduce the cartesian product
+		if dist_neighbors_complete < err:
+			# too small, do not accept
+			# sources within err will be outside the neighbor pixels
+			break
+		nside = 2**nside_next
+	return nside
+
+def adaptive_pair_radii(max_errors, k, floor, radius):
+	"""
+	Pre-filter radii for pairs of catalogues with an adaptive search radius
+	k * sqrt(error_i**2 + error_j**2) + floor (all in arcsec).
+	
+	max_errors: largest positional error of each catalogue
+	radius: largest search radius
+	
+	Returns (i, j, radius_ij) for each pair of catalogues i < j whose
+	sources can not be further apart than radius_ij < radius.
+	"""
+	pairs = []
+	for i in range(len(max_errors)):
+		for j in range(i + 1, len(max_errors)):
+			radius_ij = k * (max_errors[i]**2 + max_errors[j]**2)**0.5 + floor
+			if radius_ij < radius:
+				pairs.append((i, j, radius_ij))
+	return pairs
+
+def within_adaptive_radius(separation, errors_i, errors_j, k, floor):
+	"""
+	Whether the separation (arcsec) is within k * sqrt(errors_i**2 + errors_j**2) + floor.
+	Missing separations (nan) are within.
+	"""
+	with numpy.errstate(invalid='ignore'):
+		return ~(separation > k * numpy.sqrt(errors_i**2 + errors_j**2) + floor)
+
+def within_pair_radii(combinations, radectables, pairwise_errs=[], pair_radius=None):
+	"""
+	Whether the sources of each combination (rows, -1 if absent) are
+	within the pair-wise radii: radius_ij (arcsec) of the pairs of
+	catalogues (i, j, radius_ij) in pairwise_errs, and the adaptive search
+	radius pair_radius (k, floor, errors) of each pair of sources, with
+	errors of each catalogue a value or one per row (see within_adaptive_radius).
+	"""
+	mask = numpy.ones(len(combinations), dtype=bool)
+	pairs = list(pairwise_errs)
+	if pair_radius is not None:
+		k, floor, errors = pair_radius
+		pairs += [(i, j, None) for i in range(len(radectables)) for j in range(i + 1, len(radectables))]
+	for tablei, tablej, errij in pairs:
+		indicesi = combinations[:,tablei]
+		indicesj = combinations[:,tablej]
+		# only entries (still kept) that have both sources
+		mask_both = mask & (indicesi >= 0) & (indicesj >= 0)
+		indicesi, indicesj = indicesi[mask_both], indicesj[mask_both]
+		rai, deci = radectables[tablei]
+		raj, decj = radectables[tablej]
+		separation = dist((rai[indicesi], deci[indicesi]), (raj[indicesj], decj[indicesj])) * 60 * 60
+		if errij is not None:
+			mask[mask_both] = separation < errij
+		else:
+			errors_i, errors_j = [e if numpy.ndim(e) == 0 else e[idx] for e, idx in ((errors[tablei], indicesi), (errors[tablej], indicesj))]
+			mask[mask_both] = within_adaptive_radius(separation, errors_i, errors_j, k, floor)
+	return mask
+
+# buckets giving more combinations are subdivided
+default_max_bucket_product = 10000
+
+def can_use_flat_bins(radectables, err):
+	"""
+	whether all sources are away from the poles and RA=0, 
+	so that the flat-sky approximation can be used for hashing.
+	"""
 	for ra, dec in radectables:
 		if not(err < 1 and (ra > 10*err).all() and (ra < 360-10*err).all() and (numpy.abs(dec) < 45).all()):
-			use_flat_bins = False
-			break
+			return False
+	return True
+
+def unit_vectors(ra, dec):
+	"""
+	Cartesian coordinates (n, 3) of positions on the unit sphere (in degrees).
+	"""
+	phi = numpy.asarray(ra, dtype=float) / 180 * pi
+	theta = numpy.asarray(dec, dtype=float) / 180 * pi
+	return numpy.transpose([cos(theta) * cos(phi), cos(theta) * sin(phi), sin(theta)])
+
+def subdivide_bucket(positions, lists, chord, max_product):
+	"""
+	Splits a crowded bucket into parts with smaller cartesian products.
+	
+	The primary sources are split recursively in half along the
+	direction of largest extent, until the product of a part is at most
+	max_product or it holds a single primary source. Each part keeps the
+	secondary sources within the chord distance of the bounding box of
+	its primary sources, so no combination within the match radius is lost.
+	
+	positions: for each catalogue, the unit vectors of the sources in the bucket
+	lists: for each catalogue, the row numbers of the sources in the bucket
+	chord: chord length corresponding to the match radius
+	
+	Returns a list of parts, each a list of row numbers for each catalogue.
+	"""
+	lo = positions[0].min(axis=0)
+	hi = positions[0].max(axis=0)
+	keep = [numpy.ones(len(positions[0]), dtype=bool)] + [
+		((numpy.maximum(0, numpy.maximum(lo - p, p - hi)))**2).sum(axis=1) <= chord**2
+		for p in positions[1:]]
+	positions = [p[k] for p, k in zip(positions, keep)]
+	lists = [l[k] for l, k in zip(lists, keep)]
+	nproduct = len(lists[0])
+	for l in lists[1:]:
+		nproduct *= len(l) + 1
+	if nproduct <= max_product or len(lists[0]) == 1:
+		return [lists]
+	axis = numpy.argmax(hi - lo)
+	order = numpy.argsort(positions[0][:,axis])
+	half = len(order) // 2
+	parts = []
+	for selected in order[:half], order[half:]:
+		parts += subdivide_bucket([positions[0][selected]] + positions[1:], 
+			[lists[0][selected]] + lists[1:], chord, max_product)
+	return parts
+
+def log_bucket_occupancy(occupancy, products, max_product, logger):
+	"""
+	Reports how many sources of each catalogue the buckets hold, and
+	how much the most crowded buckets contribute to the cartesian products.
+	"""
+	if len(occupancy) == 0:
+		return
+	logger.log('matching: sources per bucket (median/99%%/max): %s' % ', '.join(['catalogue %d: %d/%d/%d' % (
+		ti + 1, numpy.median(o), numpy.percentile(o, 99), o.max()) for ti, o in enumerate(occupancy.transpose())]))
+	ncrowded = (products > max_product).sum()
+	top = numpy.sort(products)[::-1][:max(1, len(products) // 100)]
+	logger.log('matching: %d combinations expected after hashing; the 1%% most crowded buckets give %.1f%%, the largest %d' % (
+		products.sum(), top.sum() * 100. / max(1, products.sum()), products.max()))
+	if ncrowded > 0:
+		logger.log('matching: %d crowded buckets with more than %d combinations are subdivided' % (ncrowded, max_product))
+
+def hash_crossproduct(radectables, err, logger, pairwise_errs=[], use_flat_bins=None, max_bucket_product=default_max_bucket_product, pair_radius=None):
+	"""
+	Finds all combinations of sources (one per catalogue, or none for the
+	secondary catalogues) in the same hashing buckets of size ~err.
+	
+	pairwise_errs, pair_radius: the combinations of each bucket are
+		filtered by these pair-wise radii (see within_pair_radii),
+		before they are collected.
+	use_flat_bins: whether to use the flat-sky approximation for hashing.
+		By default, it is used when possible (see can_use_flat_bins).
+	max_bucket_product: buckets with more combinations than this
+		(in crowded fields) are subdivided (see subdivide_bucket). 
+		Only combinations which can not be within err are left out.
+	
+	Returns the sorted array of row numbers (-1 if absent) of each combination.
+	"""
+	if use_flat_bins is None:
+		use_flat_bins = can_use_flat_bins(radectables, err)
 	
 	if use_flat_bins:
 		logger.log('matching: using fast flat-sky approximation for this match')
 	else:
-		# choose appropriate nside for err (in deg)
-		nside = 1
-		for nside_next in range(30): 
-			# largest distance still contained within pixels
-			dist_neighbors_complete = get_healpix_resolution_degrees(2**nside_next)
-			# we are looking for a pixel size which ensures bigger distances than the error radius
-			# but we want the smallest pixels possible, to reduce the cartesian product
-			if dist_neighbors_complete < err:
-				# too small, do not accept
-				# sources within err will be outside the neighbor pixels
-				break
-			nside = 2**nside_next
+		nside = get_healpix_nside(err)
 		resol = get_healpix_resolution_degrees(nside) * 60 * 60
 		logger.log('matching: healpix hashing on pixel resolution ~ %f arcsec (nside=%d)' % (resol, nside))
 	
 	buckets = defaultdict(lambda : [[] for _ in range(len(radectables))])
 	primary_cat_keys = None
 	
-	pbar = tqdm.tqdm(total=sum([len(t[0]) for t in radectables]))
+	quiet = isinstance(logger, NullOutputLogger)
+	pbar = tqdm.tqdm(total=sum([len(t[0]) for t in radectables]), disable=quiet)
 	for ti, (ra_table, dec_table) in enumerate(radectables):
 		if use_flat_bins:
 			for ei, (ra, dec) in enumerate(zip(ra_table, dec_table)):
@@ -158,51 +309,59 @@ def crossproduct(radectables, err, logger, pairwise_errs=[]):
 	results = set()
 	# now combine within buckets
 	logger.log('matching: collecting from %d buckets, creating cartesian products ...' % len(buckets))
-	#print('matching: %6d matches expected after hashing' % numpy.sum([
-	#	len(lists[0]) * numpy.product([len(li) + 1 for li in lists[1:]]) 
-	#		for lists in buckets.values()]))
+	occupancy = numpy.array([[len(l) for l in lists] for lists in buckets.values()]).reshape((-1, len(radectables)))
+	products = occupancy[:,0] * numpy.product(occupancy[:,1:] + 1., axis=1)
+	log_bucket_occupancy(occupancy, products, max_bucket_product, logger=logger)
+	
+	# unit vectors of the sources, for subdividing crowded buckets
+	positions = [None for _ in radectables]
+	chord = 2 * sin(err / 180 * pi / 2) * (1 + 1e-6)
+	ncrowded_before = 0
+	ncrowded_after = 0
 	
 	#pbar = logger.progress(ndigits=5, maxval=len(buckets)).start()
-	pbar = tqdm.tqdm(total=len(buckets))
+	pbar = tqdm.tqdm(total=len(buckets), disable=quiet)
 	while buckets:
 		k, lists = buckets.popitem()
 		pbar.update()
-		# add for secondary catalogues the option of missing source
+		nproduct = len(lists[0])
 		for l in lists[1:]:
-			l.insert(0, -1)
-		# create the cartesian product
-		local_results = itertools.product(*[sorted(l) for l in lists])
+			nproduct *= len(l) + 1
+		if nproduct > max_bucket_product:
+			# crowded bucket: only combine sources close enough to each other
+			for ti, (ra, dec) in enumerate(radectables):
+				if positions[ti] is None:
+					positions[ti] = unit_vectors(ra, dec)
+			lists = [numpy.array(l, dtype=int) for l in lists]
+			parts = subdivide_bucket([p[l] for p, l in zip(positions, lists)], lists, chord, max_bucket_product)
+			parts = [[l.tolist() for l in part] for part in parts]
+			ncrowded_before += nproduct
+			for part in parts:
+				nproduct = len(part[0])
+				for l in part[1:]:
+					nproduct *= len(l) + 1
+				ncrowded_after += nproduct
+		else:
+			parts = [lists]
 		
-		# if pairwise filtering is requested, use it to trim down solutions
-		if pairwise_errs:
-			local_results = numpy.array(list(local_results))
-			#nstart = len(local_results)
-			for tablei, tablej, errij in pairwise_errs:
-				indicesi = local_results[:,tablei]
-				indicesj = local_results[:,tablej]
-				# first find entries that actually have both entries
-				mask_both = numpy.logical_and(indicesi >= 0, indicesj >= 0)
-				#if not mask_both.any():
-				#	continue
-				# get the RA/Dec
-				rai, deci = radectables[tablei]
-				raj, decj = radectables[tablej]
-				rai, deci = rai[indicesi[mask_both]], deci[indicesi[mask_both]]
-				raj, decj = raj[indicesj[mask_both]], decj[indicesj[mask_both]]
-				# compute distances
-				mask_good = dist((rai, deci), (raj, decj)) < errij * 60 * 60
-				# select the ones where one is missing, or those within errij
-				mask_good2 = ~mask_both
-				mask_good2[mask_both][mask_good] = True
-				#print(mask_good2.sum(), mask_both.shape, mask_both.sum(), mask_good.sum())
-				local_results = local_results[mask_good2,:]
+		for lists in parts:
+			# add for secondary catalogues the option of missing source
+			for l in lists[1:]:
+				l.insert(0, -1)
+			# create the cartesian product
+			local_results = itertools.product(*[sorted(l) for l in lists])
 			
-			#print("compression:%d/%d" % (len(local_results), nstart))
-			results.update([tuple(l) for l in local_results])
-		else:
-			results.update(local_results)
-		del local_results
+			# if pairwise filtering is requested, use it to trim down solutions
+			if pairwise_errs or pair_radius is not None:
+				local_results = numpy.array(list(local_results), dtype=int).reshape((-1, len(radectables)))
+				local_results = local_results[within_pair_radii(local_results, radectables, pairwise_errs, pair_radius)]
+				results.update([tuple(l) for l in local_results])
+			else:
+				results.update(local_results)
+			del local_results
 	pbar.close()
+	if ncrowded_before > 0:
+		logger.log('matching: subdividing crowded buckets reduced their combinations from %d to %d' % (ncrowded_before, ncrowded_after))
 
 	n = len(results)
 	logger.log('matching: %6d unique matches from cartesian product. sorting ...' % n)
@@ -210,13 +369,113 @@ def crossproduct(radectables, err, logger, pairwise_errs=[]):
 	results = numpy.array(sorted(results))
 	return results
 
+crossproduct = mem.cache(hash_crossproduct, ignore=['logger'])
+
+def nearest_candidates(radectables, err, errors, max_candidates, logger):
+	"""
+	For each primary source, finds the sources of each secondary catalogue
+	within err and keeps the max_candidates nearest by normalised
+	separation, separation / sqrt(error_primary**2 + error_secondary**2).
+	
+	errors: positional error (arcsec) of each catalogue, per source or a single value
+	
+	Returns for each secondary catalogue the kept pairs of rows
+	(primary, secondary), sorted, and a summary of the candidates
+	left out: their number (ndiscarded), the number of primary sources
+	losing some (nprimaries), and an upper bound of the posterior mass
+	of the candidates left out of each primary source, in the 
+	two-catalogue approximation (largest: max_posterior, 
+	summed over primary sources: total_posterior).
+	"""
+	ra0, dec0 = radectables[0]
+	nprimary = len(ra0)
+	error0 = numpy.broadcast_to(numpy.asarray(errors[0], dtype=float), (nprimary,))
+	kept_pairs = []
+	ndiscarded = 0
+	weight_kept = numpy.zeros(nprimary)
+	weight_discarded = numpy.zeros(nprimary)
+	for (ra, dec), error in zip(radectables[1:], errors[1:]):
+		pairs = crossproduct([(ra0, dec0), (ra, dec)], err, logger=NullOutputLogger())
+		pairs = pairs[pairs[:,1] >= 0]
+		i, k = pairs[:,0], pairs[:,1]
+		separation = dist((ra0[i], dec0[i]), (ra[k], dec[k])) * 60 * 60
+		within = separation < err * 60 * 60
+		i, k, separation = i[within], k[within], separation[within]
+		error = numpy.broadcast_to(numpy.asarray(error, dtype=float), (len(ra),))
+		variance = error0[i]**2 + error[k]**2
+		normalised = separation / variance**0.5
+		# rank the candidates of each primary source
+		order = numpy.lexsort((normalised, i))
+		i, k, normalised, variance = i[order], k[order], normalised[order], variance[order]
+		first = numpy.searchsorted(i, i)
+		keep = numpy.arange(len(i)) - first < max_candidates
+		ndiscarded += (~keep).sum()
+		# two-catalogue likelihood ratios, up to a common factor
+		weight = numpy.exp(-0.5 * normalised**2) / variance
+		weight_kept += numpy.bincount(i[keep], weights=weight[keep], minlength=nprimary)
+		weight_discarded += numpy.bincount(i[~keep], weights=weight[~keep], minlength=nprimary)
+		i, k = i[keep], k[keep]
+		order = numpy.lexsort((k, i))
+		kept_pairs.append((i[order], k[order]))
+	
+	lost = weight_discarded > 0
+	posterior = weight_discarded[lost] / (weight_kept[lost] + weight_discarded[lost])
+	summary = dict(ndiscarded=int(ndiscarded), nprimaries=int(lost.sum()),
+		max_posterior=float(posterior.max()) if lost.any() else 0., 
+		total_posterior=float(posterior.sum()))
+	return kept_pairs, summary
+
+def combine_candidates(nprimary, pairs):
+	"""
+	All combinations of each primary source with no source or one of
+	its candidates of each secondary catalogue.
+	
+	pairs: for each secondary catalogue, the candidate pairs of rows
+		(primary, secondary), sorted
+	
+	Returns the sorted array of row numbers (-1 if absent) of each combination.
+	"""
+	results = numpy.arange(nprimary).reshape((-1, 1))
+	for i, k in pairs:
+		# combine each row with no source and each candidate of its primary source
+		counts = numpy.bincount(i, minlength=nprimary)
+		starts = numpy.cumsum(counts) - counts
+		primary = results[:,0]
+		noptions = counts[primary] + 1
+		row = numpy.repeat(numpy.arange(len(results)), noptions)
+		option = numpy.arange(len(row)) - numpy.repeat(numpy.cumsum(noptions) - noptions, noptions)
+		candidate = numpy.append(k, -1)[numpy.where(option > 0, starts[primary[row]] + option - 1, -1)]
+		results = numpy.column_stack((results[row], candidate))
+	return results
+
+def capped_crossproduct(radectables, err, errors, max_candidates, logger, pairwise_errs=[], pair_radius=None):
+	"""
+	Like hash_crossproduct, but for each primary source, only the
+	max_candidates nearest sources of each secondary catalogue (by
+	normalised separation, see nearest_candidates) are combined. 
+	This bounds the number of combinations of each primary source
+	by (max_candidates + 1)**(number of secondary catalogues).
+	
+	Returns the sorted array of row numbers (-1 if absent) of each combination.
+	"""
+	kept_pairs, summary = nearest_candidates(radectables, err, errors, max_candidates, logger)
+	logger.log('matching: keeping the %d nearest candidates of each catalogue per primary source' % max_candidates)
+	logger.log('matching: %6d candidates of %d primary sources left out, posterior mass of those left out: < %.2g per source, < %.2g in total' % (
+		summary['ndiscarded'], summary['nprimaries'], summary['max_posterior'], summary['total_posterior']))
+	
+	results = combine_candidates(len(radectables[0][0]), kept_pairs)
+	results = results[within_pair_radii(results, radectables, pairwise_errs, pair_radius)]
+	# combinations were created in sorted order
+	logger.log('matching: %6d matches from the capped cartesian product' % len(results))
+	return results
+
 # use preferred newer astropy command if available
 if hasattr(pyfits.BinTableHDU, 'from_columns'):
 	fits_from_columns = pyfits.BinTableHDU.from_columns
 else:
 	fits_from_columns = pyfits.new_table
 
-def match_multiple(tables, table_names, err, fits_formats, logger, circular=True, pairwise_errs=[]):
+def match_multiple(tables, table_names, err, fits_formats, logger, circular=True, pairwise_errs=[], columns=None, rows=None, scratch=None, pair_radius=None, candidate_cap=None):
 	"""
 	computes the cartesian product of all possible matches,
 	limited to a maximum distance of err (in degrees).
@@ -224,6 +483,21 @@ def match_multiple(tables, table_names, err, fits_formats, logger, circular=True
 	tables: input FITS table
 	table_names: names of the tables
 	fits_formats: FITS data type of the columns of each table
+	columns: for each table, the list of column names to merge into the output.
+		If None (default), all columns are merged. The RA/DEC columns are always included.
+	rows: for each table, the row numbers to consider (e.g., those of one sky tile, 
+		see tiling.iter_tiles). If None (default), all rows are used. 
+		The returned results always refer to rows of the full tables.
+	scratch: ScratchSpace for allocating the output columns under a memory
+		limit. By default, all columns are computed in memory.
+	pair_radius: adaptive search radius, as (k, floor, errors) with the 
+		positional error (arcsec) of each table, a value or one per row. 
+		Each pair of sources i, j has to be within 
+		k * sqrt(errors_i**2 + errors_j**2) + floor arcsec (and within err).
+		The combinations are filtered by it while hashing.
+	candidate_cap: (max_candidates, errors), with errors as for pair_radius:
+		only combine the max_candidates nearest sources of each secondary
+		table per primary source (see capped_crossproduct).
 	
 	returns 
 	results: cartesian product of all possible matches (smaller than err)
@@ -233,7 +507,7 @@ def match_multiple(tables, table_names, err, fits_formats, logger, circular=True
 	"""
 	logger.log('')
 	logger.log('matching with %f arcsec radius' % (err * 60 * 60))
-	logger.log('matching: %6d naive possibilities' % numpy.product([len(t) for t in tables]))
+	logger.log('matching: %6d naive possibilities' % numpy.product([len(t) for t in (tables if rows is None else rows)]))
 
 	logger.log('matching: hashing')
 
@@ -243,97 +517,145 @@ def match_multiple(tables, table_names, err, fits_formats, logger, circular=True
 	logger.log('    using DEC columns: %s' % ', '.join(dec_keys))
 
 	ratables = [(t[ra_key], t[dec_key]) for t, ra_key, dec_key in zip(tables, ra_keys, dec_keys)]
-	resultstable = crossproduct(ratables, err, logger=logger, pairwise_errs=pairwise_errs)
+	# the errors of the rows hashed
+	row_subset = lambda errors: errors if rows is None else [e if numpy.ndim(e) == 0 else e[r] for e, r in zip(errors, rows)]
+	hashed_pair_radius = None
+	if pair_radius is not None:
+		k_radius, floor_radius, source_errors = pair_radius
+		hashed_pair_radius = (k_radius, floor_radius, row_subset(source_errors))
+	if candidate_cap is not None:
+		max_candidates, source_errors = candidate_cap
+		hashed = lambda radectables: capped_crossproduct(radectables, err, row_subset(source_errors), max_candidates, 
+			logger=logger, pairwise_errs=pairwise_errs, pair_radius=hashed_pair_radius)
+	else:
+		hashed = lambda radectables: crossproduct(radectables, err, logger=logger, pairwise_errs=pairwise_errs, 
+			pair_radius=hashed_pair_radius)
+	if rows is None:
+		resultstable = hashed(ratables)
+	else:
+		resultstable = hashed([(ra[r], dec[r]) for (ra, dec), r in zip(ratables, rows)])
+		# translate to row numbers of the full tables (-1 stays -1)
+		resultstable = numpy.column_stack([numpy.append(r, -1)[idx]
+			for idx, r in zip(resultstable.transpose(), rows)])
+	if scratch is None:
+		scratch = ScratchSpace()
+	resultstable = scratch.store(resultstable)
 	results = resultstable.view(dtype=[(table_name, resultstable.dtype) for table_name in table_names]).reshape((-1,))
 
-	keys = []
-	for table_name, table in zip(table_names, tables):
-		keys += ["%s_%s" % (table_name, n) for n in table.dtype.names]
+	if columns is None:
+		columns = [table.dtype.names for table in tables]
+	columns = [[n for n in table.dtype.names if n in cols or n in (ra_key, dec_key)]
+		for table, cols, ra_key, dec_key in zip(tables, columns, ra_keys, dec_keys)]
 	
-	logger.log('merging in %d columns from input catalogues ...' % sum([1 + len(table.dtype.names) for table in tables]))
+	logger.log('merging in %d columns from input catalogues ...' % sum([len(cols) for cols in columns]))
 	cat_columns = []
-	pbar = tqdm.tqdm(total=sum([1 + len(table.dtype.names) for table in tables]))
-	for table, table_name, fits_format in zip(tables, table_names, fits_formats):
-		tbl = table[results[table_name]]
-		# set missing to nan
-		mask_missing = results[table_name] == -1
-		
-		pbar.update()
-		for n, format in zip(table.dtype.names, fits_format):
-			k = "%s_%s" % (table_name, n)
-			keys.append(k)
-			col = tbl[n]
-			#print('   setting "%s" to -99 (%d affected; column format "%s")' % (k, mask_missing.sum(), format))
-			try:
-				col[mask_missing] = -99
-			except Exception as e:
-				logger.log('   setting "%s" to -99 failed (%d affected; column format "%s"): %s' % (k, mask_missing.sum(), format, e))
-			
-			fitscol = pyfits.Column(name=k, format=format, array=col)
-			cat_columns.append(fitscol)
-			pbar.update()
+	pbar = tqdm.tqdm(total=sum([len(cols) for cols in columns]))
+	for table, table_name, fits_format, cols in zip(tables, table_names, fits_formats, columns):
+		cat_columns += gather_columns(table, table_name, results[table_name], fits_format, cols, logger=logger, pbar=pbar, scratch=scratch)
 	pbar.close()
 	
-	tbhdu = fits_from_columns(pyfits.ColDefs(cat_columns))
 	header = dict(
 		COLS_RA = ' '.join(["%s_%s" % (ti, ra_key) for ti, ra_key in zip(table_names, ra_keys)]),
 		COLS_DEC = ' '.join(["%s_%s" % (ti, dec_key) for ti, dec_key in zip(table_names, dec_keys)])
 	)
 	
 	logger.log('    adding angular separation columns')
-	max_separation = numpy.zeros(len(results))
+	nresults = len(results)
+	max_separation = scratch.full(nresults, 0.)
+	radec = []
+	for table_name, (ra, dec) in zip(table_names, ratables):
+		idx = results[table_name]
+		a_ra, a_dec = scratch.take(ra, idx), scratch.take(dec, idx)
+		a_ra[idx == -1] = -99
+		a_dec[idx == -1] = -99
+		radec.append((a_ra, a_dec))
 	for i in range(len(tables)):
-		a_ra  = tbhdu.data["%s_%s" % (table_names[i], ra_keys[i])]
-		a_dec = tbhdu.data["%s_%s" % (table_names[i], dec_keys[i])]
+		a_ra_all, a_dec_all = radec[i]
 		for j in range(i):
 			k = "Separation_%s_%s" % (table_names[i], table_names[j])
 			k1 = k + "_ra"
 			k2 = k + "_dec"
-			if circular:
-				keys += [k, k1, k2]
-			else:
-				keys += [k]
-			
-			b_ra  = tbhdu.data["%s_%s" % (table_names[j], ra_keys[j])]
-			b_dec = tbhdu.data["%s_%s" % (table_names[j], dec_keys[j])]
-			
-			if circular:
-				col = dist((a_ra, a_dec), (b_ra, b_dec))
-			else:
-				col, col_ra, col_dec = dist3d((a_ra, a_dec), (b_ra, b_dec))
-			
-			valid_input = numpy.logical_and(a_ra != -99, b_ra != -99)
-			assert not numpy.isnan(col[valid_input]).any(), ['%d distances are nan' % numpy.isnan(col[valid_input]).sum(), 
-				a_ra[numpy.isnan(col)], a_dec[numpy.isnan(col)], 
-				b_ra[numpy.isnan(col)], b_dec[numpy.isnan(col)]]
 			
-			col[a_ra == -99] = numpy.nan
-			col[b_ra == -99] = numpy.nan
+			b_ra_all, b_dec_all = radec[j]
+			# separations in arcsec, computed chunk by chunk
+			sep = scratch.empty(nresults, dtype='f4')
 			if not circular:
-				col_ra[a_ra == -99] = numpy.nan
-				col_ra[b_ra == -99] = numpy.nan
-				col_dec[a_ra == -99] = numpy.nan
-				col_dec[b_ra == -99] = numpy.nan
-			max_separation = numpy.nanmax([col * 60 * 60, max_separation], axis=0)
-			# store distance in arcsec 
-			cat_columns.append(pyfits.Column(name=k, format='E', array=col * 60 * 60))
+				sep_ra = scratch.empty(nresults, dtype='f4')
+				sep_dec = scratch.empty(nresults, dtype='f4')
+			for s in scratch.chunks(nresults):
+				a_ra, a_dec, b_ra, b_dec = a_ra_all[s], a_dec_all[s], b_ra_all[s], b_dec_all[s]
+				
+				if circular:
+					col = dist((a_ra, a_dec), (b_ra, b_dec))
+				else:
+					col, col_ra, col_dec = dist3d((a_ra, a_dec), (b_ra, b_dec))
+				
+				valid_input = numpy.logical_and(a_ra != -99, b_ra != -99)
+				assert not numpy.isnan(col[valid_input]).any(), ['%d distances are nan' % numpy.isnan(col[valid_input]).sum(), 
+					a_ra[numpy.isnan(col)], a_dec[numpy.isnan(col)], 
+					b_ra[numpy.isnan(col)], b_dec[numpy.isnan(col)]]
+				
+				col[a_ra == -99] = numpy.nan
+				col[b_ra == -99] = numpy.nan
+				if not circular:
+					col_ra[a_ra == -99] = numpy.nan
+					col_ra[b_ra == -99] = numpy.nan
+					col_dec[a_ra == -99] = numpy.nan
+					col_dec[b_ra == -99] = numpy.nan
+				max_separation[s] = numpy.nanmax([col * 60 * 60, max_separation[s]], axis=0)
+				# store distance in arcsec 
+				sep[s] = col * 60 * 60
+				if not circular:
+					sep_ra[s] = col_ra * 60 * 60
+					sep_dec[s] = col_dec * 60 * 60
+			cat_columns.append(pyfits.Column(name=k, format='E', array=sep))
 			if not circular:
-				cat_columns.append(pyfits.Column(name=k1, format='E', array=col_ra * 60 * 60))
-				cat_columns.append(pyfits.Column(name=k2, format='E', array=col_dec * 60 * 60))
+				cat_columns.append(pyfits.Column(name=k1, format='E', array=sep_ra))
+				cat_columns.append(pyfits.Column(name=k2, format='E', array=sep_dec))
+	del radec
 	
-	cat_columns.append(pyfits.Column(name="Separation_max", format='E', array=max_separation))
-	cat_columns.append(pyfits.Column(name="ncat", format='I', array=(resultstable > -1).sum(axis=1)))
-	keys.append("Separation_max")
+	cat_columns.append(pyfits.Column(name="Separation_max", format='E', array=scratch.astype(max_separation, 'f4')))
+	cat_columns.append(pyfits.Column(name="ncat", format='I', array=scratch.apply(lambda r: (r > -1).sum(axis=1), resultstable, dtype='i2')))
 	mask = max_separation < err * 60 * 60
 	for c in cat_columns:
-		c.array = c.array[mask]
+		c.array = scratch.compress(c.array, mask)
 	
 	logger.log('matching: %6d matches after filtering by search radius' % mask.sum())
 	logger.log('')
-	return results[mask], cat_columns, header
+	return scratch.compress(results, mask), cat_columns, header
 
-def wraptable2fits(cat_columns, extname):
-	tbhdu = fits_from_columns(pyfits.ColDefs(cat_columns))
+def gather_columns(table, table_name, indices, fits_format, names, logger, pbar=None, scratch=None):
+	"""
+	Picks the rows given by indices from the columns names of table.
+	Missing entries (index -1) are set to -99.
+	
+	Each column is gathered separately, so only the requested columns
+	of a (memory-mapped) input table are read. With a scratch space
+	(see match_multiple), the columns are gathered chunk by chunk.
+	
+	Returns a list of FITS columns, named <table_name>_<column>.
+	"""
+	if scratch is None:
+		scratch = ScratchSpace()
+	mask_missing = indices == -1
+	formats = dict(zip(table.dtype.names, fits_format))
+	cat_columns = []
+	for n in names:
+		k = "%s_%s" % (table_name, n)
+		col = scratch.take(table[n], indices)
+		format = formats[n] or tableio.fits_format(col)
+		#print('   setting "%s" to -99 (%d affected; column format "%s")' % (k, mask_missing.sum(), format))
+		try:
+			col[mask_missing] = -99
+		except Exception as e:
+			logger.log('   setting "%s" to -99 failed (%d affected; column format "%s"): %s' % (k, mask_missing.sum(), format, e))
+		
+		cat_columns.append(pyfits.Column(name=k, format=format, array=col))
+		if pbar is not None:
+			pbar.update()
+	return cat_columns
+
+def make_primary_hdu():
 	hdu = pyfits.PrimaryHDU()
 	import datetime, time
 	now = datetime.datetime.fromtimestamp(time.time())
@@ -341,6 +663,11 @@ def wraptable2fits(cat_columns, extname):
 	nowstr = nowstr[:nowstr.rfind('.')]
 	hdu.header['DATE'] = nowstr
 	hdu.header['ANALYSIS'] = 'NWAY matching'
+	return hdu
+
+def wraptable2fits(cat_columns, extname):
+	tbhdu = fits_from_columns(pyfits.ColDefs(cat_columns))
+	hdu = make_primary_hdu()
 	tbhdu.header['EXTNAME'] = extname
 	hdulist = pyfits.HDUList([hdu, tbhdu])
 	return hdulist
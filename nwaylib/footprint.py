@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+__doc__ = """
+Sky footprints as multi-order HEALPix coverage maps (MOC).
+
+The footprint of the primary catalogue, dilated by the match radius,
+contains all secondary sources which can be matched. Secondary sources
+outside of it (e.g., of an all-sky catalogue) can be left out before
+hashing.
+
+A MOC is a list of (order, sorted nested pixel numbers), with
+nside = 2**order, in the standard HEALPix convention (theta is the
+colatitude). It can be written to a FITS file (NUNIQ ordering, as in
+the IVOA MOC standard) for reuse with other tools.
+"""
+
+import numpy
+import healpy
+import astropy.io.fits as pyfits
+from . import fastskymatch as match
+
+default_chunk_size = 1000000
+
+def dilated_coverage(ra, dec, radius, chunk_size=default_chunk_size):
+	"""
+	Footprint of the sources, dilated by radius.
+
+	ra, dec: coordinates in degrees
+	radius: dilation in degrees
+
+	Returns a MOC containing all positions within radius of a source.
+	"""
+	nside = match.get_healpix_nside(radius)
+	order = int(round(numpy.log2(nside)))
+	pixels = []
+	for lo in range(0, len(ra), chunk_size):
+		ra_chunk = numpy.asarray(ra[lo:lo+chunk_size], dtype=float)
+		dec_chunk = numpy.asarray(dec[lo:lo+chunk_size], dtype=float)
+		# positions within radius are in the same or in a neighbouring pixel
+		i = healpy.ang2pix(nside, ra_chunk, dec_chunk, nest=True, lonlat=True)
+		j = healpy.get_all_neighbours(nside, ra_chunk, dec_chunk, nest=True, lonlat=True)
+		pixels.append(numpy.unique(numpy.hstack((i, j[j >= 0]))))
+	if not pixels:
+		return []
+	return normalise(order, numpy.unique(numpy.concatenate(pixels)))
+
+def normalise(order, pixels):
+	"""
+	MOC of pixels at order, with each complete set of
+	four sibling pixels replaced by their parent pixel.
+	"""
+	moc = []
+	pixels = numpy.unique(pixels)
+	while order > 0 and len(pixels) > 0:
+		parents, counts = numpy.unique(pixels >> 2, return_counts=True)
+		complete = parents[counts == 4]
+		moc.append((order, pixels[~numpy.in1d(pixels >> 2, complete)]))
+		order -= 1
+		pixels = complete
+	moc.append((order, pixels))
+	return [(order, pixels) for order, pixels in moc[::-1] if len(pixels) > 0]
+
+def contains(moc, ra, dec, chunk_size=default_chunk_size):
+	"""
+	Whether the positions (in degrees) lie in the MOC.
+	"""
+	mask = numpy.zeros(len(ra), dtype=bool)
+	if not moc:
+		return mask
+	max_order = max([order for order, pixels in moc])
+	for lo in range(0, len(ra), chunk_size):
+		ra_chunk = numpy.asarray(ra[lo:lo+chunk_size], dtype=float)
+		dec_chunk = numpy.asarray(dec[lo:lo+chunk_size], dtype=float)
+		i = healpy.ang2pix(2**max_order, ra_chunk, dec_chunk, nest=True, lonlat=True)
+		for order, pixels in moc:
+			parent = i >> (2 * (max_order - order))
+			index = numpy.minimum(numpy.searchsorted(pixels, parent), len(pixels) - 1)
+			mask[lo:lo+len(i)] |= pixels[index] == parent
+	return mask
+
+def area(moc):
+	"""
+	Sky area covered by the MOC, in square degrees.
+	"""
+	return sum([len(pixels) * healpy.nside2pixarea(2**order, degrees=True) for order, pixels in moc])
+
+def write_moc(filename, moc):
+	"""
+	Write the MOC to a FITS file (NUNIQ ordering).
+	"""
+	max_order = max([order for order, pixels in moc]) if moc else 0
+	uniq = numpy.concatenate([4 * 4**order + pixels for order, pixels in moc] + [numpy.zeros(0, dtype=int)])
+	hdu = pyfits.BinTableHDU.from_columns([pyfits.Column(name='UNIQ', format='K', array=uniq)])
+	hdu.header['PIXTYPE'] = 'HEALPIX'
+	hdu.header['ORDERING'] = 'NUNIQ'
+	hdu.header['COORDSYS'] = 'C'
+	hdu.header['MOCORDER'] = max_order
+	hdu.header['MOCTOOL'] = 'nway'
+	pyfits.HDUList([pyfits.PrimaryHDU(), hdu]).writeto(filename, overwrite=True)
+
+def read_moc(filename):
+	"""
+	Read a MOC from a FITS file (NUNIQ ordering).
+	"""
+	uniq = numpy.asarray(pyfits.open(filename)[1].data['UNIQ'], dtype=numpy.int64)
+	orders = numpy.log2(uniq).astype(int) // 2 - 1
+	pixels = uniq - 4 * 4**orders
+	return [(order, numpy.sort(pixels[orders == order])) for order in numpy.unique(orders)]
+
+def rows_in_footprint(radectables, radius):
+	"""
+	Rows of each catalogue which can be matched: all primary sources,
+	and the secondary sources within radius of the primary footprint.
+
+	radectables: list of (ra, dec) of each catalogue, the first is the primary catalogue
+	radius: match radius in degrees
+
+	Returns the MOC of the footprint and the rows of each catalogue.
+	"""
+	ra, dec = radectables[0]
+	moc = dilated_coverage(ra, dec, radius)
+	rows = [numpy.arange(len(ra))] + [numpy.where(contains(moc, ra, dec))[0] for ra, dec in radectables[1:]]
+	return moc, rows
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+__doc__ = """
+Cache of the magnitude histograms derived automatically (--mag ... auto).
+
+Each histogram is stored in a file named by a fingerprint (SHA-1) of
+everything it depends on: the positions, errors and sky areas of the
+input catalogues, the matching parameters, the magnitude column and its
+values, and the selection parameters. Later runs with the same inputs,
+also in tiled mode, reuse it instead of selecting the secure matches
+again. Runs with different inputs use different files, so runs in
+parallel do not overwrite each other's histograms.
+
+The files have the format of <table>_<column>_fit.txt, and can be given
+to --mag as histogram files (e.g., for matching fake catalogues).
+"""
+
+import os
+import hashlib
+import tempfile
+import numpy
+
+default_chunk_size = 1000000
+
+def _update(h, item, chunk_size=default_chunk_size):
+	if isinstance(item, (list, tuple)):
+		h.update(b'(')
+		for subitem in item:
+			_update(h, subitem, chunk_size=chunk_size)
+		h.update(b')')
+	elif numpy.ndim(item) > 0:
+		empty = numpy.asarray(item[:0])
+		dtype = empty.dtype.newbyteorder('=')
+		# the shape of each row of multi-dimensional arrays (vector columns)
+		shape = '' if empty.ndim == 1 else str(empty.shape[1:])
+		h.update(('array:%s%s:%d:' % (dtype.str, shape, len(item))).encode('ascii'))
+		for lo in range(0, len(item), chunk_size):
+			h.update(numpy.ascontiguousarray(item[lo:lo+chunk_size], dtype=dtype).tobytes())
+	elif isinstance(item, (bool, numpy.bool_)) or item is None:
+		h.update(('%s;' % item).encode('ascii'))
+	elif isinstance(item, (int, float, numpy.number)):
+		h.update(('%r;' % float(item)).encode('ascii'))
+	else:
+		h.update(('%s;' % item).encode('utf-8'))
+
+def fingerprint(*items):
+	"""
+	SHA-1 hex digest of the items: numbers, strings, arrays (by content,
+	independent of the byte order), and lists or tuples of them.
+	"""
+	h = hashlib.sha1()
+	_update(h, items)
+	return h.hexdigest()
+
+def write_histogram(filename, bins, hist_sel, hist_all, fmt="%10.5f"):
+	"""
+	Write the histograms (as <table>_<column>_fit.txt). The file is
+	replaced at once, so concurrent readers never see a partial file.
+	"""
+	directory = os.path.dirname(os.path.abspath(filename))
+	fd, tmpname = tempfile.mkstemp(prefix='.' + os.path.basename(filename), dir=directory)
+	try:
+		with os.fdopen(fd, 'wb') as f:
+			f.write(b'# lo hi selected others\n')
+			numpy.savetxt(f,
+				numpy.transpose([bins[:-1], bins[1:], hist_sel, hist_all]),
+				fmt = [fmt]*4)
+		os.rename(tmpname, filename)
+	finally:
+		if os.path.exists(tmpname):
+			os.unlink(tmpname)
+
+def read_histogram(filename):
+	"""
+	Read histograms written by write_histogram. Returns bins, hist_sel, hist_all.
+	"""
+	bins_lo, bins_hi, hist_sel, hist_all = numpy.loadtxt(filename, ndmin=2).transpose()
+	return numpy.array(list(bins_lo) + [bins_hi[-1]]), hist_sel, hist_all
+
+def write_grid(filename, edges, cells, hist_sel, hist_all):
+	"""
+	Write a grid of N-dimensional histograms (see magnitudeweights.adaptive_grid):
+	the bin edges of each dimension, then the multi-index of each non-empty 
+	cell with its selected and others histogram values.
+	"""
+	indices = numpy.unravel_index(cells, tuple([len(e) - 1 for e in edges]))
+	directory = os.path.dirname(os.path.abspath(filename))
+	fd, tmpname = tempfile.mkstemp(prefix='.' + os.path.basename(filename), dir=directory)
+	try:
+		with os.fdopen(fd, 'wb') as f:
+			for i, e in enumerate(edges):
+				f.write(('# edges %d: %s\n' % (i, ' '.join(['%.17g' % x for x in e]))).encode('ascii'))
+			f.write(('# %s selected others\n' % ' '.join(['i%d' % i for i in range(len(edges))])).encode('ascii'))
+			numpy.savetxt(f, numpy.transpose(list(indices) + [hist_sel, hist_all]),
+				fmt = ["%d"] * len(edges) + ["%.17g"] * 2)
+		os.rename(tmpname, filename)
+	finally:
+		if os.path.exists(tmpname):
+			os.unlink(tmpname)
+
+def read_grid(filename):
+	"""
+	Read a grid written by write_grid. Returns edges, cells, hist_sel, hist_all.
+	"""
+	edges = []
+	with open(filename) as f:
+		for line in f:
+			if line.startswith('# edges '):
+				edges.append(numpy.array([float(x) for x in line.split(':', 1)[1].split()]))
+	data = numpy.loadtxt(filename, ndmin=2)
+	indices = data[:,:len(edges)].astype(int).transpose()
+	cells = numpy.ravel_multi_index(tuple(indices), tuple([len(e) - 1 for e in edges]))
+	order = numpy.argsort(cells)
+	return edges, cells[order], data[order,len(edges)], data[order,len(edges)+1]
+
+class HistogramCache(object):
+	"""
+	Directory of magnitude histograms, by fingerprint (see fingerprint).
+	"""
+	def __init__(self, directory):
+		self.directory = directory
+
+	def path(self, key):
+		return os.path.join(self.directory, key + '.txt')
+
+	def load(self, key):
+		"""
+		Returns bins, hist_sel, hist_all, or None if not cached.
+		"""
+		if not os.path.exists(self.path(key)):
+			return None
+		return read_histogram(self.path(key))
+
+	def store(self, key, bins, hist_sel, hist_all):
+		"""
+		Store the histograms; returns the file name.
+		"""
+		if not os.path.exists(self.directory):
+			try:
+				os.makedirs(self.directory)
+			except OSError:
+				# created concurrently
+				assert os.path.isdir(self.directory), self.directory
+		# in full precision, so that reusing them gives the same result
+		write_histogram(self.path(key), bins, hist_sel, hist_all, fmt="%.17g")
+		return self.path(key)
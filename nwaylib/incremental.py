@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+__doc__ = """
+Incremental re-matching (--update), after rows of the input catalogues
+were added, removed or changed.
+
+The rows of the earlier and the current version of a catalogue are
+compared by content. Only the primary sources within the match radius
+of a changed source (in either version) can have different associations;
+their groups are matched again, and all other groups are copied from
+the previous output.
+"""
+
+import numpy
+
+default_chunk_size = 1000000
+
+def row_keys(columns, dtypes=None, chunk_size=default_chunk_size):
+	"""
+	Contents of each row (one numpy void value per row), for
+	comparing the rows of two versions of a catalogue.
+
+	columns: list of (name, array)
+	dtypes: data type of each column (by default, that of the array in
+		native byte order), so that both versions are compared alike
+	"""
+	if dtypes is None:
+		dtypes = [_column_dtype(values) for name, values in columns]
+	records = numpy.zeros(len(columns[0][1]) if columns else 0,
+		dtype=[(name, dtype) for (name, values), dtype in zip(columns, dtypes)])
+	for name, values in columns:
+		for lo in range(0, len(records), chunk_size):
+			records[name][lo:lo+chunk_size] = values[lo:lo+chunk_size]
+	return records.view(numpy.dtype((numpy.void, records.dtype.itemsize)))
+
+def common_dtypes(old_columns, new_columns):
+	"""
+	Data types holding the values of both versions of each column
+	(e.g., the longer string length).
+	"""
+	dtypes = []
+	for (name, old), (_, new) in zip(old_columns, new_columns):
+		old_dtype, new_dtype = _column_dtype(old), _column_dtype(new)
+		assert old_dtype.shape == new_dtype.shape, 'column "%s" changed its shape from %s to %s' % (name, old_dtype.shape, new_dtype.shape)
+		dtypes.append(numpy.dtype((numpy.promote_types(old_dtype.base, new_dtype.base), old_dtype.shape)))
+	return dtypes
+
+def _column_dtype(values):
+	# data type of one cell (keeping the shape of vector columns), in native byte order
+	values = numpy.asarray(values[:0])
+	return numpy.dtype((values.dtype.newbyteorder('='), values.shape[1:]))
+
+def _occurrence(sorted_keys):
+	# the how-manieth occurrence of its value each key is
+	first = numpy.searchsorted(sorted_keys, sorted_keys, side='left')
+	return numpy.arange(len(sorted_keys)) - first
+
+def diff_rows(old_keys, new_keys):
+	"""
+	Compares two versions of a catalogue, row by row (see row_keys).
+	Identical rows are paired up (also if they moved); repeated rows in
+	the order of their occurrence.
+
+	Returns the new row number of each old row (-1 if it was removed or
+	changed), and the old row number of each new row (-1 if it was added
+	or changed).
+	"""
+	old_order = numpy.argsort(old_keys, kind='mergesort')
+	new_order = numpy.argsort(new_keys, kind='mergesort')
+	old_sorted = old_keys[old_order]
+	new_sorted = new_keys[new_order]
+	# position of the same occurrence of the value in the new version
+	i = numpy.searchsorted(new_sorted, old_sorted, side='left') + _occurrence(old_sorted)
+	found = i < len(new_sorted)
+	found[found] = new_sorted[i[found]] == old_sorted[found]
+	old_to_new = numpy.zeros(len(old_keys), dtype=int) - 1
+	new_to_old = numpy.zeros(len(new_keys), dtype=int) - 1
+	old_to_new[old_order[found]] = new_order[i[found]]
+	new_to_old[new_order[i[found]]] = old_order[found]
+	return old_to_new, new_to_old
+
+def remap_index(mapping, index):
+	"""
+	Row numbers (e.g., of --out-narrow output) in the new version of a
+	catalogue, from those in the old version (-1 stays -1).
+	"""
+	return numpy.append(mapping, -1)[index]
@@ -79,6 +79,28 @@ def fitfunc_histogram(bin_mag, hist_sel, hist_all):
 		bounds_error=False, kind='zero')
 	return interpfunc
 
+"""
+log10 of the biasing function (see fitfunc_histogram) in each bin, 
+as a lookup table for log_bias.
+"""
+def log_bias_table(bin_mag, hist_sel, hist_all):
+	bin_n = ratio(hist_sel, hist_all)
+	with numpy.errstate(divide='ignore'):
+		return log10(numpy.asarray(list(bin_n) + [bin_n[-1]], dtype=float))
+
+"""
+evaluates the log10 biasing function of log_bias_table at values,
+with a binary search of the bins (the same as fitfunc_histogram).
+Values outside the bins, and undefined values, get a weight of 0.
+"""
+def log_bias(bin_mag, table, values):
+	values = numpy.asarray(values)
+	i = numpy.searchsorted(bin_mag, values, side='right') - 1
+	defined = logical_and(logical_and(values >= bin_mag[0], values <= bin_mag[-1]), i >= 0)
+	weights = numpy.zeros(values.shape)
+	weights[defined] = table[i[defined]]
+	return weights
+
 """
 creates the histograms for the two columns in an adaptive way (based on mag_sel)
 with the same binning.
@@ -110,3 +132,170 @@ def adaptive_histograms(mag_all, mag_sel, weights=None):
 	return bins, hist_sel, hist_all
 
 
+"""
+bin edges of adaptive_histograms, from the quantiles of the selected
+values (a QuantileSketch), extended to the range lo, hi of all values.
+"""
+def adaptive_bins(sketch, lo, hi):
+	# choose bin borders based on cumulative distribution, using 15 points
+	x = numpy.unique(sketch.quantiles(numpy.linspace(0, 1, 15)))
+	# extend to make sure ratios are well-defined
+	if x[-1] < hi:
+		x = numpy.asarray(list(x) + [hi+1])
+	if x[0] > lo:
+		x = numpy.asarray([lo-1] + list(x))
+	return x
+
+default_sketch_size = 100000
+
+class QuantileSketch(object):
+	"""
+	Mergeable approximate quantiles of weighted values, added chunk by chunk.
+	
+	Keeps up to size points; beyond, neighbouring values are combined into
+	points of equal weight (their weighted mean), so the quantiles are
+	accurate to about 1/size in cumulative weight. The smallest and 
+	largest values are kept exactly. With at most size values, the 
+	quantiles are those of adaptive_histograms.
+	"""
+	def __init__(self, size=default_sketch_size):
+		self.size = size
+		self.values = numpy.zeros(0)
+		self.weights = numpy.zeros(0)
+		self.lo = numpy.inf
+		self.hi = -numpy.inf
+	
+	def add(self, values, weights=None):
+		values = numpy.asarray(values, dtype=float)
+		if weights is None:
+			weights = numpy.ones(len(values))
+		assert len(weights) == len(values), (len(weights), len(values))
+		if len(values) == 0:
+			return
+		self.lo = min(self.lo, values.min())
+		self.hi = max(self.hi, values.max())
+		values = numpy.concatenate((self.values, values))
+		weights = numpy.concatenate((self.weights, weights))
+		order = numpy.argsort(values, kind='mergesort')
+		self.values, self.weights = values[order], weights[order]
+		if len(self.values) > self.size:
+			self._compress()
+	
+	def merge(self, other):
+		"""
+		Add the values of another sketch (e.g., of another shard).
+		"""
+		self.add(other.values, other.weights)
+		self.lo = min(self.lo, other.lo)
+		self.hi = max(self.hi, other.hi)
+	
+	def _compress(self):
+		# group into size points of equal weight
+		cumulative = numpy.cumsum(self.weights) - self.weights
+		group = numpy.minimum((cumulative / cumulative[-1] * self.size).astype(int), self.size - 1)
+		weights = numpy.bincount(group, weights=self.weights)
+		values = numpy.bincount(group, weights=self.weights * self.values)
+		nonempty = weights > 0
+		self.values = values[nonempty] / weights[nonempty]
+		self.weights = weights[nonempty]
+	
+	def quantiles(self, q):
+		assert len(self.values) > 0, 'no values'
+		values = self.values.copy()
+		values[0], values[-1] = self.lo, self.hi
+		weight_axis = numpy.cumsum(self.weights) / numpy.sum(self.weights)
+		weight_axis[0] = 0
+		weight_axis[-1] = 1
+		return scipy.interpolate.interp1d(weight_axis, values)(q)
+
+class HistogramAccumulator(object):
+	"""
+	Weighted histogram with fixed bins, accumulated chunk by chunk 
+	and mergeable. density() gives numpy.histogram(..., density=True).
+	"""
+	def __init__(self, bins):
+		self.bins = numpy.asarray(bins)
+		self.counts = numpy.zeros(len(bins) - 1)
+	
+	def add(self, values, weights=None):
+		self.counts += numpy.histogram(values, bins=self.bins, weights=weights)[0]
+	
+	def merge(self, other):
+		assert (other.bins == self.bins).all(), 'bins differ'
+		self.counts += other.counts
+	
+	def density(self):
+		return self.counts / numpy.diff(self.bins) / self.counts.sum()
+
+"""
+adaptive_histograms computed chunk by chunk, without holding the values 
+in memory: 
+
+chunks(): function giving an iterator over chunks of (field values, 
+selected values, weights of the selected values). It is iterated twice, 
+first for the bin edges, then for the histograms.
+"""
+def streaming_histograms(chunks, sketch_size=default_sketch_size):
+	sketch = QuantileSketch(size=sketch_size)
+	lo, hi = numpy.inf, -numpy.inf
+	for mag_all, mag_sel, weights in chunks():
+		sketch.add(mag_sel, weights)
+		if len(mag_all) > 0:
+			lo, hi = min(lo, numpy.nanmin(mag_all)), max(hi, numpy.nanmax(mag_all))
+	bins = adaptive_bins(sketch, lo, hi)
+	hist_sel = HistogramAccumulator(bins)
+	hist_all = HistogramAccumulator(bins)
+	for mag_all, mag_sel, weights in chunks():
+		hist_sel.add(mag_sel, weights)
+		hist_all.add(mag_all)
+	return bins, hist_sel.density(), hist_all.density()
+
+"""
+creates N-dimensional histograms (e.g., magnitude and colour) of all and of 
+selected sources, on a grid of adaptive bins in each dimension (as 
+adaptive_histograms), for priors which depend on several properties jointly.
+
+values_all, values_sel: list of arrays, one for each dimension
+
+Returns the bin edges of each dimension and, for the non-empty cells only
+(a sparse grid), the cell numbers (flattened multi-index) and the 
+normalised histograms of the selected and of all sources.
+"""
+def adaptive_grid(values_all, values_sel, weights=None):
+	if weights is None:
+		weights = numpy.ones(len(values_sel[0]))
+	edges = []
+	for v_all, v_sel in zip(values_all, values_sel):
+		sketch = QuantileSketch(size=max(default_sketch_size, len(v_sel)))
+		sketch.add(v_sel, weights)
+		edges.append(adaptive_bins(sketch, numpy.min(v_all), numpy.max(v_all)))
+	hist_sel, _ = numpy.histogramdd(numpy.transpose(values_sel), bins=edges, density=True, weights=weights)
+	hist_all, _ = numpy.histogramdd(numpy.transpose(values_all), bins=edges, density=True)
+	cells = numpy.where(numpy.logical_or(hist_sel.flatten() > 0, hist_all.flatten() > 0))[0]
+	return edges, cells, hist_sel.flatten()[cells], hist_all.flatten()[cells]
+
+"""
+evaluates the log10 prior ratio of a grid from adaptive_grid at the
+values (list of arrays, one for each dimension), with a binary search
+of the bins of each dimension and of the non-empty cells. 
+Values outside the grid, and undefined values, get a weight of 0.
+Empty cells get the weight of a cell without field sources (as ratio).
+"""
+def log_grid_bias(edges, cells, hist_sel, hist_all, values):
+	shape = tuple([len(e) - 1 for e in edges])
+	defined = numpy.ones(len(values[0]), dtype=bool)
+	indices = []
+	for e, v in zip(edges, values):
+		v = numpy.asarray(v)
+		defined &= logical_and(v >= e[0], v <= e[-1])
+		# the last bin includes its upper edge
+		indices.append(numpy.clip(numpy.searchsorted(e, v, side='right') - 1, 0, len(e) - 2))
+	flat = numpy.ravel_multi_index(indices, shape)
+	with numpy.errstate(divide='ignore'):
+		table = numpy.append(log10(ratio(hist_sel, hist_all)), log10(ratio(numpy.zeros(1), numpy.zeros(1))))
+	i = numpy.searchsorted(cells, flat)
+	found = cells[numpy.minimum(i, len(cells) - 1)] == flat
+	weights = numpy.zeros(len(flat))
+	weights[defined] = table[numpy.where(found, i, len(cells))[defined]]
+	return weights
+
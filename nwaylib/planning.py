@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+__doc__ = """
+Planning a match before running it.
+
+Predicts the number of candidate rows, the peak memory of each stage
+and the run time, and recommends how to run the match: in one go,
+in sky tiles (--tile-nside) or in shards (--shards), and the chunk size.
+
+The prediction uses the source densities (number of sources and sky area
+of each catalogue), the match radius and the hashing of a random sample
+of primary sources together with the secondary sources around them
+(see fastskymatch.hash_crossproduct). Memory and run time are
+extrapolated with costs per source and per candidate measured on a
+typical workstation, and are accurate to about a factor of two.
+"""
+
+import os
+import numpy
+from numpy import pi
+import healpy
+from collections import OrderedDict
+from . import fastskymatch as match
+from . import tiling
+from .logger import NullOutputLogger
+from .scratch import format_size
+
+default_sample_size = 1000
+
+# run time in seconds (measured with nway.py)
+time_per_source = 5.5e-6  # hashing: assigning a source to its buckets
+time_per_hashed = 3.5e-6  # hashing: a combination from the buckets
+time_per_row = 2e-6  # merging columns, separations and probabilities
+time_per_partial = 1e-4  # correcting one partial association for unrelated associations
+time_per_partial_primary = 2e-8  # ... per primary source in the match (lookup of its group)
+time_per_group = 6.5e-5  # group statistics of one primary source
+
+# memory in bytes
+bytes_per_source = 100  # hashing buckets
+bytes_per_hashed = 120  # unique combinations (set of tuples), per combination
+bytes_per_hashed_catalogue = 16  # ... per catalogue
+bytes_per_computed_row = 64  # probability columns
+
+def available_memory():
+	"""
+	Physical memory of this machine in bytes, or None if unknown.
+	"""
+	try:
+		return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+	except (ValueError, OSError, AttributeError):
+		return None
+
+def _round_chunk_size(n):
+	# round down to 1, 2 or 5 times a power of ten
+	base = 10**int(numpy.floor(numpy.log10(n)))
+	return max([f * base for f in (1, 2, 5) if f * base <= n])
+
+def sample_candidates(radectables, err, sample_size=default_sample_size, pairwise_errs=[], seed=1):
+	"""
+	Match a random sample of the primary sources with the secondary
+	sources around them, in the same way as the full match.
+
+	radectables: list of (ra, dec) of each catalogue, the first is the primary catalogue
+	err: match radius in degrees
+
+	Returns a dictionary with the number of primary sources sampled
+	(nsample), of combinations after hashing (nhashed), of candidate
+	rows within the match radius (nrows) and of those rows which
+	lack at least two catalogues (npartial).
+	"""
+	ra0, dec0 = radectables[0]
+	rng = numpy.random.RandomState(seed)
+	nsample = min(sample_size, len(ra0))
+	sample = numpy.sort(rng.choice(len(ra0), size=nsample, replace=False))
+	sample_ra, sample_dec = numpy.asarray(ra0[sample], dtype=float), numpy.asarray(dec0[sample], dtype=float)
+
+	# secondary sources in coarse pixels neighbouring the sample,
+	# a superset of those sharing a hashing bucket with them
+	coarse_nside = max(1, match.get_healpix_nside(err) // 4)
+	phi, theta, i = tiling._pixels(sample_ra, sample_dec, coarse_nside)
+	j = healpy.pixelfunc.get_all_neighbours(coarse_nside, phi=phi, theta=theta, nest=True)
+	near_pixels = numpy.unique(numpy.hstack((i, j.flatten())))
+	sampletables = [(sample_ra, sample_dec)]
+	for ra, dec in radectables[1:]:
+		rows = []
+		for lo in range(0, len(ra), tiling.default_chunk_size):
+			_, _, pixels = tiling._pixels(numpy.asarray(ra[lo:lo+tiling.default_chunk_size], dtype=float),
+				numpy.asarray(dec[lo:lo+tiling.default_chunk_size], dtype=float), coarse_nside)
+			rows.append(lo + numpy.where(numpy.in1d(pixels, near_pixels))[0])
+		rows = numpy.concatenate(rows)
+		sampletables.append((numpy.asarray(ra[rows], dtype=float), numpy.asarray(dec[rows], dtype=float)))
+
+	results = match.hash_crossproduct(sampletables, err, logger=NullOutputLogger(), pairwise_errs=pairwise_errs,
+		use_flat_bins=match.can_use_flat_bins(radectables, err))
+	nhashed = len(results)
+	if nhashed == 0:
+		return dict(nsample=nsample, nhashed=0, nrows=0, npartial=0)
+
+	# largest separation between the sources of each combination
+	max_separation = numpy.zeros(nhashed)
+	radec = []
+	for (ra, dec), idx in zip(sampletables, results.transpose()):
+		radec.append((numpy.where(idx == -1, numpy.nan, ra[idx]), numpy.where(idx == -1, numpy.nan, dec[idx])))
+	for i in range(len(radec)):
+		for j in range(i):
+			sep = match.dist(radec[i], radec[j])
+			max_separation = numpy.fmax(max_separation, sep)
+	within = max_separation < err
+	ncat = (results[within] > -1).sum(axis=1)
+	return dict(nsample=nsample, nhashed=nhashed, nrows=int(within.sum()),
+		npartial=int((ncat <= len(radectables) - 2).sum()))
+
+def plan(radectables, areas, err, row_bytes, memory_limit=None, chunk_size=1000000,
+	sample_size=default_sample_size, pairwise_errs=[], target_runtime=3600):
+	"""
+	Predict the size, memory and run time of a match, and recommend how to run it.
+
+	radectables: list of (ra, dec) of each catalogue, the first is the primary catalogue
+	areas: sky area of each catalogue in square degrees
+	err: match radius in degrees
+	row_bytes: size of the input catalogue columns merged into each output row
+	memory_limit: memory available in bytes. By default, the physical memory.
+	chunk_size: intended number of rows computed and written at a time
+	sample_size: number of primary sources to hash
+	target_runtime: recommend splitting into shards of about this run time (seconds)
+
+	Returns a dictionary with the predictions and recommendations (see format_plan).
+	"""
+	ncats = len(radectables)
+	nsources = [len(ra) for ra, dec in radectables]
+	nprimary = nsources[0]
+	if memory_limit is None:
+		memory_limit = available_memory()
+
+	# expected from the source densities alone (no clustering)
+	circle = pi * err**2
+	per_primary = numpy.product([1 + n / area * circle for n, area in zip(nsources[1:], areas[1:])])
+
+	sampled = sample_candidates(radectables, err, sample_size=sample_size, pairwise_errs=pairwise_errs)
+	scale = nprimary / max(1, sampled['nsample'])
+	nhashed = sampled['nhashed'] * scale
+	nrows = sampled['nrows'] * scale
+	npartial = sampled['npartial'] * scale
+
+	nseparations = ncats * (ncats - 1) // 2
+	merged_row = row_bytes + 8 * ncats + 4 * nseparations + 6
+	computed_row = merged_row + bytes_per_computed_row
+	memory = OrderedDict([
+		('inputs', sum(nsources) * 24),
+		('hashing', sum(nsources) * bytes_per_source + nhashed * (bytes_per_hashed + bytes_per_hashed_catalogue * ncats)),
+		('merging', (nhashed + nrows) * merged_row + nhashed * 16 * ncats),
+		('probabilities', nrows * computed_row),
+		('writing', min(chunk_size, nrows) * computed_row * 2),
+	])
+	runtime = OrderedDict([
+		('hashing', sum(nsources) * time_per_source + nhashed * time_per_hashed),
+		('probabilities', nrows * time_per_row),
+		('unrelated associations', npartial * (time_per_partial + time_per_partial_primary * nprimary)),
+		('writing', nprimary * time_per_group + nrows * time_per_row),
+	])
+	stage_memory = max(list(memory.values())[1:])
+	total_runtime = sum(runtime.values())
+
+	result = OrderedDict([
+		('sources', nsources),
+		('sample', sampled),
+		('candidates_density', nprimary * per_primary),
+		('candidates_hashed', nhashed),
+		('candidates', nrows),
+		('memory', memory),
+		('peak_memory', memory['inputs'] + stage_memory),
+		('runtime', runtime),
+		('total_runtime', total_runtime),
+		('memory_limit', memory_limit),
+	])
+
+	# choose the largest tiles whose stages fit into memory
+	tile_nside = None
+	tile_peak = None
+	budget = None if memory_limit is None else memory_limit - memory['inputs']
+	if budget is not None and memory['inputs'] + stage_memory > memory_limit:
+		max_nside = match.get_healpix_nside(err)
+		ra0, dec0 = radectables[0]
+		tiles = numpy.concatenate([tiling._pixels(numpy.asarray(ra0[lo:lo+tiling.default_chunk_size], dtype=float),
+			numpy.asarray(dec0[lo:lo+tiling.default_chunk_size], dtype=float), max_nside)[2]
+			for lo in range(0, nprimary, tiling.default_chunk_size)])
+		nside = 1
+		while nside <= max_nside:
+			shift = 2 * int(round(numpy.log2(max_nside // nside)))
+			largest = numpy.unique(tiles >> shift, return_counts=True)[1].max()
+			tile_nside = nside
+			tile_peak = stage_memory * largest / nprimary
+			if tile_peak < budget:
+				break
+			nside *= 2
+
+	# split long runs into shards
+	shards = None
+	if total_runtime > target_runtime:
+		shards = int(numpy.ceil(total_runtime / target_runtime))
+		if tile_nside is None:
+			# enough tiles to distribute
+			tile_nside = 1
+			ra0, dec0 = radectables[0]
+			while len(tiling.tile_rows(ra0, dec0, tile_nside)) < 4 * shards and tile_nside < match.get_healpix_nside(err):
+				tile_nside *= 2
+
+	if budget is not None:
+		# chunk working memory: at most a tenth of the memory available
+		chunk_size = min(chunk_size, max(10000, _round_chunk_size(max(1, budget // 10 // (computed_row * 3)))))
+
+	if shards is not None:
+		engine = 'sharded'
+	elif tile_nside is not None:
+		engine = 'tiled'
+	else:
+		engine = 'single'
+	result['recommended'] = OrderedDict([
+		('engine', engine),
+		('tile_nside', tile_nside),
+		('tile_peak_memory', tile_peak),
+		('shards', shards),
+		('chunk_size', chunk_size),
+		('spill', tile_peak is not None and tile_peak > budget),
+	])
+	return result
+
+def _format_time(seconds):
+	if seconds < 120:
+		return '%.0fs' % seconds
+	if seconds < 7200:
+		return '%.0fmin' % (seconds / 60)
+	return '%.1fh' % (seconds / 3600)
+
+def format_plan(result):
+	"""
+	Human-readable description of a plan, as a list of lines.
+	"""
+	sampled = result['sample']
+	recommended = result['recommended']
+	lines = [
+		'sources: %s' % ', '.join(['%d' % n for n in result['sources']]),
+		'candidates expected from the source densities: %d' % result['candidates_density'],
+		'hashing sample of %d primary sources: %d combinations, %d within the radius' % (
+			sampled['nsample'], sampled['nhashed'], sampled['nrows']),
+		'predicted candidates after hashing: %d' % result['candidates_hashed'],
+		'predicted candidate rows (output size): %d' % result['candidates'],
+		'predicted memory:',
+	] + ['    %-24s %s' % (stage, format_size(nbytes)) for stage, nbytes in result['memory'].items()] + [
+		'    %-24s %s' % ('peak', format_size(result['peak_memory'])),
+		'predicted run time:',
+	] + ['    %-24s %s' % (stage, _format_time(seconds)) for stage, seconds in result['runtime'].items()] + [
+		'    %-24s %s' % ('total', _format_time(result['total_runtime'])),
+		'memory available: %s' % (format_size(result['memory_limit']) if result['memory_limit'] is not None else 'unknown'),
+		'recommended: %s run' % recommended['engine'],
+	]
+	if recommended['tile_nside'] is not None:
+		lines.append('    --tile-nside %d%s' % (recommended['tile_nside'],
+			' (largest tile needs ~%s)' % format_size(recommended['tile_peak_memory']) if recommended['tile_peak_memory'] is not None else ''))
+	if recommended['shards'] is not None:
+		lines.append('    --shards %d' % recommended['shards'])
+	lines.append('    --chunk-size %d' % recommended['chunk_size'])
+	if recommended['spill']:
+		lines.append('    --memory-limit %s (even the smallest tiles do not fit into memory)' % format_size(result['memory_limit'] // 2))
+	return lines
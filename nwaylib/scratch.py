@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+__doc__ = """
+Memory-budgeted allocation of large intermediate arrays.
+
+Arrays are allocated in memory as long as the total size allocated so far
+stays within the memory limit. Beyond, they are placed in memory-mapped
+files in a scratch directory, so that a too large run slows down
+(the operating system pages them to disk) instead of running out of memory.
+The scratch files are unlinked immediately; their disk space is freed when
+the last array using them is released, also if the program is killed.
+
+Example:
+
+	scratch = ScratchSpace(memory_limit=parse_size('4G'))
+	post = scratch.apply(bayesdist.posterior, prior, log_bf)
+"""
+
+import tempfile
+import numpy
+
+default_chunk_size = 1000000
+
+_size_units = dict(K=1024, M=1024**2, G=1024**3, T=1024**4)
+
+def parse_size(text):
+	"""
+	Number of bytes of a size like "800M", "16G" or "1.5T" (or a plain number).
+	"""
+	text = text.strip().upper().rstrip('B')
+	unit = 1
+	if text and text[-1] in _size_units:
+		unit = _size_units[text[-1]]
+		text = text[:-1]
+	try:
+		size = int(float(text) * unit)
+	except ValueError:
+		raise ValueError('invalid size "%s", expected for example 800M or 16G' % text)
+	assert size > 0, 'size has to be positive'
+	return size
+
+def format_size(nbytes):
+	for unit in 'TGMK':
+		if nbytes >= _size_units[unit]:
+			return '%.1f%s' % (nbytes / _size_units[unit], unit)
+	return '%dB' % nbytes
+
+class ScratchSpace(object):
+	"""
+	Allocator of intermediate arrays under a memory budget.
+
+	memory_limit: number of bytes to keep in memory. If None, all arrays
+		are kept in memory, and the arrays are computed in one go.
+	directory: where to put the scratch files. By default, the system
+		temporary directory (TMPDIR).
+	chunk_size: number of rows computed at a time under a memory limit.
+
+	All arrays allocated count towards the budget until the scratch space
+	is released, so the budget is an upper bound of the memory used.
+	"""
+	def __init__(self, memory_limit=None, directory=None, chunk_size=default_chunk_size):
+		self.memory_limit = memory_limit
+		self.directory = directory
+		self.chunk_size = chunk_size
+		self.allocated = 0
+		self.spilled = 0
+
+	def chunks(self, n):
+		"""
+		Slices for computing n rows chunk by chunk (a single one without memory limit).
+		"""
+		if self.memory_limit is None:
+			return [slice(0, n)]
+		return [slice(lo, lo + self.chunk_size) for lo in range(0, n, self.chunk_size)]
+
+	def empty(self, shape, dtype=float):
+		"""
+		Uninitialised array, in memory or, if the budget is exhausted, memory-mapped.
+		"""
+		shape = tuple(numpy.atleast_1d(shape))
+		nbytes = int(numpy.prod(shape)) * numpy.dtype(dtype).itemsize
+		if self.memory_limit is None or self.allocated + nbytes <= self.memory_limit or nbytes == 0:
+			self.allocated += nbytes
+			return numpy.empty(shape, dtype=dtype)
+		self.spilled += nbytes
+		with tempfile.TemporaryFile(prefix='nway-scratch-', dir=self.directory) as f:
+			return numpy.memmap(f, dtype=dtype, mode='w+', shape=shape)
+
+	def full(self, shape, value, dtype=float):
+		array = self.empty(shape, dtype=dtype)
+		for s in self.chunks(len(array)):
+			array[s] = value
+		return array
+
+	def store(self, array):
+		"""
+		The array, moved to a memory-mapped file if the budget is exhausted.
+		"""
+		if self.memory_limit is None:
+			return array
+		out = self.empty(array.shape, dtype=array.dtype)
+		for s in self.chunks(len(array)):
+			out[s] = array[s]
+		return out
+
+	def take(self, array, indices):
+		"""
+		array[indices], gathered chunk by chunk.
+		"""
+		if self.memory_limit is None:
+			return array[indices]
+		out = self.empty((len(indices),) + array.shape[1:], dtype=array.dtype)
+		for s in self.chunks(len(indices)):
+			out[s] = array[indices[s]]
+		return out
+
+	def compress(self, array, mask):
+		"""
+		array[mask] for a boolean mask, chunk by chunk.
+		"""
+		if self.memory_limit is None:
+			return array[mask]
+		out = self.empty((int(mask.sum()),) + array.shape[1:], dtype=array.dtype)
+		lo = 0
+		for s in self.chunks(len(mask)):
+			part = array[s][mask[s]]
+			out[lo:lo+len(part)] = part
+			lo += len(part)
+		return out
+
+	def astype(self, array, dtype):
+		"""
+		Copy of the array converted to dtype, chunk by chunk.
+		"""
+		return self.apply(lambda a: a, array, dtype=dtype)
+
+	def apply(self, func, *arrays, **kwargs):
+		"""
+		Elementwise func(*arrays), computed chunk by chunk
+		into an array of type dtype (default: float).
+		"""
+		dtype = kwargs.pop('dtype', float)
+		assert not kwargs, kwargs
+		if self.memory_limit is None:
+			return numpy.asarray(func(*arrays), dtype=dtype)
+		out = self.empty(len(arrays[0]), dtype=dtype)
+		for s in self.chunks(len(out)):
+			out[s] = func(*[a[s] for a in arrays])
+		return out
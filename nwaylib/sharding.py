@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+__doc__ = """
+Splitting one tiled nway run into shards, which independent nway.py
+processes (e.g., on different batch nodes) compute.
+
+The shard manifest is a JSON file on a shared file system. It records
+the nway.py arguments, fingerprints of the input files, the sky tiles
+of each shard and the magnitude histograms, so that all shards use
+the same priors. Each worker writes its own partial output file,
+and the partial outputs are combined afterwards (nway-merge-shards.py).
+
+Workflow:
+  nway.py <arguments> --tile-nside 64 --shards 100 --manifest run.json
+  nway.py --manifest run.json --shard 0    (... up to 99, on any node)
+  nway-merge-shards.py run.json
+"""
+
+import os
+import json
+import hashlib
+import numpy
+from collections import OrderedDict
+
+manifest_version = 1
+
+def fingerprint(filename, head_size=1024*1024):
+	"""
+	Cheap fingerprint of a file: size, modification time and
+	checksum of the beginning (which holds the headers).
+	"""
+	stat = os.stat(filename)
+	with open(filename, 'rb') as f:
+		head = f.read(head_size)
+	return dict(filename=filename, size=stat.st_size, mtime=int(stat.st_mtime),
+		sha1_head=hashlib.sha1(head).hexdigest())
+
+def split_tiles(tiles, costs, nshards):
+	"""
+	Split the sorted list of tiles into nshards (at most one per tile)
+	contiguous shards of similar cost (e.g., number of sources in the tile).
+
+	Contiguous shards keep the output order of a single tiled run
+	when the shards are merged in order.
+	"""
+	assert len(tiles) == len(costs)
+	nshards = max(1, min(nshards, len(tiles)))
+	cumcost = numpy.cumsum(costs, dtype=float)
+	# cut where the cumulative cost crosses multiples of total/nshards
+	cuts = numpy.searchsorted(cumcost, cumcost[-1] * numpy.arange(1, nshards) / nshards) + 1
+	# leave at least one tile for each shard, also next to expensive tiles
+	cuts = numpy.clip(cuts, numpy.arange(1, nshards), len(tiles) - nshards + numpy.arange(1, nshards))
+	cuts = numpy.maximum.accumulate(cuts - numpy.arange(1, nshards)) + numpy.arange(1, nshards)
+	bounds = [0] + [int(c) for c in cuts] + [len(tiles)]
+	return [[int(t) for t in tiles[lo:hi]] for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo]
+
+def strip_arguments(argv, options):
+	"""
+	Remove options (with their value) from a list of command line arguments.
+	"""
+	result = []
+	skip = False
+	for a in argv:
+		if skip:
+			skip = False
+		elif a in options:
+			skip = True
+		elif any(a.startswith(o + '=') for o in options):
+			pass
+		else:
+			result.append(a)
+	return result
+
+def _manifest_id(manifest):
+	content = dict([(k, v) for k, v in manifest.items() if k != 'id'])
+	return hashlib.sha1(json.dumps(content, sort_keys=True).encode()).hexdigest()[:16]
+
+def shard_filename(manifest, shard):
+	"""
+	Name of the partial output file of a shard.
+	"""
+	base, ext = os.path.splitext(manifest['output'])
+	return os.path.join(manifest['directory'], '%s-shard%04d%s' % (base, shard, ext))
+
+def write_manifest(filename, arguments, inputs, output, out_format, tile_nside, shards, magnitude_histograms, grid_priors={}):
+	"""
+	Write a shard manifest.
+
+	arguments: nway.py command line arguments (without the sharding options)
+	inputs: input file names
+	output: final output file name
+	out_format: fits or parquet
+	tile_nside: HEALPix nside of the tiles
+	shards: list of the tiles of each shard
+	magnitude_histograms: for each magnitude column (<table>:<column>),
+		the histogram (bins, hist_sel, hist_all) to use.
+	grid_priors: for each joint prior (<table>:<column1>,<column2>),
+		the grid (edges, cells, hist_sel, hist_all) to use.
+
+	Returns the manifest.
+	"""
+	manifest = OrderedDict([
+		('version', manifest_version),
+		('directory', os.getcwd()),
+		('arguments', list(arguments)),
+		('inputs', [fingerprint(f) for f in inputs]),
+		('output', output),
+		('out_format', out_format),
+		('tile_nside', tile_nside),
+		('shards', shards),
+		('magnitude_histograms', dict([(mag, dict(bins=list(map(float, bins)),
+			selected=list(map(float, hist_sel)), others=list(map(float, hist_all))))
+			for mag, (bins, hist_sel, hist_all) in magnitude_histograms.items()])),
+		('grid_priors', dict([(spec, dict(edges=[list(map(float, e)) for e in edges], cells=list(map(int, cells)),
+			selected=list(map(float, hist_sel)), others=list(map(float, hist_all))))
+			for spec, (edges, cells, hist_sel, hist_all) in grid_priors.items()])),
+	])
+	manifest['id'] = _manifest_id(manifest)
+	with open(filename, 'w') as f:
+		json.dump(manifest, f, indent=1)
+	return manifest
+
+def read_manifest(filename):
+	"""
+	Read a shard manifest, and check that it is complete.
+	"""
+	with open(filename) as f:
+		manifest = json.load(f)
+	assert manifest.get('version') == manifest_version, 'unsupported manifest version in "%s"' % filename
+	assert manifest.get('id') == _manifest_id(manifest), 'manifest "%s" was modified or is incomplete' % filename
+	return manifest
+
+def magnitude_histograms(manifest):
+	"""
+	The magnitude histograms of the manifest, as (bins, hist_sel, hist_all) for each magnitude column.
+	"""
+	return dict([(mag, (numpy.array(h['bins']), numpy.array(h['selected']), numpy.array(h['others'])))
+		for mag, h in manifest['magnitude_histograms'].items()])
+
+def grid_priors(manifest):
+	"""
+	The joint priors of the manifest, as (edges, cells, hist_sel, hist_all) for each set of columns.
+	"""
+	return dict([(spec, ([numpy.array(e) for e in g['edges']], numpy.array(g['cells'], dtype=int), 
+		numpy.array(g['selected']), numpy.array(g['others'])))
+		for spec, g in manifest.get('grid_priors', {}).items()])
+
+def check_inputs(manifest):
+	"""
+	Verify that the input files have not changed since the manifest was written.
+	"""
+	for expected in manifest['inputs']:
+		filename = os.path.join(manifest['directory'], expected['filename'])
+		assert os.path.exists(filename), 'input file "%s" of the manifest not found' % filename
+		found = fingerprint(filename)
+		for k in 'size', 'mtime', 'sha1_head':
+			assert found[k] == expected[k], 'input file "%s" changed since the manifest was written (%s: %s, expected %s)' % (
+				filename, k, found[k], expected[k])
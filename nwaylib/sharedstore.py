@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+__doc__ = """
+Sharing catalogue columns with worker processes without copying them.
+
+The parent process publishes each array once into a scratch directory
+(in memory under /dev/shm, where available). Tasks only pass the small,
+picklable handles; workers attach to them as read-only memory maps.
+The scratch directory is removed when the store is closed, also on
+errors and at interpreter exit.
+
+Example:
+
+	with SharedArrays() as store:
+		store.publish('OPT_ra', ra)
+		pool.map(work, [(store.handles, rows) for rows in tasks])
+
+	def work(args):
+		handles, rows = args
+		ra = attach(handles)['OPT_ra'][rows]
+"""
+
+import os
+import atexit
+import shutil
+import tempfile
+import numpy
+
+default_chunk_size = 1000000
+
+def default_directory():
+	# in-memory file system, if available
+	if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+		return '/dev/shm'
+	return None
+
+class SharedArrays(object):
+	"""
+	Store of named arrays, published once for worker processes.
+
+	directory: where to put the scratch directory. By default /dev/shm
+		if available, otherwise the system temporary directory.
+	"""
+	def __init__(self, directory=None):
+		self.directory = tempfile.mkdtemp(prefix='nway-shared-', dir=directory or default_directory())
+		self.handles = {}
+		atexit.register(self.close)
+
+	def publish(self, name, array, chunk_size=default_chunk_size):
+		"""
+		Copy array into the store, in native byte order.
+		Big-endian (FITS) columns are converted chunk by chunk.
+
+		Returns a read-only view of the stored array.
+		"""
+		assert name not in self.handles, 'array "%s" already published' % name
+		assert self.directory is not None, 'store is closed'
+		dtype = numpy.dtype(array.dtype).newbyteorder('=')
+		filename = os.path.join(self.directory, '%d.npy' % len(self.handles))
+		stored = numpy.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=numpy.shape(array))
+		for lo in range(0, len(array), chunk_size):
+			stored[lo:lo+chunk_size] = array[lo:lo+chunk_size]
+		stored.flush()
+		del stored
+		self.handles[name] = filename
+		return attach(self.handles)[name]
+
+	def close(self):
+		"""
+		Remove the stored arrays. Views already attached in other
+		processes stay valid until they are released.
+		"""
+		if self.directory is not None:
+			shutil.rmtree(self.directory, ignore_errors=True)
+			self.directory = None
+			_attached.clear()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+_attached = {}
+
+def attach(handles):
+	"""
+	Read-only views of the published arrays, as a dictionary by name.
+	Each array is only opened once per process.
+	"""
+	views = {}
+	for name, filename in handles.items():
+		if filename not in _attached:
+			_attached[filename] = numpy.load(filename, mmap_mode='r')
+		views[name] = _attached[filename]
+	return views
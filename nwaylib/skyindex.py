@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+__doc__ = """
+Spatial index of a catalogue, for matching many small batches of
+positions against it (see Catalogue and match_batch).
+
+The sources are sorted by their HEALPix pixel (nested scheme), with
+pixels large enough that the sources within the search radius of a
+position lie in its pixel or a neighbouring one (see
+fastskymatch.get_healpix_nside). The candidates of a position are then
+found in nine contiguous ranges of the sorted catalogue, without hashing
+the catalogue again.
+"""
+
+import numpy
+import healpy
+from . import fastskymatch as match
+
+class SkyIndex(object):
+	"""
+	Index of the positions ra, dec (in degrees) for searches within radius (in degrees).
+	"""
+	def __init__(self, ra, dec, radius):
+		self.ra = numpy.asarray(ra, dtype=float)
+		self.dec = numpy.asarray(dec, dtype=float)
+		self.radius = radius
+		self.nside = match.get_healpix_nside(radius)
+		pixels = healpy.ang2pix(self.nside, self.ra, self.dec, nest=True, lonlat=True)
+		self.order = numpy.argsort(pixels, kind='mergesort')
+		self.pixels = pixels[self.order]
+
+	def __len__(self):
+		return len(self.ra)
+
+	def cells(self, ra, dec):
+		"""
+		The pixels to search for each position: its own and the
+		neighbouring ones. The same for all indexes of the same radius.
+
+		Returns the position number and the pixel of each.
+		"""
+		ra = numpy.atleast_1d(numpy.asarray(ra, dtype=float))
+		dec = numpy.atleast_1d(numpy.asarray(dec, dtype=float))
+		n = len(ra)
+		# the pixel of each position and its neighbours (-1 where there is none)
+		cells = numpy.vstack((healpy.ang2pix(self.nside, ra, dec, nest=True, lonlat=True).reshape((1, -1)),
+			healpy.get_all_neighbours(self.nside, ra, dec, nest=True, lonlat=True).reshape((8, n))))
+		owner = numpy.tile(numpy.arange(n), 9)
+		cells = cells.reshape((-1,))
+		keep = cells >= 0
+		owner, cells = owner[keep], cells[keep]
+		# each pixel only once per position
+		_, unique = numpy.unique(owner * healpy.nside2npix(self.nside) + cells, return_index=True)
+		return owner[unique], cells[unique]
+
+	def pairs(self, ra, dec, cells=None):
+		"""
+		Finds the sources within radius of each position.
+		cells: the result of cells(ra, dec), if already known.
+
+		Returns the pairs of rows (position, source), sorted,
+		and their separations in degrees.
+		"""
+		ra = numpy.atleast_1d(numpy.asarray(ra, dtype=float))
+		dec = numpy.atleast_1d(numpy.asarray(dec, dtype=float))
+		owner, cells = self.cells(ra, dec) if cells is None else cells
+		lo = numpy.searchsorted(self.pixels, cells, side='left')
+		counts = numpy.searchsorted(self.pixels, cells, side='right') - lo
+		i = numpy.repeat(owner, counts)
+		k = self.order[numpy.repeat(lo - (numpy.cumsum(counts) - counts), counts) + numpy.arange(counts.sum())]
+		separation = match.dist((ra[i], dec[i]), (self.ra[k], self.dec[k]))
+		# the exact cut is left to the matching
+		within = separation <= self.radius * (1 + 1e-6)
+		i, k, separation = i[within], k[within], separation[within]
+		order = numpy.lexsort((k, i))
+		return i[order], k[order], separation[order]
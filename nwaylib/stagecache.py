@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+__doc__ = """
+Cache of the results of the stages of a match (--stage-cache).
+
+Each stage result (e.g., the candidate table of a tile, or its distance
+Bayes factors) is stored in a directory named by a fingerprint of
+everything it depends on (see histcache.fingerprint): one .npy file per
+array and an index with the array names and further (JSON) information.
+Later runs with the same inputs and parameters memory-map the arrays
+instead of computing them again, so that changing, e.g., only
+--prior-completeness or --acceptable-prob recomputes only the stages
+which depend on it.
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import numpy
+from collections import OrderedDict
+
+# changes whenever the stored stage results change
+format_version = 1
+
+class StageCache(object):
+	"""
+	Directory of stage results, by fingerprint.
+	"""
+	def __init__(self, directory):
+		self.directory = directory
+
+	def path(self, key):
+		return os.path.join(self.directory, key)
+
+	def load(self, key):
+		"""
+		Returns the arrays (an OrderedDict of read-only memory-mapped
+		arrays) and the information stored with them,
+		or None if not cached.
+		"""
+		path = self.path(key)
+		indexfile = os.path.join(path, 'index.json')
+		if not os.path.exists(indexfile):
+			return None
+		with open(indexfile) as f:
+			index = json.load(f)
+		if index['version'] != format_version:
+			return None
+		arrays = OrderedDict([(name, numpy.load(os.path.join(path, '%d.npy' % i), mmap_mode='r'))
+			for i, name in enumerate(index['arrays'])])
+		return arrays, index['info']
+
+	def store(self, key, arrays, info={}):
+		"""
+		Store the arrays (a list of name, array) and information
+		(JSON-serialisable). The stage result appears at once, so
+		concurrent runs never see a partial one.
+		"""
+		if not os.path.exists(self.directory):
+			try:
+				os.makedirs(self.directory)
+			except OSError:
+				# created concurrently
+				assert os.path.isdir(self.directory), self.directory
+		tmpdir = tempfile.mkdtemp(prefix='.' + key, dir=self.directory)
+		try:
+			names = []
+			for i, (name, array) in enumerate(arrays):
+				numpy.save(os.path.join(tmpdir, '%d.npy' % i), numpy.asarray(array))
+				names.append(name)
+			with open(os.path.join(tmpdir, 'index.json'), 'w') as f:
+				json.dump(dict(version=format_version, arrays=names, info=info), f)
+			try:
+				os.rename(tmpdir, self.path(key))
+			except OSError:
+				# stored concurrently
+				assert os.path.isdir(self.path(key)), self.path(key)
+		finally:
+			if os.path.exists(tmpdir):
+				shutil.rmtree(tmpdir)
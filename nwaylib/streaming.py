@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+__doc__ = """
+Reading primary sources as they arrive, for matching them in small
+batches against catalogues kept in memory (nway.py --stream).
+
+The sources are newline-delimited JSON records (one object per line),
+read from a pipe until it is closed, or from a file which is followed
+as it grows.
+"""
+
+import os
+import sys
+import time
+import json
+import select
+import numpy
+
+def read_batches(fd, batch_size, wait, follow=False):
+	"""
+	Yields the lines (bytes) arriving on file descriptor fd, in batches
+	of up to batch_size lines. A line waits at most about wait seconds
+	before its batch is yielded.
+
+	follow: at the end of the file, wait for more lines (like tail -f)
+		instead of stopping
+	"""
+	buffered = b''
+	lines = []
+	first = None
+	while True:
+		if lines:
+			timeout = first + wait - time.time()
+			if timeout <= 0 or not select.select([fd], [], [], timeout)[0]:
+				yield lines
+				lines = []
+				continue
+		data = os.read(fd, 1 << 16)
+		if not data:
+			# end of the file, or the pipe was closed
+			if not follow and buffered.strip():
+				lines.append(buffered)
+				buffered = b''
+			if lines:
+				yield lines
+				lines = []
+			if not follow:
+				return
+			time.sleep(wait)
+			continue
+		parts = (buffered + data).split(b'\n')
+		buffered = parts.pop()
+		if not lines:
+			first = time.time()
+		lines += [line for line in parts if line.strip()]
+		while len(lines) >= batch_size:
+			yield lines[:batch_size]
+			lines = lines[batch_size:]
+			first = time.time()
+
+def parse_records(lines):
+	"""
+	Decode JSON records, skipping (with a warning) lines which are not JSON objects.
+	"""
+	records = []
+	for line in lines:
+		try:
+			record = json.loads(line.decode('utf-8'))
+		except ValueError:
+			record = None
+		if not isinstance(record, dict):
+			sys.stderr.write('WARNING: skipping a line which is not a JSON object: %r\n' % line[:100])
+			continue
+		records.append(record)
+	return records
+
+def record_fields(record):
+	"""
+	Fields of a record and their type: int for integers, float for
+	other numbers (and null), otherwise str.
+	"""
+	def kind(value):
+		if isinstance(value, int) and not isinstance(value, bool):
+			return int
+		return float if value is None or isinstance(value, (int, float)) else str
+	return [(k, kind(v)) for k, v in record.items()]
+
+def records_table(records, fields):
+	"""
+	Structured array of the records, with the columns given by
+	record_fields. Missing values are -99 for integers, nan for
+	other numbers and empty strings.
+	"""
+	columns = []
+	for k, kind in fields:
+		values = [r.get(k) for r in records]
+		if kind is int:
+			column = numpy.array([-99 if v is None else v for v in values])
+			assert column.dtype.kind in 'iu', 'field "%s" should have integer values, like in the first record: %s' % (k, column)
+		elif kind is float:
+			column = numpy.array([numpy.nan if v is None else v for v in values], dtype=float)
+		else:
+			column = numpy.array(['' if v is None else str(v) for v in values], dtype=str)
+		columns.append(column)
+	return numpy.rec.fromarrays(columns, names=[k for k, kind in fields])
@@ -0,0 +1,557 @@
+"""
+Reading nway input catalogues and writing nway output tables.
+
+Input catalogues can be FITS binary tables, Parquet files, HDF5 files or
+CSV files (see open_table). Columns are loaded only when they are used,
+and memory-mapped where the format allows.
+
+Besides FITS (see fastskymatch.wraptable2fits), the output can be written as
+compressed, columnar Parquet files. The rows are grouped so that all
+candidates of a primary source fall into the same row group, and the run
+information (TABLES, COLS_RA, COL_PRIM, BIASING, NWAYCMD, ...) is stored
+in the key-value metadata of the file.
+
+Both formats can be written incrementally, chunk by chunk, with
+FITSTableWriter and ParquetTableWriter. For streams of matches,
+NDJSONTableWriter writes newline-delimited JSON records.
+
+Parquet support requires the optional pyarrow package, HDF5 support
+the optional h5py package.
+"""
+from __future__ import print_function, division
+import io
+import os
+import json
+from collections import OrderedDict
+import numpy
+import astropy.io.fits as pyfits
+
+default_row_group_size = 100000
+
+def _import_pyarrow():
+	try:
+		import pyarrow
+		import pyarrow.parquet
+	except ImportError:
+		raise ImportError('Parquet files need the pyarrow package. Install it with "pip install pyarrow".')
+	return pyarrow, pyarrow.parquet
+
+def group_starts(primary_ids):
+	"""
+	Start index of each run of identical primary ids.
+	The candidates of one primary source are always contiguous in nway output.
+	"""
+	primary_ids = numpy.asarray(primary_ids)
+	if len(primary_ids) == 0:
+		return numpy.zeros(0, dtype=int)
+	changes = numpy.where(primary_ids[1:] != primary_ids[:-1])[0] + 1
+	return numpy.hstack(([0], changes))
+
+def row_group_ranges(primary_ids, row_group_size=default_row_group_size):
+	"""
+	Splits the table into (start, stop) ranges of about row_group_size rows,
+	cutting only where the primary id changes.
+	"""
+	n = len(primary_ids)
+	starts = group_starts(primary_ids)
+	ranges = []
+	lo = 0
+	while lo < n:
+		i = numpy.searchsorted(starts, lo + row_group_size)
+		hi = starts[i] if i < len(starts) else n
+		ranges.append((lo, hi))
+		lo = hi
+	return ranges
+
+def _arrow_array(pyarrow, values):
+	values = numpy.asarray(values)
+	if values.dtype.kind == 'S':
+		# FITS character columns
+		values = numpy.char.decode(values, 'ascii')
+	elif values.dtype.kind in 'biufc' and not values.dtype.isnative:
+		# FITS columns are big-endian, pyarrow needs native byte order
+		values = values.astype(values.dtype.newbyteorder('='))
+	if values.ndim > 1:
+		# vector columns
+		flat = _arrow_array(pyarrow, values.reshape((-1,)))
+		return pyarrow.FixedSizeListArray.from_arrays(flat, int(numpy.product(values.shape[1:])))
+	return pyarrow.array(values)
+
+def _arrow_metadata(metadata):
+	return {str(k).encode(): str(v).encode() for k, v in (metadata or {}).items()}
+
+class FITSTableWriter(object):
+	"""
+	Writes a FITS binary table incrementally.
+
+	The table header is written with the first chunk, further chunks
+	are appended as rows, and the number of rows in the header is
+	updated on close(). Only one chunk needs to be held in memory.
+
+	filename: output file
+	extname: name of the table extension
+	formats: dictionary of FITS column formats by column name.
+		Give these for character columns, otherwise the width is
+		chosen from the first chunk.
+	primary_hdu: primary HDU to write first (default: empty).
+	"""
+	def __init__(self, filename, extname, formats={}, primary_hdu=None):
+		self.filename = filename
+		self.extname = extname
+		self.formats = formats
+		self.primary_hdu = primary_hdu if primary_hdu is not None else pyfits.PrimaryHDU()
+		self.fileobj = None
+		self.header = None
+		self.header_offset = None
+		self.nrows = 0
+		self.nbytes = 0
+
+	def _encode(self, columns):
+		tbhdu = pyfits.BinTableHDU.from_columns(pyfits.ColDefs([
+			pyfits.Column(name=name, format=self.formats.get(name) or fits_format(values), array=values)
+			for name, values in columns]))
+		tbhdu.header['EXTNAME'] = self.extname
+		assert tbhdu.header['PCOUNT'] == 0, 'variable-length columns can not be written incrementally'
+		# let astropy do the conversion to the on-disk format
+		buf = io.BytesIO()
+		pyfits.HDUList([pyfits.PrimaryHDU(), tbhdu]).writeto(buf)
+		offset = len(pyfits.PrimaryHDU().header.tostring()) + len(tbhdu.header.tostring())
+		nbytes = tbhdu.header['NAXIS1'] * tbhdu.header['NAXIS2']
+		return tbhdu.header, buf.getvalue()[offset:offset + nbytes]
+
+	def write(self, columns):
+		"""
+		Append rows. columns: list of (name, array) pairs
+		"""
+		header, data = self._encode(columns)
+		if self.fileobj is None:
+			self.header = header
+			self.fileobj = open(self.filename, 'wb')
+			self.fileobj.write(self.primary_hdu.header.tostring().encode('ascii'))
+			self.header_offset = self.fileobj.tell()
+			self.fileobj.write(header.tostring().encode('ascii'))
+		else:
+			assert header['NAXIS1'] == self.header['NAXIS1'], ('columns changed between chunks', header, self.header)
+		self.fileobj.write(data)
+		self.nrows += header['NAXIS2']
+		self.nbytes += len(data)
+
+	def close(self):
+		"""
+		Finish the file: pad the data and update the number of rows.
+		"""
+		if self.fileobj is None:
+			return
+		padding = -self.nbytes % 2880
+		self.fileobj.write(b'\0' * padding)
+		self.header['NAXIS2'] = self.nrows
+		self.fileobj.seek(self.header_offset)
+		self.fileobj.write(self.header.tostring().encode('ascii'))
+		self.fileobj.close()
+		self.fileobj = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+_fits_type_codes = {'b1': 'L', 'u1': 'B', 'i1': 'B', 'i2': 'I', 'u2': 'I', 'i4': 'J', 'u4': 'J',
+	'i8': 'K', 'u8': 'K', 'f4': 'E', 'f8': 'D', 'c8': 'C', 'c16': 'M'}
+
+def fits_format(values):
+	"""
+	FITS format code for an array.
+	"""
+	values = numpy.asarray(values)
+	repeat = int(numpy.product(values.shape[1:]))
+	if values.dtype.kind == 'S':
+		return '%dA' % max(1, values.dtype.itemsize * repeat)
+	if values.dtype.kind == 'U':
+		return '%dA' % max(1, values.dtype.itemsize // 4 * repeat)
+	code = _fits_type_codes['%s%d' % (values.dtype.kind, values.dtype.itemsize)]
+	return code if repeat == 1 else '%d%s' % (repeat, code)
+
+class ParquetTableWriter(object):
+	"""
+	Writes a Parquet file incrementally, each chunk as one or more row groups.
+
+	filename: output file
+	metadata: dictionary stored in the key-value metadata of the file
+	row_group_size: maximum number of rows per row group
+	compression: Parquet compression codec
+	"""
+	def __init__(self, filename, metadata=None, row_group_size=default_row_group_size, compression='zstd'):
+		self.pyarrow, self.pq = _import_pyarrow()
+		self.filename = filename
+		self.metadata = metadata
+		self.row_group_size = row_group_size
+		self.compression = compression
+		self.writer = None
+		self.nrows = 0
+
+	def write(self, columns):
+		"""
+		Append rows. columns: list of (name, array) pairs
+		"""
+		pyarrow = self.pyarrow
+		chunk = pyarrow.Table.from_arrays(
+			[_arrow_array(pyarrow, values) for _, values in columns],
+			names=[name for name, _ in columns])
+		if self.writer is None:
+			schema = chunk.schema.with_metadata(_arrow_metadata(self.metadata))
+			self.writer = self.pq.ParquetWriter(self.filename, schema, compression=self.compression)
+		self.writer.write_table(chunk, row_group_size=max(1, min(len(chunk), self.row_group_size)))
+		self.nrows += len(chunk)
+
+	def close(self):
+		if self.writer is not None:
+			self.writer.close()
+			self.writer = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+class NDJSONTableWriter(object):
+	"""
+	Writes newline-delimited JSON, one object per row. Each chunk is
+	flushed when written, so that readers see complete rows. NaN values
+	are written as null.
+
+	filename: output file
+	"""
+	def __init__(self, filename):
+		self.filename = filename
+		self.fileobj = open(filename, 'w')
+		self.nrows = 0
+
+	def write(self, columns):
+		"""
+		Append rows. columns: list of (name, array) pairs
+		"""
+		names = [name for name, _ in columns]
+		values = [_json_values(values) for _, values in columns]
+		for row in zip(*values):
+			self.fileobj.write(json.dumps(OrderedDict(zip(names, row))) + '\n')
+		self.fileobj.flush()
+		self.nrows += len(values[0]) if values else 0
+
+	def close(self):
+		if self.fileobj is not None:
+			self.fileobj.close()
+			self.fileobj = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+def _json_values(values):
+	values = numpy.asarray(values)
+	if values.dtype.kind == 'S':
+		values = numpy.char.decode(values, 'ascii')
+	if values.dtype.kind == 'f':
+		return [None if v != v else v for v in values.tolist()]
+	return values.tolist()
+
+def write_parquet(filename, columns, metadata=None, primary_column=None,
+	row_group_size=default_row_group_size, compression='zstd'):
+	"""
+	Write columns to a Parquet file.
+
+	columns: list of (name, array) pairs
+	metadata: dictionary stored in the key-value metadata of the file
+	primary_column: name of the column with the primary catalogue IDs.
+		Row groups are aligned to where its value changes.
+		By default, the first column is used.
+	row_group_size: approximate number of rows per row group
+	compression: Parquet compression codec
+	"""
+	names = [name for name, _ in columns]
+	arrays = [numpy.asarray(values) for _, values in columns]
+	if primary_column is None:
+		primary_column = names[0]
+	ranges = row_group_ranges(arrays[names.index(primary_column)], row_group_size)
+
+	with ParquetTableWriter(filename, metadata=metadata, row_group_size=len(arrays[0]) + 1,
+			compression=compression) as writer:
+		for lo, hi in ranges or [(0, 0)]:
+			writer.write([(name, values[lo:hi]) for name, values in zip(names, arrays)])
+
+def to_parquet(table, filename, metadata=None, row_group_size=default_row_group_size, compression='zstd'):
+	"""
+	Write a nway_match result (pandas DataFrame) to a Parquet file.
+
+	Row groups are aligned to the primary catalogue index (first column).
+	See write_parquet.
+	"""
+	columns = [(k, table[k].values) for k in table.columns]
+	write_parquet(filename, columns, metadata=metadata, primary_column=table.columns[0],
+		row_group_size=row_group_size, compression=compression)
+
+def read_parquet_metadata(filename):
+	"""
+	Returns the key-value metadata of a Parquet file as a dictionary.
+	"""
+	pyarrow, pq = _import_pyarrow()
+	metadata = pq.read_schema(filename).metadata or {}
+	return {k.decode(): v.decode() for k, v in metadata.items()}
+
+def read_output(filename, chunk_size=default_row_group_size):
+	"""
+	Open an nway output file (FITS or Parquet, by the file name extension)
+	for reading chunk by chunk. Each chunk contains all rows of its primary
+	sources.
+
+	Returns the header (run information), the columns (a list of name and
+	FITS format, None for Parquet files), and a function returning a
+	generator of chunks (lists of (name, array)).
+	"""
+	if guess_format(filename) == 'parquet':
+		pyarrow, pq = _import_pyarrow()
+		parquet_file = pq.ParquetFile(filename)
+		columns = [(n, None) for n in parquet_file.schema_arrow.names]
+		def chunks():
+			# row groups are aligned to primary sources
+			for i in range(parquet_file.num_row_groups):
+				rows = parquet_file.read_row_group(i)
+				yield [(n, rows.column(n).to_numpy(zero_copy_only=False)) for n in rows.column_names]
+		return read_parquet_metadata(filename), columns, chunks
+	f = pyfits.open(filename, memmap=True)
+	data = f[1].data
+	def chunks():
+		for lo, hi in row_group_ranges(data[f[0].header['COL_PRIM']], chunk_size):
+			yield [(n, data[n][lo:hi]) for n in data.dtype.names]
+	return f[0].header, [(c.name, c.format) for c in f[1].columns], chunks
+
+
+class InputTable(object):
+	"""
+	An input catalogue.
+	
+	name: table name (used as prefix of output columns)
+	data: the table. Supports len(), data.dtype.names and data[column]
+	area: sky area covered in square degrees, None if unknown
+	formats: FITS format of each column (None where not known in advance)
+	"""
+	def __init__(self, filename, name, data, area, formats):
+		self.filename = filename
+		self.name = name
+		self.data = data
+		self.area = area
+		self.formats = formats
+
+def to_native(values, chunk_size=default_row_group_size):
+	"""
+	Copy of an array in native byte order. Big-endian (FITS) columns 
+	are read and converted chunk by chunk.
+	"""
+	native = numpy.empty(values.shape, dtype=values.dtype.newbyteorder('='))
+	for lo in range(0, len(values), chunk_size):
+		native[lo:lo+chunk_size] = values[lo:lo+chunk_size]
+	return native
+
+class CachedTable(object):
+	"""
+	A (memory-mapped) table, of which some columns are held in memory, 
+	in native byte order. The other columns are read from the table 
+	when accessed.
+	"""
+	def __init__(self, data):
+		self.data = data
+		self.dtype = data.dtype
+		self.columns = {}
+
+	def load(self, names):
+		"""
+		Read the given columns into memory.
+		"""
+		for n in names:
+			if n not in self.columns:
+				self.columns[n] = to_native(self.data[n])
+
+	def __getitem__(self, name):
+		if name in self.columns:
+			return self.columns[name]
+		return self.data[name]
+
+	def __len__(self):
+		return len(self.data)
+
+class ColumnTable(object):
+	"""
+	A table whose columns are loaded on first access, and then kept.
+	
+	Provides what nway needs from a numpy structured array or FITS table:
+	len(table), table.dtype.names and table[column].
+	
+	names: column names
+	nrows: number of rows (or a function returning it)
+	loader: function returning a dictionary of arrays for a list of column names
+	"""
+	def __init__(self, names, nrows, loader):
+		self.dtype = numpy.dtype([(n, 'f8') for n in names])
+		self._nrows = nrows
+		self.loader = loader
+		self.columns = {}
+
+	def load(self, names):
+		"""
+		Load the given columns (all at once, where the format allows).
+		"""
+		names = [n for n in names if n not in self.columns]
+		if names:
+			for n, values in self.loader(names).items():
+				values = numpy.asarray(values)
+				if values.dtype.kind == 'O':
+					values = values.astype('U')
+				self.columns[n] = values
+
+	def __getitem__(self, name):
+		if name not in self.columns:
+			if name not in self.dtype.names:
+				raise KeyError(name)
+			self.load([name])
+		return self.columns[name]
+
+	def __len__(self):
+		if callable(self._nrows):
+			self._nrows = self._nrows()
+		return self._nrows
+
+def _read_fits(filename):
+	# memory-mapped: columns are only read when accessed or loaded
+	fits_table = pyfits.open(filename, memmap=True)[1]
+	area = fits_table.header.get('SKYAREA')
+	return InputTable(filename, fits_table.name, CachedTable(fits_table.data),
+		None if area is None else area * 1.0, [c.format for c in fits_table.columns])
+
+def _read_parquet(filename):
+	pyarrow, pq = _import_pyarrow()
+	parquet_file = pq.ParquetFile(filename, memory_map=True)
+	names = parquet_file.schema_arrow.names
+	def loader(columns):
+		data = parquet_file.read(columns=columns)
+		return dict([(n, data.column(n).to_numpy()) for n in columns])
+	metadata = read_parquet_metadata(filename)
+	area = metadata.get('SKYAREA')
+	return InputTable(filename, metadata.get('EXTNAME'), ColumnTable(names, parquet_file.metadata.num_rows, loader),
+		None if area is None else float(area), [None] * len(names))
+
+def _import_h5py():
+	try:
+		import h5py
+	except ImportError:
+		raise ImportError('HDF5 files need the h5py package. Install it with "pip install h5py".')
+	return h5py
+
+def _hdf5_column(filename, dataset):
+	# contiguous, uncompressed datasets can be memory-mapped directly
+	offset = dataset.id.get_offset()
+	if dataset.chunks is None and dataset.compression is None and offset is not None and dataset.dtype.kind in 'biuf':
+		return numpy.memmap(filename, dtype=dataset.dtype, mode='r', offset=offset, shape=dataset.shape)
+	return dataset[()]
+
+def _read_hdf5(filename):
+	"""
+	Either a file with one 1-d dataset per column, or a file with a
+	compound (table) dataset. Metadata are read from the EXTNAME and 
+	SKYAREA attributes of the file or of the dataset.
+	"""
+	h5py = _import_h5py()
+	f = h5py.File(filename, 'r')
+	attrs = dict(f.attrs)
+	datasets = [k for k, v in f.items() if isinstance(v, h5py.Dataset)]
+	compound = [k for k in datasets if f[k].dtype.names is not None]
+	if compound:
+		dataset = f[compound[0]]
+		attrs.update(dataset.attrs)
+		names = list(dataset.dtype.names)
+		nrows = len(dataset)
+		def loader(columns):
+			return dict([(n, dataset[n]) for n in columns])
+	else:
+		names = [k for k in datasets if len(f[k].shape) == 1]
+		assert len(names) > 0, 'HDF5 file "%s" contains neither a table dataset nor column datasets' % filename
+		nrows = f[names[0]].shape[0]
+		def loader(columns):
+			return dict([(n, _hdf5_column(filename, f[n])) for n in columns])
+	name = attrs.get('EXTNAME')
+	if isinstance(name, bytes):
+		name = name.decode()
+	area = attrs.get('SKYAREA')
+	return InputTable(filename, name, ColumnTable(names, nrows, loader),
+		None if area is None else float(area), [None] * len(names))
+
+def _read_csv(filename):
+	"""
+	Comma-separated file with a header line. 
+	Comment lines (#) at the top of the form "# KEY = value" 
+	can give EXTNAME and SKYAREA.
+	
+	CSV files have to be parsed as a whole; the columns that are needed
+	should be loaded together with table.load(columns).
+	"""
+	import pandas
+	metadata = {}
+	with open(filename) as f:
+		for line in f:
+			if not line.startswith('#'):
+				break
+			key, _, value = line.lstrip('#').partition('=')
+			if value:
+				metadata[key.strip()] = value.strip().strip("'\"")
+	names = list(pandas.read_csv(filename, comment='#', nrows=0).columns)
+	def nrows():
+		return len(pandas.read_csv(filename, comment='#', usecols=[names[0]]))
+	def loader(columns):
+		data = pandas.read_csv(filename, comment='#', usecols=columns)
+		return dict([(n, data[n].values) for n in columns])
+	area = metadata.get('SKYAREA')
+	return InputTable(filename, metadata.get('EXTNAME'), ColumnTable(names, nrows, loader),
+		None if area is None else float(area), [None] * len(names))
+
+readers = {
+	'fits': _read_fits,
+	'parquet': _read_parquet,
+	'hdf5': _read_hdf5,
+	'csv': _read_csv,
+}
+
+def guess_format(filename):
+	"""
+	File format from the file name extension; FITS if unknown.
+	"""
+	name = filename.lower()
+	if name.endswith('.gz'):
+		name = name[:-3]
+	ext = os.path.splitext(name)[1]
+	if ext in ('.parquet', '.pq'):
+		return 'parquet'
+	if ext in ('.hdf5', '.h5', '.hdf'):
+		return 'hdf5'
+	if ext in ('.csv',):
+		return 'csv'
+	return 'fits'
+
+def open_table(filename, name=None, area=None, format=None):
+	"""
+	Open an input catalogue.
+	
+	filename: FITS, Parquet, HDF5 or CSV file
+	name: table name. If None, taken from the file (EXTNAME)
+	area: sky area in square degrees. If None, taken from the file (SKYAREA)
+	format: one of fits, parquet, hdf5, csv. If None, guessed from the file name.
+	
+	Returns an InputTable.
+	"""
+	table = readers[format or guess_format(filename)](filename)
+	if name is not None:
+		table.name = name
+	if area is not None:
+		table.area = float(area)
+	return table
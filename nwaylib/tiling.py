@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+__doc__ = """
+Splitting a match into HEALPix sky tiles.
+
+Each primary source belongs to exactly one tile. A tile also holds the
+secondary sources within the match radius of it (the margin), so that
+all candidates of its primary sources can be found in the tile alone.
+Tiles can therefore be matched independently, and each primary source
+group is computed exactly once.
+
+Pixels are computed in the same (nested) way as in fastskymatch.crossproduct.
+"""
+
+import numpy
+from numpy import pi
+import healpy
+from multiprocessing.pool import ThreadPool
+from . import fastskymatch as match
+
+default_chunk_size = 1000000
+
+def _pixels(ra, dec, nside):
+	phi = ra / 180 * pi
+	theta = dec / 180 * pi + pi/2.
+	i = healpy.pixelfunc.ang2pix(nside, phi=phi, theta=theta, nest=True)
+	return phi, theta, i
+
+def _unique_pairs(tiles, rows):
+	# sorted by tile, then row, without duplicates
+	order = numpy.lexsort((rows, tiles))
+	tiles, rows = tiles[order], rows[order]
+	keep = numpy.ones(len(tiles), dtype=bool)
+	keep[1:] = numpy.logical_or(tiles[1:] != tiles[:-1], rows[1:] != rows[:-1])
+	return tiles[keep], rows[keep]
+
+def tile_rows(ra, dec, nside, err=None, chunk_size=default_chunk_size):
+	"""
+	Assign sources to HEALPix tiles (nested scheme).
+
+	ra, dec: coordinates in degrees
+	nside: HEALPix nside of the tiles
+	err: margin in degrees. If set, sources are also assigned to all
+		tiles they are within err of. Otherwise, each source belongs
+		to the one tile it is located in.
+	chunk_size: number of sources processed at a time
+
+	Returns a dictionary of tile number to (sorted) row numbers.
+	"""
+	if err is not None:
+		# sources within err are in the same or in a neighbouring fine pixel
+		fine_nside = match.get_healpix_nside(err)
+		assert fine_nside >= nside, 'tiles (nside=%d) have to be larger than the match radius (allows nside<=%d)' % (nside, fine_nside)
+		shift = 2 * int(round(numpy.log2(fine_nside // nside)))
+	all_tiles = []
+	all_rows = []
+	for lo in range(0, len(ra), chunk_size):
+		ra_chunk = numpy.asarray(ra[lo:lo+chunk_size], dtype=float)
+		dec_chunk = numpy.asarray(dec[lo:lo+chunk_size], dtype=float)
+		rows = numpy.arange(lo, lo + len(ra_chunk))
+		if err is None:
+			_, _, tiles = _pixels(ra_chunk, dec_chunk, nside)
+		else:
+			phi, theta, i = _pixels(ra_chunk, dec_chunk, fine_nside)
+			j = healpy.pixelfunc.get_all_neighbours(fine_nside, phi=phi, theta=theta, nest=True)
+			pixels = numpy.vstack((i.reshape((1,-1)), j))
+			rows = numpy.broadcast_to(rows, pixels.shape)
+			# missing neighbours are marked with -1
+			mask = pixels >= 0
+			tiles = pixels[mask] >> shift
+			rows = rows[mask]
+			# most neighbours lie in the same tile
+			tiles, rows = _unique_pairs(tiles, rows)
+		all_tiles.append(tiles)
+		all_rows.append(rows)
+	if len(all_tiles) == 0:
+		return {}
+	tiles, rows = _unique_pairs(numpy.concatenate(all_tiles), numpy.concatenate(all_rows))
+	starts = numpy.where(numpy.hstack(([True], tiles[1:] != tiles[:-1])))[0]
+	ends = list(starts[1:]) + [len(tiles)]
+	return dict([(tiles[lo], rows[lo:hi]) for lo, hi in zip(starts, ends)])
+
+def iter_tiles(radectables, err, nside, chunk_size=default_chunk_size):
+	"""
+	Split a match into sky tiles.
+
+	radectables: list of (ra, dec) of each catalogue, the first is the primary catalogue
+	err: match radius in degrees
+	nside: HEALPix nside of the tiles
+
+	Yields for each tile containing primary sources the tile number and,
+	for each catalogue, the row numbers in the tile.
+	Primary sources are only in the tile they are located in,
+	secondary sources in all tiles within err.
+	"""
+	(ra, dec), others = radectables[0], radectables[1:]
+	primary_tiles = tile_rows(ra, dec, nside, chunk_size=chunk_size)
+	secondary_tiles = [tile_rows(ra, dec, nside, err=err, chunk_size=chunk_size) for ra, dec in others]
+	empty = numpy.zeros(0, dtype=int)
+	for tile in sorted(primary_tiles.keys()):
+		yield tile, [primary_tiles[tile]] + [t.get(tile, empty) for t in secondary_tiles]
+
+def prefetch(func, items):
+	"""
+	Yields func(item) for each item. The result for the next item is
+	computed in a background thread while the current one is used,
+	so that reading the inputs of the next tile overlaps with
+	processing and writing the current tile.
+	"""
+	pool = ThreadPool(1)
+	try:
+		pending = None
+		for item in items:
+			future = pool.apply_async(func, (item,))
+			if pending is not None:
+				yield pending.get()
+			pending = future
+		if pending is not None:
+			yield pending.get()
+	finally:
+		pool.close()
+		pool.join()
@@ -1,4 +1,5 @@
 import os
+import sys
 try:
 	from setuptools import setup
 except ImportError:
@@ -14,7 +15,9 @@ setup(
 	author='Johannes Buchner',
 	author_email='johannes.buchner.acad@gmx.com',
 	packages=['nwaylib'],
-	scripts=['nway.py', 'nway-write-header.py', 'nway-explain.py', 'nway-create-fake-catalogue.py', 'nway-create-shifted-catalogue.py', 'nway-calibrate-cutoff.py'],
+	scripts=['nway.py', 'nway-write-header.py', 'nway-explain.py', 'nway-create-fake-catalogue.py', 'nway-create-shifted-catalogue.py', 'nway-calibrate-cutoff.py', 'nway-join.py', 'nway-merge-shards.py'] +
+		# nway-serve.py uses asyncio
+		(['nway-serve.py'] if sys.version_info >= (3, 5) else []),
 	url='http://pypi.python.org/pypi/nway/',
 	license='AGPLv3 (see LICENSE file)',
 	description='Probabilistic Cross-Identification of Astronomical Sources',
@@ -29,6 +32,10 @@ setup(
 		"healpy",
 		"pandas",
 	],
+	extras_require={
+		'parquet': ["pyarrow"],
+		'hdf5': ["h5py"],
+	},
 	setup_requires=['pytest-runner'],
 	tests_require=['pytest'],
 )
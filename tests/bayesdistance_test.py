@@ -26,5 +26,40 @@ def test_log_bf():
 	print(log_bf(numpy.array([[numpy.nan + sep, sep, sep], [sep, numpy.nan + sep, sep], [sep, sep, numpy.nan + sep]]), 
 		[0.1 + q, 0.2 + q, 0.3 + q]))
 
+def test_log_bf_present():
+	import numpy.testing as test
+	sep = numpy.array([0., 0.1, 0.2, 0.3])
+	nan = numpy.nan + sep
+	errors = [0.1 + 0 * sep, 0.2 + 0 * sep, 0.3 + 0 * sep]
+	present = [sep == sep, numpy.array([True, False, True, False]), numpy.array([True, True, False, False])]
+	# the separations of absent sources are nan
+	p12 = numpy.where(present[1], sep, numpy.nan)
+	p13 = numpy.where(present[2], sep, numpy.nan)
+	p23 = numpy.where(present[1] & present[2], sep, numpy.nan)
+	r = log_bf_present([[nan, p12, p13], [nan, nan, p23], [nan, nan, nan]], errors, present)
+	test.assert_almost_equal(r[0], log_bf3(sep[0], sep[0], sep[0], 0.1, 0.2, 0.3))
+	test.assert_almost_equal(r[1], log_bf2(sep[1], 0.1, 0.3))
+	test.assert_almost_equal(r[2], log_bf2(sep[2], 0.1, 0.2))
+	assert r[3] == 0, r
+
+
 
 
+def test_group_posteriors():
+	rng = numpy.random.RandomState(1)
+	sizes = [1, 3, 2, 5, 1]
+	group_start = numpy.cumsum([0] + sizes[:-1])
+	log_post_weight = rng.normal(size=sum(sizes)) * 3
+	p_any, p_i, match_flag = group_posteriors(log_post_weight, group_start, 0.5)
+	# one group at a time
+	for lo, n in zip(group_start, sizes):
+		values = log_post_weight[lo:lo+n]
+		others = values[1:]
+		p_none = 10**values[0] / (10**values).sum()
+		numpy.testing.assert_allclose(p_any[lo:lo+n], 1 - p_none, atol=1e-12)
+		expected = numpy.zeros(n)
+		if n > 1:
+			expected[1:] = 10**others / (10**others).sum()
+		numpy.testing.assert_allclose(p_i[lo:lo+n], expected, atol=1e-12)
+		best = expected.max()
+		assert (match_flag[lo:lo+n] == numpy.where(expected == best, 1, numpy.where(expected > 0.5 * best, 2, 0))).all()
@@ -83,3 +83,83 @@ def test_match_5():
 
 
 
+
+def test_crowded_buckets():
+	# a crowded field: subdividing buckets keeps all combinations within err
+	numpy.random.seed(1)
+	err = 5 / 3600.
+	radectables = [(numpy.random.normal(150, 10 / 3600., n), numpy.random.normal(60, 10 / 3600., n)) for n in (100, 100, 50)]
+	def within_err(results):
+		max_separation = numpy.zeros(len(results))
+		radec = [(numpy.where(idx == -1, numpy.nan, ra[idx]), numpy.where(idx == -1, numpy.nan, dec[idx]))
+			for (ra, dec), idx in zip(radectables, results.transpose())]
+		for i in range(len(radec)):
+			for j in range(i):
+				max_separation = numpy.fmax(max_separation, dist(radec[i], radec[j]))
+		return set(map(tuple, results[max_separation < err]))
+	full = hash_crossproduct(radectables, err, logger=logger.NullOutputLogger(), max_bucket_product=10**12)
+	subdivided = hash_crossproduct(radectables, err, logger=logger.NullOutputLogger(), max_bucket_product=1000)
+	assert len(subdivided) < len(full)
+	assert within_err(subdivided) == within_err(full)
+
+def test_adaptive_radius():
+	# catalogue 0 has large errors, catalogues 1 and 2 small errors
+	pairs = adaptive_pair_radii([4., 0.1, 0.2], 3, 0.5, radius=15)
+	assert [(i, j) for i, j, r in pairs] == [(0, 1), (0, 2), (1, 2)]
+	assert abs(pairs[2][2] - (3 * 0.05**0.5 + 0.5)) < 1e-10
+	assert adaptive_pair_radii([4., 0.1], 5, 0.5, radius=15) == []
+	assert within_adaptive_radius(numpy.array([0.5, 2., numpy.nan]), 0.1, numpy.array([0.1, 0.1, 0.1]), 3, 0.5).tolist() == [True, False, True]
+
+	# pair-wise pre-filtering removes the combinations of distant pairs
+	numpy.random.seed(2)
+	err = 10 / 3600.
+	radectables = [(numpy.random.uniform(150, 150.1, n), numpy.random.uniform(2, 2.1, n)) for n in (100, 200, 200)]
+	full = hash_crossproduct(radectables, err, logger=logger.NullOutputLogger())
+	filtered = hash_crossproduct(radectables, err, logger=logger.NullOutputLogger(), pairwise_errs=[(1, 2, 1.)])
+	both = numpy.logical_and(filtered[:,1] >= 0, filtered[:,2] >= 0)
+	separation = dist((radectables[1][0][filtered[both,1]], radectables[1][1][filtered[both,1]]), 
+		(radectables[2][0][filtered[both,2]], radectables[2][1][filtered[both,2]])) * 60 * 60
+	assert len(filtered) < len(full)
+	assert (separation < 1).all()
+
+	# one source with a large error makes the catalogue pre-filter radii
+	# as wide as the search radius, but each pair is cut while hashing
+	errors = [numpy.append(10., numpy.ones(99) * 0.5), 0.1, numpy.random.uniform(0.1, 0.3, 200)]
+	assert len(adaptive_pair_radii([numpy.max(e) for e in errors], 3, 0.5, radius=10)) == 1
+	pair_radius = (3, 0.5, errors)
+	adaptive = hash_crossproduct(radectables, err, logger=logger.NullOutputLogger(), pair_radius=pair_radius)
+	expected = full[within_pair_radii(full, radectables, pair_radius=pair_radius)]
+	assert len(adaptive) < len(full) / 3, (len(adaptive), len(full))
+	assert (adaptive == expected).all()
+	assert (adaptive[:,0] == 0).sum() > (adaptive[:,0] == 1).sum()
+
+def test_max_candidates():
+	numpy.random.seed(3)
+	err = 10 / 3600.
+	radectables = [(numpy.random.uniform(150, 150.1, n), numpy.random.uniform(2, 2.1, n)) for n in (100, 400, 400)]
+	errors = [1., numpy.random.uniform(0.1, 1, 400), 0.5]
+	def within(results):
+		# combinations with all sources within err
+		max_separation = numpy.zeros(len(results))
+		for i in range(3):
+			for j in range(i):
+				both = numpy.logical_and(results[:,i] >= 0, results[:,j] >= 0)
+				sep = numpy.zeros(len(results))
+				sep[both] = dist((radectables[i][0][results[both,i]], radectables[i][1][results[both,i]]),
+					(radectables[j][0][results[both,j]], radectables[j][1][results[both,j]]))
+				max_separation = numpy.maximum(max_separation, sep)
+		return results[max_separation < err]
+	full = within(hash_crossproduct(radectables, err, logger=logger.NullOutputLogger()))
+	# without effective cap, the same combinations
+	capped = within(capped_crossproduct(radectables, err, errors, 1000, logger=logger.NullOutputLogger()))
+	assert (capped == full).all()
+	# at most 2 candidates of each catalogue per primary source
+	capped = within(capped_crossproduct(radectables, err, errors, 2, logger=logger.NullOutputLogger()))
+	assert len(capped) < len(full)
+	assert (numpy.bincount(capped[:,0]) <= 9).all()
+	for i in 1, 2:
+		pairs = numpy.unique(capped[capped[:,i] >= 0][:,[0, i]], axis=0)
+		assert (numpy.bincount(pairs[:,0]) <= 2).all()
+	kept_pairs, summary = nearest_candidates(radectables, err, errors, 2, logger=logger.NullOutputLogger())
+	assert summary['ndiscarded'] > 0
+	assert 0 < summary['max_posterior'] < 1
@@ -0,0 +1,29 @@
+from __future__ import print_function, division
+import numpy
+from nwaylib.footprint import *
+from nwaylib.fastskymatch import dist
+
+def test_footprint():
+	numpy.random.seed(1)
+	# primary in a small field, secondary over a larger area
+	ra, dec = numpy.random.uniform(150, 150.5, 400), numpy.random.uniform(2, 2.5, 400)
+	ra2, dec2 = numpy.random.uniform(148, 153, 20000), numpy.random.uniform(0, 5, 20000)
+	radius = 20 / 3600.
+	moc, rows = rows_in_footprint([(ra, dec), (ra2, dec2)], radius)
+	assert (rows[0] == numpy.arange(400)).all()
+	assert 0 < len(rows[1]) < 1000
+	# all secondary sources within radius of a primary source are kept
+	for i in range(len(ra)):
+		near = numpy.where(dist((ra[i], dec[i]), (ra2, dec2)) < radius)[0]
+		assert numpy.in1d(near, rows[1]).all()
+	# normalisation merges complete sets of sibling pixels
+	assert normalise(5, numpy.array([8, 9, 10, 11, 17]))[0][0] == 4
+	assert abs(area(normalise(5, numpy.arange(16))) - 16 * area([(5, numpy.array([0]))])) < 1e-10
+
+def test_write_moc():
+	moc = normalise(6, numpy.array([0, 1, 2, 3, 100, 4000]))
+	write_moc('test_footprint.fits', moc)
+	moc2 = read_moc('test_footprint.fits')
+	assert [o for o, p in moc] == [o for o, p in moc2]
+	for (o, p), (o2, p2) in zip(moc, moc2):
+		assert (p == p2).all()
@@ -0,0 +1,41 @@
+from __future__ import print_function, division
+import os
+import shutil
+import numpy
+from nwaylib.histcache import *
+
+def test_fingerprint():
+	a = numpy.arange(10.)
+	assert fingerprint(a, 0.9, 'OPT:MAG') == fingerprint(a.copy(), 0.9, 'OPT:MAG')
+	assert fingerprint(a, 0.9, 'OPT:MAG') == fingerprint(a.astype('>f8'), 0.9, 'OPT:MAG')
+	assert fingerprint(a, 0.9, 'OPT:MAG') != fingerprint(a, 0.8, 'OPT:MAG')
+	b = a.copy()
+	b[3] = 3.5
+	assert fingerprint(a, None) != fingerprint(b, None)
+	assert fingerprint([a, 1]) != fingerprint(a, 1)
+	# vector columns of the same values, but a different shape
+	assert fingerprint(a.reshape((5, 2))) != fingerprint(a.reshape((2, 5)))
+	assert fingerprint(a.reshape((5, 2))) == fingerprint(a.reshape((5, 2)).astype('>f8'))
+
+def test_cache():
+	directory = 'test_histcache'
+	shutil.rmtree(directory, ignore_errors=True)
+	cache = HistogramCache(directory)
+	key = fingerprint('test')
+	assert cache.load(key) is None
+	bins, hist_sel, hist_all = numpy.array([0.1, 1. / 3, 2.]), numpy.array([0.7, 0.3]), numpy.array([0.5, 0.5])
+	filename = cache.store(key, bins, hist_sel, hist_all)
+	assert os.path.exists(filename)
+	for stored, original in zip(cache.load(key), (bins, hist_sel, hist_all)):
+		assert (stored == original).all()
+	shutil.rmtree(directory)
+
+def test_grid_file():
+	edges = [numpy.array([10, 15.5, 20, 30]), numpy.array([-1, 0., 1. / 3])]
+	cells = numpy.array([0, 3, 5])
+	hist_sel, hist_all = numpy.array([0.1, 0.2, 0.3]), numpy.array([0.3, 0., 1e-5])
+	write_grid('test_grid.txt', edges, cells, hist_sel, hist_all)
+	edges2, cells2, hist_sel2, hist_all2 = read_grid('test_grid.txt')
+	assert all([(e == e2).all() for e, e2 in zip(edges, edges2)])
+	assert (cells == cells2).all() and (hist_sel == hist_sel2).all() and (hist_all == hist_all2).all()
+	os.unlink('test_grid.txt')
@@ -0,0 +1,35 @@
+from __future__ import print_function, division
+import numpy
+from nwaylib.incremental import *
+
+def test_diff_rows():
+	ra = numpy.array([1., 2., 3., 4., 4., 5.])
+	name = numpy.array([b'a', b'b', b'c', b'd', b'd', b'e'])
+	# row 1 removed, a new row and another copy of a repeated row added, and reordered
+	ra2 = numpy.array([5., 4., 4., 3.5, 3., 1., 4.])
+	name2 = numpy.array(['e', 'd', 'd', 'x', 'c', 'a', 'd'], dtype='U3')
+	old_columns = [('RA', ra), ('NAME', name)]
+	new_columns = [('RA', ra2), ('NAME', name2.astype('S'))]
+	dtypes = common_dtypes(old_columns, new_columns)
+	old_to_new, new_to_old = diff_rows(row_keys(old_columns, dtypes), row_keys(new_columns, dtypes))
+	assert old_to_new.tolist() == [5, -1, 4, 1, 2, 0], old_to_new
+	assert new_to_old.tolist() == [5, 3, 4, -1, 2, 0, -1], new_to_old
+	assert remap_index(old_to_new, numpy.array([0, -1, 3])).tolist() == [5, -1, 1]
+
+def test_row_keys_byteorder():
+	values = numpy.arange(10.)
+	# the same values in another byte order are identical rows
+	old_to_new, new_to_old = diff_rows(row_keys([('x', values.astype('>f8'))], chunk_size=3), row_keys([('x', values)]))
+	assert (old_to_new == numpy.arange(10)).all()
+
+def test_row_keys_vector_column():
+	flux = numpy.arange(30.).reshape((10, 3))
+	flux2 = flux.astype('>f4')
+	flux2[4, 1] = -1
+	old_columns = [('ID', numpy.arange(10)), ('FLUX', flux)]
+	new_columns = [('ID', numpy.arange(10).astype('>i4')), ('FLUX', flux2)]
+	dtypes = common_dtypes(old_columns, new_columns)
+	assert dtypes[1].shape == (3,), dtypes
+	old_to_new, new_to_old = diff_rows(row_keys(old_columns, dtypes, chunk_size=3), row_keys(new_columns, dtypes))
+	assert old_to_new.tolist() == [0, 1, 2, 3, -1, 5, 6, 7, 8, 9], old_to_new
+	assert new_to_old.tolist() == old_to_new.tolist()
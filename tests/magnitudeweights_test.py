@@ -0,0 +1,62 @@
+from __future__ import print_function, division
+import numpy
+from nwaylib.magnitudeweights import *
+
+def test_log_bias():
+	bins = numpy.array([0., 1, 2, 3.5])
+	hist_sel = numpy.array([0.2, 0., 0.5])
+	hist_all = numpy.array([0.1, 0.3, 0.])
+	values = numpy.array([-99, -1, 0, 0.5, 1, 1.5, 2, 3, 3.5, 3.6, numpy.nan, numpy.inf, -numpy.inf])
+	# the same as evaluating the interpolation function
+	func = fitfunc_histogram(bins, hist_sel, hist_all)
+	with numpy.errstate(divide='ignore'):
+		expected = numpy.log10(func(values))
+	expected[numpy.isnan(expected)] = 0
+	weights = log_bias(bins, log_bias_table(bins, hist_sel, hist_all), values)
+	assert (weights == expected).all(), (weights, expected)
+
+def test_streaming_histograms():
+	rng = numpy.random.RandomState(1)
+	mag_all = rng.normal(20, 2, 20000)
+	mag_sel = rng.normal(19, 1, 2000)
+	weights = rng.uniform(0.9, 1, 2000)
+	def chunks():
+		for lo in range(0, 20000, 3000):
+			yield mag_all[lo:lo+3000], mag_sel[lo//10:lo//10+300], weights[lo//10:lo//10+300]
+	expected = adaptive_histograms(mag_all, mag_sel, weights=weights)
+	# exact while the sketch holds all values
+	for a, b in zip(streaming_histograms(chunks), expected):
+		assert numpy.allclose(a, b, rtol=1e-12, atol=0)
+	# approximate with a small sketch
+	bins, hist_sel, hist_all = streaming_histograms(chunks, sketch_size=200)
+	assert len(bins) == len(expected[0])
+	assert numpy.allclose(bins, expected[0], atol=0.05)
+
+def test_quantile_sketch_merge():
+	rng = numpy.random.RandomState(2)
+	values = rng.uniform(0, 1, 10000)
+	a, b = QuantileSketch(size=100), QuantileSketch(size=100)
+	a.add(values[:7000])
+	b.add(values[7000:])
+	a.merge(b)
+	assert a.lo == values.min() and a.hi == values.max()
+	assert numpy.allclose(a.quantiles([0.1, 0.5, 0.9]), [0.1, 0.5, 0.9], atol=0.02)
+
+def test_adaptive_grid():
+	rng = numpy.random.RandomState(3)
+	mag_all = [rng.normal(20, 2, 5000), rng.normal(0.5, 0.3, 5000)]
+	mag_sel = [rng.normal(19, 1, 500), rng.normal(0.3, 0.2, 500)]
+	# a grid of one dimension gives the histograms and biases of one column
+	bins, hist_sel, hist_all = adaptive_histograms(mag_all[0], mag_sel[0])
+	edges, cells, grid_sel, grid_all = adaptive_grid(mag_all[:1], mag_sel[:1])
+	assert numpy.allclose(edges[0], bins)
+	assert numpy.allclose(grid_sel, hist_sel[cells]) and numpy.allclose(grid_all, hist_all[cells])
+	values = numpy.array([-99, 15, 19.5, 22, bins[-1], numpy.nan])
+	assert numpy.allclose(log_grid_bias(edges, cells, grid_sel, grid_all, [values]),
+		log_bias(bins, log_bias_table(bins, hist_sel, hist_all), values))
+	# two dimensions
+	edges, cells, grid_sel, grid_all = adaptive_grid(mag_all, mag_sel)
+	assert len(edges) == 2
+	assert (numpy.diff(cells) > 0).all()
+	weights = log_grid_bias(edges, cells, grid_sel, grid_all, [numpy.array([19., 19., -99]), numpy.array([0.3, 1.5, 0.3])])
+	assert weights[0] > 0 and weights[1] < weights[0] and weights[2] == 0
@@ -0,0 +1,30 @@
+from __future__ import print_function, division
+import numpy
+from nwaylib.planning import *
+import nwaylib.fastskymatch as match
+from nwaylib.logger import NullOutputLogger
+
+def _catalogues():
+	rng = numpy.random.RandomState(1)
+	return [(rng.uniform(150, 151, n), rng.uniform(2, 3, n)) for n in (300, 3000, 1500)]
+
+def test_sample_candidates():
+	radectables = _catalogues()
+	err = 10 / 3600.
+	# sampling all primary sources gives the full hashing result
+	sampled = sample_candidates(radectables, err, sample_size=1000)
+	results = match.hash_crossproduct(radectables, err, logger=NullOutputLogger())
+	assert sampled['nsample'] == 300
+	assert sampled['nhashed'] == len(results)
+	assert 300 <= sampled['nrows'] <= len(results)
+
+def test_plan():
+	radectables = _catalogues()
+	result = plan(radectables, [1., 1., 1.], 10 / 3600., row_bytes=100, memory_limit=10**10)
+	assert result['recommended']['engine'] == 'single'
+	assert result['candidates'] > 300
+	# too little memory for a single run
+	result = plan(radectables, [1., 1., 1.], 10 / 3600., row_bytes=100, memory_limit=2 * result['memory']['inputs'])
+	assert result['recommended']['engine'] == 'tiled'
+	assert result['recommended']['tile_nside'] >= 1
+	assert len(format_plan(result)) > 10
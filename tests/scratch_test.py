@@ -0,0 +1,27 @@
+from __future__ import print_function, division
+import numpy
+from nwaylib.scratch import *
+
+def test_parse_size():
+	assert parse_size('800') == 800
+	assert parse_size('2K') == 2048
+	assert parse_size('1.5G') == 3 * 1024**3 // 2
+	assert parse_size('16gb') == 16 * 1024**3
+
+def test_spill():
+	scratch = ScratchSpace(memory_limit=1000, chunk_size=7)
+	a = scratch.empty(100)
+	assert not isinstance(a, numpy.memmap)
+	b = scratch.full(100, numpy.nan)
+	assert isinstance(b, numpy.memmap)
+	assert numpy.isnan(b).all()
+	assert scratch.spilled == 800
+
+	values = numpy.arange(100.)
+	indices = numpy.arange(99, -1, -3)
+	mask = values % 3 == 1
+	for s in ScratchSpace(), scratch:
+		assert (s.take(values, indices) == values[indices]).all()
+		assert (s.compress(values, mask) == values[mask]).all()
+		assert (s.store(values) == values).all()
+		assert (s.apply(numpy.add, values, values, dtype='f4') == (2 * values).astype('f4')).all()
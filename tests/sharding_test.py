@@ -0,0 +1,40 @@
+from __future__ import print_function, division
+import numpy
+import pytest
+from nwaylib.sharding import *
+
+def test_split_tiles():
+	tiles = [3, 5, 8, 9, 20, 21]
+	shards = split_tiles(tiles, [10, 1, 1, 10, 5, 5], 3)
+	print(shards)
+	assert len(shards) == 3
+	assert sum(shards, []) == tiles
+	# as many shards as requested, also if one tile dominates the cost
+	assert split_tiles(tiles[:4], [1, 1, 1, 100], 3) == [[3, 5], [8], [9]]
+	assert split_tiles(tiles[:4], [100, 1, 1, 1], 3) == [[3], [5], [8, 9]]
+	# never more shards than tiles
+	assert split_tiles(tiles[:2], [1, 1], 5) == [[3], [5]]
+	assert split_tiles(tiles[:1], [1], 5) == [[3]]
+
+def test_strip_arguments():
+	argv = ['X.fits', ':pos_err', '--shards', '10', '--manifest=run.json', '--radius', '15']
+	assert strip_arguments(argv, ['--shards', '--manifest']) == ['X.fits', ':pos_err', '--radius', '15']
+
+def test_manifest():
+	with open('test_input.txt', 'w') as f:
+		f.write('input\n')
+	bins = numpy.array([18., 20., 22.])
+	manifest = write_manifest('test_manifest.json', ['test_input.txt', '0.1'], ['test_input.txt'],
+		'test_output.fits', 'fits', 64, [[1, 2], [7]], {'OPT:MAG': (bins, [0.4, 0.6], [0.1, 0.9])})
+	manifest2 = read_manifest('test_manifest.json')
+	assert manifest2['id'] == manifest['id']
+	check_inputs(manifest2)
+	assert shard_filename(manifest2, 1).endswith('test_output-shard0001.fits')
+	bins2, hist_sel, hist_all = magnitude_histograms(manifest2)['OPT:MAG']
+	assert (bins2 == bins).all()
+	
+	with open('test_input.txt', 'w') as f:
+		f.write('modified input\n')
+	with pytest.raises(AssertionError):
+		check_inputs(manifest2)
+
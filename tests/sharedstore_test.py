@@ -0,0 +1,29 @@
+from __future__ import print_function, division
+import os
+import numpy
+import multiprocessing
+from nwaylib.sharedstore import *
+
+def _sum_rows(task):
+	handles, rows = task
+	return attach(handles)['ra'][rows].sum()
+
+def test_shared_arrays():
+	ra = numpy.arange(1000, dtype='>f8')
+	with SharedArrays() as store:
+		view = store.publish('ra', ra, chunk_size=300)
+		assert view.dtype.isnative
+		assert not view.flags.writeable
+		assert (view == ra).all()
+		pool = multiprocessing.Pool(2)
+		try:
+			tasks = [(store.handles, numpy.arange(i, 1000, 10)) for i in range(10)]
+			sums = pool.map(_sum_rows, tasks)
+		finally:
+			pool.close()
+			pool.join()
+		assert sum(sums) == ra.sum()
+		directory = store.directory
+		assert os.path.exists(directory)
+	assert not os.path.exists(directory)
+
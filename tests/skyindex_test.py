@@ -0,0 +1,27 @@
+from __future__ import print_function, division
+import numpy
+from nwaylib.skyindex import *
+from nwaylib.fastskymatch import dist, combine_candidates
+
+def test_pairs():
+	numpy.random.seed(1)
+	radius = 0.5
+	# also near the pole and across RA=0
+	ra = numpy.random.uniform(0, 360, size=2000)
+	dec = numpy.degrees(numpy.arcsin(numpy.random.uniform(0.95, 1, size=2000)))
+	index = SkyIndex(ra, dec, radius)
+	assert len(index) == 2000
+	ra2 = numpy.array([0.1, 359.9, 120., 42.])
+	dec2 = numpy.array([89.9, 75., 80., 73.])
+	i, k, sep = index.pairs(ra2, dec2)
+	for j in range(len(ra2)):
+		expected = numpy.where(dist((ra2[j], dec2[j]), (ra, dec)) <= radius)[0]
+		assert k[i == j].tolist() == expected.tolist(), (j, k[i == j], expected)
+	assert (sep <= radius * (1 + 1e-6)).all()
+	assert (numpy.diff(i) >= 0).all()
+
+def test_combine_candidates():
+	results = combine_candidates(3, [(numpy.array([0, 0, 2]), numpy.array([4, 7, 1]))])
+	assert results.tolist() == [[0, -1], [0, 4], [0, 7], [1, -1], [2, -1], [2, 1]], results
+	results = combine_candidates(2, [(numpy.array([1]), numpy.array([3])), (numpy.array([1]), numpy.array([5]))])
+	assert results.tolist() == [[0, -1, -1], [1, -1, -1], [1, -1, 5], [1, 3, -1], [1, 3, 5]], results
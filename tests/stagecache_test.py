@@ -0,0 +1,25 @@
+from __future__ import print_function, division
+import os
+import shutil
+import numpy
+from nwaylib.stagecache import *
+
+def test_cache():
+	directory = 'test_stagecache'
+	shutil.rmtree(directory, ignore_errors=True)
+	cache = StageCache(directory)
+	assert cache.load('abc') is None
+	results = numpy.array([(0, -1), (0, 3)], dtype=[('X', 'i8'), ('OPT', 'i8')])
+	names = numpy.array([b'a', b'bc'])
+	cache.store('abc', [('results', results), ('names', names), ('sep', numpy.arange(2.))], dict(formats=['A2', 'E']))
+	arrays, info = cache.load('abc')
+	assert list(arrays.keys()) == ['results', 'names', 'sep']
+	assert isinstance(arrays['sep'], numpy.memmap)
+	assert (arrays['results']['OPT'] == results['OPT']).all()
+	assert (arrays['names'] == names).all()
+	assert info == dict(formats=['A2', 'E'])
+	# storing again (e.g., concurrently) keeps the stage result
+	cache.store('abc', [('sep', numpy.arange(2.))])
+	assert list(cache.load('abc')[0].keys()) == ['results', 'names', 'sep']
+	assert os.listdir(directory) == ['abc']
+	shutil.rmtree(directory)
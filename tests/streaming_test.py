@@ -0,0 +1,38 @@
+from __future__ import print_function, division
+import os
+import time
+import numpy
+from nwaylib.streaming import *
+
+def test_read_batches_pipe():
+	r, w = os.pipe()
+	os.write(w, b'{"a": 1}\n\n{"a": 2}\n{"a": 3}\n{"a"')
+	batches = read_batches(r, 2, wait=0.1)
+	assert next(batches) == [b'{"a": 1}', b'{"a": 2}']
+	# an incomplete batch is passed on after waiting
+	t = time.time()
+	assert next(batches) == [b'{"a": 3}']
+	assert time.time() - t < 1
+	# the last line is kept until the pipe is closed
+	os.write(w, b': 4}')
+	os.close(w)
+	assert list(batches) == [[b'{"a": 4}']]
+	os.close(r)
+
+def test_read_batches_file():
+	with open('test_input.ndjson', 'wb') as f:
+		f.write(b''.join(b'{"a": %d}\n' % i for i in range(5)))
+	fd = os.open('test_input.ndjson', os.O_RDONLY)
+	assert [len(lines) for lines in read_batches(fd, 2, wait=0.1)] == [2, 2, 1]
+	os.close(fd)
+
+def test_records_table():
+	records = parse_records([b'{"ID": 1, "RA": 10.5, "NAME": "a"}', b'not json', b'[1, 2]',
+		b'{"ID": 2, "RA": 11, "NAME": null}', b'{"RA": null}'])
+	assert len(records) == 3
+	fields = record_fields(records[0])
+	assert fields == [('ID', int), ('RA', float), ('NAME', str)]
+	table = records_table(records, fields)
+	assert list(table['ID']) == [1, 2, -99]
+	numpy.testing.assert_equal(table['RA'], [10.5, 11, numpy.nan])
+	assert list(table['NAME']) == ['a', '', '']
@@ -0,0 +1,103 @@
+from __future__ import print_function, division
+import numpy
+import pytest
+from nwaylib.tableio import *
+
+def test_row_group_ranges():
+	ids = numpy.array([1, 1, 1, 2, 2, 3, 4, 4, 4, 4, 5])
+	ranges = row_group_ranges(ids, 3)
+	print(ranges)
+	assert ranges == [(0, 3), (3, 6), (6, 10), (10, 11)]
+	# every primary source is in exactly one row group
+	for lo, hi in ranges:
+		assert lo == 0 or ids[lo] != ids[lo - 1]
+	assert row_group_ranges(ids[:0], 3) == []
+
+def test_write_parquet():
+	pytest.importorskip('pyarrow')
+	import pyarrow.parquet as pq
+	n = 1000
+	ids = numpy.repeat(numpy.arange(n // 4), 4).astype('>i4')
+	columns = [
+		('XMM_ID', ids),
+		('XMM_NAME', numpy.array([('src%d' % i).encode() for i in ids])),
+		('p_i', numpy.random.uniform(size=n)),
+	]
+	write_parquet('test_output.parquet', columns, metadata=dict(COL_PRIM='XMM_ID', TABLES='XMM, OPT'), row_group_size=30)
+	f = pq.ParquetFile('test_output.parquet')
+	assert f.metadata.num_rows == n
+	assert f.metadata.num_row_groups == (n + 31) // 32
+	assert read_parquet_metadata('test_output.parquet')['COL_PRIM'] == 'XMM_ID'
+	data = f.read()
+	assert (data.column('XMM_ID').to_numpy() == ids).all()
+	assert data.column('XMM_NAME')[0].as_py() == 'src0'
+
+def test_fits_writer():
+	import astropy.io.fits as pyfits
+	ids = numpy.arange(100)
+	names = numpy.array([('src%d' % i).encode() for i in ids])
+	with FITSTableWriter('test_output.fits', 'NWAYMATCH', formats=dict(NAME='8A', ID='K')) as writer:
+		for lo, hi in row_group_ranges(ids // 3, 10):
+			writer.write([('ID', ids[lo:hi]), ('NAME', names[lo:hi]), ('p_i', ids[lo:hi] / 100.)])
+	assert writer.nrows == 100
+	f = pyfits.open('test_output.fits')
+	f.verify('exception')
+	data = f['NWAYMATCH'].data
+	assert len(data) == 100
+	assert (data['ID'] == ids).all()
+	assert data['NAME'][42] == 'src42'
+	numpy.testing.assert_allclose(data['p_i'], ids / 100.)
+
+def test_ndjson_writer():
+	import json
+	ids = numpy.arange(10)
+	with NDJSONTableWriter('test_output.ndjson') as writer:
+		writer.write([('ID', ids[:4]), ('NAME', numpy.array(['a'] * 4)), ('p_i', numpy.array([0.5, numpy.nan, 1, 0]))])
+		writer.write([('ID', ids[4:]), ('NAME', numpy.array(['b'] * 6)), ('p_i', ids[4:] / 10.)])
+	assert writer.nrows == 10
+	rows = [json.loads(line) for line in open('test_output.ndjson')]
+	assert [row['ID'] for row in rows] == list(ids)
+	assert list(rows[0].keys()) == ['ID', 'NAME', 'p_i']
+	assert rows[1]['p_i'] is None
+	assert rows[9] == dict(ID=9, NAME='b', p_i=0.9)
+
+def test_open_table():
+	n = 50
+	ra = numpy.random.uniform(size=n)
+	ids = numpy.arange(n)
+	with open('test_input.csv', 'w') as f:
+		f.write('# EXTNAME = OPT\n# SKYAREA = 0.5\n')
+		f.write('ID,RA,DEC\n')
+		for i in ids:
+			f.write('%d,%.17g,%.17g\n' % (i, ra[i], -ra[i]))
+	table = open_table('test_input.csv')
+	assert table.name == 'OPT'
+	assert table.area == 0.5
+	assert len(table.data) == n
+	assert table.data.dtype.names == ('ID', 'RA', 'DEC')
+	assert (table.data['ID'] == ids).all()
+	numpy.testing.assert_allclose(table.data['RA'], ra)
+	
+	table = open_table('test_input.csv', name='OPT2', area=2)
+	assert table.name == 'OPT2'
+	assert table.area == 2.0
+	
+	pytest.importorskip('pyarrow')
+	write_parquet('test_input.parquet', [('ID', ids), ('RA', ra), ('DEC', -ra)], metadata=dict(EXTNAME='OPT', SKYAREA=0.5))
+	table = open_table('test_input.parquet')
+	assert (table.name, table.area, len(table.data)) == ('OPT', 0.5, n)
+	numpy.testing.assert_allclose(table.data['DEC'], -ra)
+
+def test_cached_table():
+	data = numpy.zeros(1000, dtype=[('RA', '>f8'), ('ID', '>i4')])
+	data['RA'] = numpy.linspace(0, 1, 1000)
+	data['ID'] = numpy.arange(1000)
+	table = CachedTable(data)
+	assert len(table) == 1000
+	table.load(['RA'])
+	assert table['RA'].dtype.isnative
+	assert (table['RA'] == data['RA']).all()
+	# not loaded columns come from the table
+	assert not table['ID'].dtype.isnative
+	assert (to_native(data['ID'], chunk_size=77) == numpy.arange(1000)).all()
+
@@ -0,0 +1,48 @@
+from __future__ import print_function, division
+import numpy
+from nwaylib.tiling import *
+from nwaylib.fastskymatch import dist
+
+def test_tile_margin():
+	numpy.random.seed(1)
+	err = 20. / 60 / 60
+	n = 2000
+	# a field crossing RA=0 and several tiles
+	ra1 = numpy.random.uniform(-0.5, 0.5, size=n) % 360
+	dec1 = numpy.random.uniform(-0.5, 0.5, size=n)
+	ra2 = numpy.random.uniform(-0.5, 0.5, size=n) % 360
+	dec2 = numpy.random.uniform(-0.5, 0.5, size=n)
+	tiles = list(iter_tiles([(ra1, dec1), (ra2, dec2)], err, 64))
+	assert len(tiles) > 1
+	# every primary source is in exactly one tile
+	primary_rows = numpy.concatenate([rows[0] for tile, rows in tiles])
+	assert sorted(primary_rows) == list(range(n))
+	# all secondary sources within err of a primary source are in its tile
+	for tile, (rows1, rows2) in tiles:
+		for i in rows1:
+			near = numpy.where(dist((ra1[i], dec1[i]), (ra2, dec2)) < err)[0]
+			assert numpy.in1d(near, rows2).all(), (tile, i, near, rows2)
+
+def test_tile_rows():
+	ra = numpy.array([10., 10.001, 200.])
+	dec = numpy.array([0., 0., 40.])
+	tiles = tile_rows(ra, dec, 8, chunk_size=2)
+	assert len(tiles) == 2
+	assert sorted([list(rows) for rows in tiles.values()]) == [[0, 1], [2]]
+
+def test_prefetch():
+	assert list(prefetch(lambda x: x**2, range(5))) == [0, 1, 4, 9, 16]
+	assert list(prefetch(lambda x: x, [])) == []
+	def fail(x):
+		if x == 2:
+			raise ValueError(x)
+		return x
+	results = []
+	try:
+		for r in prefetch(fail, range(5)):
+			results.append(r)
+		assert False
+	except ValueError:
+		pass
+	assert results == [0, 1]
+